@@ -0,0 +1,245 @@
+"""
+JSON API для скриптов: /api/v1/...
+
+    GET    /api/v1/briefcase[?fields=plan_count,fact_count&tickers=SBER,GAZP&portfolio=NAME]
+    GET    /api/v1/briefcases?email=A&email=B   (только API_SERVICE_ACCOUNTS)
+    GET    /api/v1/portfolios                   (все портфели и позиции вместе)
+    GET    /api/v1/prices
+    GET    /api/v1/weights/<name>
+    POST   /api/v1/token                        (новый токен, по сессии)
+    DELETE /api/v1/token                        (отозвать все токены)
+
+Авторизация: сессия после TOTP или заголовок Authorization: Bearer <token>.
+Суммы — строки с копейками, веса — целые базисные пункты, проценты — float.
+Если установлены orjson и brotli, они используются для кодирования и сжатия.
+"""
+import gzip
+import json
+from functools import wraps
+
+from flask import Blueprint, Response, g, request, session
+
+import db
+import settings
+from application import (app_shares, app_snapshot, app_weight_manager, get_db, get_user,
+                         init_briefcase, last_prices)
+from cache import briefcases
+from main import ConsolidatedBriefcase, weight_to_bp
+from users import User, hash_token
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SERVICE_ACCOUNTS = set(getattr(settings, "API_SERVICE_ACCOUNTS", ()))
+MAX_BATCH = getattr(settings, "API_MAX_BATCH", 100)
+COMPRESS_MIN_SIZE = 1024
+
+
+def price_str(price) -> str:
+    # 310.500000 -> "310.5", 300 -> "300"
+    return f'{price.normalize():f}'
+
+
+POSITION_FIELDS = {
+    'price': lambda ub, we: price_str(we.price),
+    'lotsize': lambda ub, we: we.lotsize,
+    'weight_bp': lambda ub, we: we.weight_bp,
+    'plan_count': lambda ub, we: ub.plans[we.ticker].count,
+    'plan_amount': lambda ub, we: f'{ub.plans[we.ticker].amount:.2f}',
+    'fact_count': lambda ub, we: ub.facts[we.ticker].count,
+    'fact_amount': lambda ub, we: f'{ub.facts[we.ticker].amount:.2f}',
+    'in_percent': lambda ub, we: round(float(ub.get_in_percent(we.ticker)), 6),
+    'of_total': lambda ub, we: round(float(ub.percent_of_total(we.ticker)), 6),
+    'favorite': lambda ub, we: we.ticker in ub.favorites,
+    'stale': lambda ub, we: we.stale,
+}
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, default=str, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def json_response(data, status=200) -> Response:
+    body = dumps(data)
+    response = Response(body, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def error(message, status):
+    return json_response({'error': message}, status)
+
+
+def api_auth(view):
+    # email пользователя — из токена или из сессии
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        email = None
+        kind, _, token = request.headers.get('Authorization', '').partition(' ')
+        if kind.lower() == 'bearer' and token:
+            email = db.fetch_api_token_email(get_db().cursor(), hash_token(token.strip()))
+        elif 'email' in session:
+            email = session['email']
+        if email is None:
+            return error('unauthorized', 401)
+        g.api_email = email
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def split_arg(name):
+    value = request.args.get(name)
+    return [item for item in value.split(',') if item] if value else None
+
+
+def user_briefcase(email, user: User):
+    user_data = user.briefcase
+    weight_name = user_data.get('weight_name', 'MOEX 2022')
+    key = (email, user.portfolio)
+    ub = briefcases.take(key, app_weight_manager(weight_name), user_data)
+    if ub is None:
+        ub = init_briefcase(user_data)
+    briefcases.put(key, user_data, ub)
+    return weight_name, ub
+
+
+def briefcase_payload(email, user: User, fields, tickers):
+    weight_name, ub = user_briefcase(email, user)
+    getters = [(name, POSITION_FIELDS[name]) for name in fields]
+    wanted = set(tickers) if tickers else None
+    return {
+        'email': email,
+        'portfolio': user.portfolio,
+        'weight_name': weight_name,
+        'capital': f'{ub.capital:.2f}',
+        'plan_sum': f'{ub.all_rur:.2f}',
+        'fact_sum': f'{ub.user_amount_sum:.2f}',
+        'tracking_error': round(ub.tracking_error, 6),
+        'ignored': sorted(ub.ignored),
+        'positions': {
+            we.ticker: {name: getter(ub, we) for name, getter in getters}
+            for we in ub.all if wanted is None or we.ticker in wanted},
+    }
+
+
+def selected_fields():
+    fields = split_arg('fields') or list(POSITION_FIELDS)
+    unknown = [name for name in fields if name not in POSITION_FIELDS]
+    return fields, unknown
+
+
+@api.route('/briefcase')
+@api_auth
+def briefcase_view():
+    fields, unknown = selected_fields()
+    if unknown:
+        return error(f'unknown fields: {", ".join(unknown)}', 400)
+    portfolio = request.args.get('portfolio', db.MAIN_PORTFOLIO)
+    user = get_user(g.api_email, portfolio)
+    if user.portfolio != portfolio:
+        return error('unknown portfolio', 404)
+    return json_response(briefcase_payload(g.api_email, user, fields, split_arg('tickers')))
+
+
+@api.route('/briefcases')
+@api_auth
+def briefcases_view():
+    # несколько пользователей за один запрос, для сервисных аккаунтов
+    if g.api_email not in SERVICE_ACCOUNTS:
+        return error('forbidden', 403)
+    fields, unknown = selected_fields()
+    if unknown:
+        return error(f'unknown fields: {", ".join(unknown)}', 400)
+    emails = request.args.getlist('email')[:MAX_BATCH]
+    tickers = split_arg('tickers')
+    conn = get_db()
+    existing = db.fetch_existing_emails(conn.cursor(), emails)
+    return json_response({
+        'briefcases': [briefcase_payload(email, User(conn, email), fields, tickers)
+                       for email in emails if email in existing],
+        'missing': [email for email in emails if email not in existing],
+    })
+
+
+@api.route('/portfolios')
+@api_auth
+def portfolios_view():
+    user = get_user(g.api_email, db.MAIN_PORTFOLIO)
+    consolidated = ConsolidatedBriefcase(
+        app_shares(), last_prices(), user.portfolios(),
+        db.fetch_all_positions(get_db().cursor(), g.api_email))
+    return json_response({
+        'email': g.api_email,
+        'capital': f'{consolidated.capital:.2f}',
+        'fact_sum': f'{consolidated.amount_sum:.2f}',
+        'portfolios': {
+            p.name: {'weight_name': p.weight_name, 'capital': f'{p.capital:.2f}',
+                     'fact_sum': f'{p.amount:.2f}'}
+            for p in consolidated.portfolios},
+        'positions': {
+            h.ticker: {'price': None if h.price is None else price_str(h.price),
+                       'count': h.count, 'amount': f'{h.amount:.2f}',
+                       'counts': {p.name: count
+                                  for p, count in zip(consolidated.portfolios, h.counts) if count}}
+            for h in consolidated.holdings},
+    })
+
+
+@api.route('/prices')
+@api_auth
+def prices_view():
+    snapshot = app_snapshot()
+    return json_response({
+        'version': snapshot.version[0] if snapshot.version else None,
+        'prices': {
+            ticker: {'price': price_str(db.units_to_decimal(db.price_to_units(attr['price']))),
+                     'lotsize': attr['lotsize'], 'source': attr.get('source'),
+                     'stale': attr.get('stale', False)}
+            for ticker, attr in (snapshot.prices or {}).items()},
+    })
+
+
+@api.route('/weights/<name>')
+@api_auth
+def weights_view(name):
+    weights_map = app_snapshot().fetch_weights(get_db().cursor(), name)
+    if weights_map is None:
+        return error('unknown weights', 404)
+    return json_response({
+        'name': name,
+        'weights_bp': {ticker: weight_to_bp(weight) for ticker, weight in weights_map.items()},
+    })
+
+
+@api.route('/token', methods=['POST', 'DELETE'])
+def token_view():
+    # токены выдаются только по сессии, не по другому токену
+    if 'email' not in session:
+        return error('unauthorized', 401)
+    user = get_user(session['email'])
+    if request.method == 'DELETE':
+        user.revoke_api_tokens()
+        return json_response({'revoked': True})
+    return json_response({'token': user.new_api_token()}, 201)
+
@@ -1,68 +1,261 @@
+import hashlib
+import hmac
 import json
-import sqlite3
+import threading
+import time
 import typing as t
 from decimal import Decimal
 
-import pyotp
 from flask import Flask
+from flask import before_render_template, template_rendered
 from flask import g
-from flask import make_response, redirect, render_template, render_template_string
+from flask import Response, make_response, redirect, render_template, render_template_string
 from flask import request, session
-from flask_qrcode import QRcode
+from jinja2 import FileSystemBytecodeCache
 
 import db
+import metrics
 import settings
-import tink
-from main import UserBriefcase, WeightManager
+import weightsets
+from cache import briefcases, fragments, purchases, snapshot
+from refresher import refresher
+from main import ConsolidatedBriefcase, UserBriefcase, WeightManager
 from users import User
 
 app = Flask(__name__)
 app.secret_key = settings.SECRET_KEY
 DATABASE = getattr(settings, "SQLITE_DB_NAME", "moex.sqlite")
-QRcode(app)
+DATABASE_POOL_SIZE = getattr(settings, "SQLITE_POOL_SIZE", 4)
+QUERY_COUNT_HEADER = getattr(settings, "QUERY_COUNT_HEADER", False)
+BRIEFCASE_ENGINE = getattr(settings, "BRIEFCASE_ENGINE", "decimal")
+PLAN_SOLVER = getattr(settings, "PLAN_SOLVER", "round")
+JINJA_CACHE_DIR = getattr(settings, "JINJA_CACHE_DIR", None)
+PROFILING = getattr(settings, "PROFILING", False)
+# /metrics и /cache_stats; с METRICS_TOKEN — только с Authorization: Bearer <token>
+METRICS_ENABLED = getattr(settings, "METRICS_ENABLED", False)
+METRICS_TOKEN = getattr(settings, "METRICS_TOKEN", None)
+purchases.bucket = getattr(settings, "BUY_NEXT_BUCKET", 1000)
+db_pool = db.ConnectionPool(DATABASE, DATABASE_POOL_SIZE)
+
+# байткод шаблонов переживает перезапуск, общие ячейки строк — в fragments
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+fragments.install(app.jinja_env)
+render_stats = {}
+
+
+@app.template_global()
+def qrcode(data):
+    # flask_qrcode тянет qrcode и PIL, нужен только при входе
+    from flask_qrcode import QRcode
+    return QRcode.qrcode(data)
+
+
+def compile_templates() -> str:
+    # компилируем все шаблоны заранее; хеш исходников входит в ETag страниц
+    digest = hashlib.sha1()
+    for name in sorted(app.jinja_env.list_templates()):
+        source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, name)
+        digest.update(source.encode())
+        app.jinja_env.get_template(name)
+    return digest.hexdigest()
+
+
+TEMPLATES_DIGEST = compile_templates()
+
+
+@before_render_template.connect_via(app)
+def render_started(sender, template, context, **extra):
+    g._render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def render_finished(sender, template, context, **extra):
+    started = g.pop('_render_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    g._render_time = g.get('_render_time', 0.0) + elapsed
+    metrics.spans.observe(elapsed, span=f'render {template.name}')
+    stats = render_stats.setdefault(template.name or '<string>', [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
 
 
 def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-    return db
+    conn = getattr(g, '_database', None)
+    if conn is None:
+        with metrics.span('get_db'):
+            conn = g._database = db_pool.acquire()
+        g._queries = db.QueryCounter().attach(conn)
+    return conn
+
+
+def get_user(email, portfolio=None) -> User:
+    # один User на запрос, изменения пишет flush_user;
+    # без portfolio — портфель, выбранный в сессии
+    if portfolio is None:
+        portfolio = session.get('portfolio', db.MAIN_PORTFOLIO)
+    user = getattr(g, '_user', None)
+    if user is None or user.email != email or user.portfolio != portfolio:
+        user = g._user = User(get_db(), email, portfolio)
+        if user.portfolio != portfolio and session.get('portfolio') == portfolio:
+            # портфель удалён, например в другой вкладке
+            session.pop('portfolio')
+    return user
+
+
+@app.before_request
+def start_request():
+    g._started = time.perf_counter()
+    start_refresher()
+    # сэмплирующий профилировщик по заголовку X-Profile или cookie profile
+    if PROFILING and (request.headers.get('X-Profile') or request.cookies.get('profile')):
+        g._profiler = metrics.Profiler(threading.get_ident()).start()
+
+
+@app.after_request
+def record_request(response):
+    # выполняется последним из after_request, после flush_user
+    started = g.get('_started')
+    if started is not None:
+        metrics.request_seconds.observe(time.perf_counter() - started,
+                                        endpoint=request.endpoint or 'unknown')
+    queries = g.get('_queries')
+    if queries is not None:
+        metrics.request_queries.observe(queries.count, endpoint=request.endpoint or 'unknown')
+        metrics.queries.inc(queries.count)
+    profiler = g.pop('_profiler', None)
+    if profiler is not None:
+        profile_id = metrics.save_profile(profiler.stop())
+        response.headers['X-Profile-Id'] = profile_id
+        response.headers['X-Profile-Url'] = f'/profiles/{profile_id}'
+    return response
+
+
+@app.after_request
+def flush_user(response):
+    user = getattr(g, '_user', None)
+    if user is not None:
+        user.flush()
+    queries = getattr(g, '_queries', None)
+    if queries is not None and (QUERY_COUNT_HEADER or app.testing):
+        response.headers['X-Query-Count'] = str(queries.count)
+    render_time = g.get('_render_time')
+    if render_time is not None:
+        response.headers['Server-Timing'] = f'render;dur={render_time * 1000:.1f}'
+    return response
+
+
+def start_refresher():
+    # поток запускается в воркере, а не в мастере gunicorn до fork
+    if refresher.interval:
+        refresher.start()
+
+
+def init_db():
+    # отдельное соединение: в пуле не должно быть соединений, открытых до fork
+    conn = db_pool.connect()
+    try:
+        db.init_sqlite(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+init_db()
+
+
+@app.teardown_request
+def stop_profiler(exception):
+    # при исключении after_request не вызывается
+    profiler = g.pop('_profiler', None)
+    if profiler is not None:
+        profiler.stop()
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    conn = getattr(g, '_database', None)
+    if conn is not None:
+        db.QueryCounter.detach(conn)
+        db_pool.release(conn)
+
+
+def app_snapshot():
+    # версия снимка проверяется один раз за запрос
+    if not getattr(g, '_snapshot_checked', False):
+        snapshot.refresh(get_db().cursor())
+        g._snapshot_checked = True
+    return snapshot
 
 
 def app_shares() -> t.Mapping:
-    result = getattr(g, '_shares', None)
-    if result is None:
-        result = g._shares = db.fetch_names(get_db().cursor())
-    return result
+    return app_snapshot().names
 
 
 def last_prices() -> t.Mapping:
-    result = getattr(g, '_last_prices', None)
-    if result is None:
-        result = g._last_prices = db.fetch_last_prices(get_db().cursor())
-    return result
+    return app_snapshot().prices
+
+
+def app_weight_manager(weight_name) -> WeightManager:
+    return app_snapshot().weight_manager(get_db().cursor(), weight_name)
+
+
+def briefcase_class():
+    if BRIEFCASE_ENGINE == 'numpy':
+        from vector import VectorBriefcase
+        return VectorBriefcase
+    return UserBriefcase
 
 
 def init_briefcase(user_data):
     weight_name = user_data.get('weight_name', 'MOEX 2022')
-    weights_map = db.fetch_weights(get_db().cursor(), weight_name)
-    ub = UserBriefcase(
-        WeightManager(app_shares(), last_prices(), weights_map),
-        user_data['ignored'].split(),
-        user_data['favorites'].split(),
+    ub = briefcase_class()(
+        app_weight_manager(weight_name),
+        user_data['ignored'],
+        user_data['favorites'],
         user_data['capital'],
         user_data['shares'],
+        solver=PLAN_SOLVER,
     )
     return ub
 
 
+def warm_up():
+    """
+    Загружает в общий кэш снимок цен, названия, все наборы весов
+    с их WeightManager и общие ячейки таблиц.
+
+    gunicorn.conf.py вызывает её в мастере перед fork: воркеры получают
+    прогретый кэш без запросов к базе, страницы памяти общие до первой записи.
+    """
+    conn = db_pool.connect()
+    try:
+        cursor = conn.cursor()
+        snapshot.refresh(cursor)
+        managers = [snapshot.weight_manager(cursor, name)
+                    for name in db.fetch_weights_names(cursor) or ()]
+    finally:
+        conn.close()
+    briefcase_class()  # numpy для VectorBriefcase тоже импортируется до fork
+    with app.app_context():
+        for manager in managers:
+            for we in manager.weights.values():
+                for layout in fragments.MACROS:
+                    fragments.cells(layout, we)
+
+
+def page_etag(email, user_data, layout, is_htmx) -> str:
+    # всё, от чего зависит страница таблицы
+    state = (TEMPLATES_DIGEST, app_snapshot().version, email, user_data.get('portfolio'),
+             layout, is_htmx, BRIEFCASE_ENGINE, PLAN_SOLVER,
+             user_data.get('weight_name'), user_data['capital'],
+             sorted(user_data['ignored']), sorted(user_data['favorites']),
+             sorted(user_data['shares'].items()))
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+
 def htmx_response(template, **data):
     is_htmx = request.headers.get('Hx-Request') == 'true'
 
@@ -77,44 +270,117 @@ def index():
     if 'email' not in session:
         return redirect('/login')
 
-    user = User(get_db(), session['email'])
+    templates = {
+        'desktop': 'table.html',
+        'mobile': 'table-mobile.html',
+    }
+    layout = request.cookies.get('layout', '')
+    template = templates.get(layout, templates['mobile'])
+
+    user = get_user(session['email'])
     user_briefcase = user.briefcase
+    weight_name = user_briefcase.get('weight_name', 'MOEX 2022')
+    key = (session['email'], user.portfolio)
+    etag = None
+    if request.method == 'GET':
+        # пользователь и снимок не менялись — страница та же
+        etag = page_etag(session['email'], user_briefcase, template,
+                         request.headers.get('Hx-Request') == 'true')
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
+    # посчитанный ранее портфель: меняем в нём только затронутые акции
+    ub = briefcases.take(key, app_weight_manager(weight_name), user_briefcase)
+    changed = set()
+    full = ub is None or request.method != 'PATCH'
 
     if request.method == 'PATCH':
         for k, v in request.form.items():
             if k == 'capital':
                 user_briefcase['capital'] = int(v)
-                user.save(capital=user_briefcase['capital'])
+                user.save_portfolio(capital=user_briefcase['capital'])
+                if ub is not None:
+                    ub.set_capital(user_briefcase['capital'])
+                full = True
             elif k == 'toggle_fav':
-                favs = user_briefcase['favorites'].split()
-                if v in favs:
-                    favs.remove(v)
-                else:
-                    favs.append(v)
-                user_briefcase['favorites'] = ' '.join(favs)
-                user.save(favorites=user_briefcase['favorites'])
+                favs = user_briefcase['favorites']
+                user.toggle_flag('favorite', v, v not in favs)
+                favs ^= {v}
+                if ub is not None:
+                    # меняется только подсветка строки акции
+                    ub.favorites = set(favs)
+                    changed.add(v)
             elif k == 'toggle_ign':
-                ignored = user_briefcase['ignored'].split()
-                if v in ignored:
-                    ignored.remove(v)
-                elif not user_briefcase['shares'].get(v):
-                    ignored.append(v)
-                user_briefcase['ignored'] = ' '.join(ignored)
-                user.save(ignored=user_briefcase['ignored'])
+                ignored = user_briefcase['ignored']
+                if v in ignored or not user_briefcase['shares'].get(v):
+                    user.toggle_flag('ignored', v, v not in ignored)
+                    ignored ^= {v}
+                ub = None
+                full = True
             else:
                 user_briefcase['shares'][k] = int(v)
-                user.save(shares=user_briefcase['shares'])
+                user.save_position(k, int(v))
+                if ub is not None:
+                    affected = ub.set_count(k, int(v))
+                    if affected is None:
+                        ub = None
+                        full = True
+                    else:
+                        changed |= affected
+
+    if ub is None:
+        ub = init_briefcase(user_briefcase)
+    briefcases.put(key, user_briefcase, ub)
+
+    if not full and request.headers.get('Hx-Request') == 'true':
+        # только изменённые строки и итоги, hx-swap-oob
+        rows = [we for we in ub.all if we.ticker in changed]
+        response = make_response(render_template(
+            'table-oob.html', ub=ub, rows=rows, layout=layout if layout in templates else 'mobile'))
+        response.headers['HX-Reswap'] = 'none'
+        return response
+
+    response = make_response(htmx_response(template, ub=ub, session=session))
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('HX-Request')
+    return response
 
-    ub = init_briefcase(user_briefcase)
 
-    templates = {
-        'desktop': 'table.html',
-        'mobile': 'table-mobile.html',
-    }
-    layout = request.cookies.get('layout', '')
-    template = templates.get(layout, templates['mobile'])
+@app.route("/buy_next")
+def buy_next_view():
+    if 'email' not in session:
+        return redirect('/login')
 
-    return htmx_response(template, ub=ub, session=session)
+    try:
+        cash = Decimal(request.args.get('cash', '').replace(' ', '') or 0)
+        if not cash.is_finite() or cash < 0:
+            raise ArithmeticError(cash)
+    except ArithmeticError:
+        return 'invalid cash', 400
+    user = get_user(session['email'])
+    user_briefcase = user.briefcase
+    key = (session['email'], user.portfolio)
+    weight_manager = app_weight_manager(user_briefcase.get('weight_name', 'MOEX 2022'))
+
+    def compute(cash):
+        ub = briefcases.take(key, weight_manager, user_briefcase)
+        if ub is None:
+            ub = init_briefcase(user_briefcase)
+        briefcases.put(key, user_briefcase, ub)
+        return ub.buy_next(cash)
+
+    cash, result = purchases.get(key, snapshot.version, user_briefcase, cash, compute)
+    if request.headers.get('Hx-Request') == 'true':
+        return render_template('buy-next.html', cash=cash, purchases=result,
+                               names=snapshot.names)
+    return {
+        'cash': f'{cash:.2f}',
+        'purchases': [{'ticker': p.ticker, 'lots': p.lots, 'count': p.count,
+                       'amount': f'{p.amount:.2f}'} for p in result],
+    }
 
 
 @app.route("/settings")
@@ -134,28 +400,25 @@ def weights_view():
     weights_names = db.fetch_weights_names(cursor)
 
     if request.args.get('use'):
-        cursor.execute(
-            "UPDATE users SET weight_name=? WHERE email=?",
-            (request.args.get('use'), session['email'],))
-        conn.commit()
+        get_user(session['email']).save_portfolio(weight_name=request.args.get('use'))
         return redirect('/')
 
     if request.method == 'POST':
         content = request.form.get('content')
         name = request.form.get('name')
         if name and content:
-            tickers = set(json.loads(content).keys())
-            db.add_new_tickers(cursor, tickers)
-
-            if name in weights_names:
-                cursor.execute(
-                    "UPDATE weights SET weights_json=? WHERE name=?",
-                    (content, name, ))
-            else:
-                cursor.execute(
-                    "INSERT INTO weights VALUES(?, ?)",
-                    (name, content, ))
-            conn.commit()
+            # JSON или строки weights.txt; тот же набор повторно не пишется
+            try:
+                changed = weightsets.ingest(cursor, name, weightsets.parse(content))
+            except weightsets.WeightsError as e:
+                response = make_response(render_template(
+                    'weights_form.html', content=content, name=name, errors=e.problems))
+                response.headers['HX-Retarget'] = '#weight_form'
+                return response
+            if changed:
+                conn.commit()
+                snapshot.invalidate(conn)
+                weights_names = db.fetch_weights_names(cursor)
         else:
             return 'error'
 
@@ -169,21 +432,105 @@ def weights_view():
     return htmx_response('weights.html', weights_names=weights_names, session=session)
 
 
+@app.route("/portfolios", methods=['GET', 'POST'])
+def portfolios_view():
+    if 'email' not in session:
+        return redirect('/login')
+
+    user = get_user(session['email'])
+    if 'use' in request.args:
+        name = request.args['use']
+        if name != db.MAIN_PORTFOLIO and name in user.portfolios():
+            session['portfolio'] = name
+        else:
+            session.pop('portfolio', None)
+        return redirect('/')
+
+    cursor = get_db().cursor()
+    if request.method == 'POST':
+        delete = request.form.get('delete')
+        name = request.form.get('name', '').strip()
+        if delete:
+            user.delete_portfolio(delete)
+            if session.get('portfolio') == delete:
+                session.pop('portfolio')
+        elif name:
+            user.add_portfolio(name, int(request.form.get('capital') or 1000 * 1000),
+                               request.form.get('weight_name') or 'MOEX 2022')
+        else:
+            return 'error'
+
+    # все портфели одним проходом по позициям, цены из общего снимка
+    consolidated = ConsolidatedBriefcase(
+        app_shares(), last_prices(), user.portfolios(),
+        db.fetch_all_positions(cursor, session['email']))
+    return htmx_response('portfolios.html', consolidated=consolidated,
+                         current=session.get('portfolio', db.MAIN_PORTFOLIO),
+                         weights_names=db.fetch_weights_names(cursor), session=session)
+
+
 @app.route("/update_prices", methods=['GET', 'POST'])
 def update_prices_view():
-    tickers = list(app_shares().keys())
-    with tink.Client(tink.TOKEN) as client:
-        shares = tink.get_shares(client, tickers)
-        shares_with_prices = tink.get_prices(client, shares)
+    # цены обновит фоновый поток (этого или другого воркера),
+    # клиент опрашивает /refresh_status, пока в базе не появится новый снимок
+    since = db.fetch_last_snapshot_id(get_db().cursor())
+    failures = refresher.failures
+    refresher.request()
+    if request.headers.get('Hx-Request') == 'true':
+        return render_template('refresh.html', since=since, failures=failures)
+    return redirect('/')
+
 
-    price_map = {
-        share.ticker: {'price': float(price), 'lotsize': share.lot}
-        for share, price in shares_with_prices}
+@app.route("/refresh_status")
+def refresh_status_view():
+    since = request.args.get('since', type=int)
+    if since is not None:
+        if db.fetch_last_snapshot_id(get_db().cursor()) > since:
+            response = make_response('', 200)
+            response.headers['HX-Refresh'] = 'true'
+            return response
+        if refresher.failures > request.args.get('failures', 0, type=int):
+            # 286 — htmx прекращает опрос
+            return render_template('refresh.html', error=refresher.last_error), 286
+        return '', 204
+    stats = refresher.stats()
+    stats['snapshot'] = db.fetch_last_snapshot_id(get_db().cursor())
+    return stats
+
+
+def metrics_allowed() -> bool:
+    if not METRICS_ENABLED:
+        return False
+    if not METRICS_TOKEN:
+        return True
+    kind, _, token = request.headers.get('Authorization', '').partition(' ')
+    return kind.lower() == 'bearer' and hmac.compare_digest(token.strip(), METRICS_TOKEN)
+
+
+@app.route("/cache_stats")
+def cache_stats_view():
+    if not metrics_allowed():
+        return 'not found', 404
+    result = snapshot.stats()
+    result['render'] = {name: {'count': count, 'total_ms': total * 1000, 'max_ms': longest * 1000}
+                        for name, (count, total, longest) in render_stats.items()}
+    return result
 
-    g._last_prices = price_map
-    WeightManager.save_to_sqlite(get_db(), 'tinkoff', price_map)
 
-    return redirect('/')
+@app.route("/metrics")
+def metrics_view():
+    if not metrics_allowed():
+        return 'not found', 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/profiles/<profile_id>")
+def profile_view(profile_id):
+    # свёрнутые стеки для flamegraph.pl или speedscope
+    profile = metrics.profiles.get(profile_id) if PROFILING else None
+    if profile is None:
+        return 'profile not found', 404
+    return Response(profile, mimetype='text/plain')
 
 
 @app.route("/qr")
@@ -196,16 +543,19 @@ def login():
     qr = None
     email = request.form.get('email', '')
     if request.method == 'POST' and email:
-        user = User(get_db(), email)
+        # портфель из сессии мог остаться от другого пользователя
+        user = get_user(email, db.MAIN_PORTFOLIO)
         code = request.form.get('code')
         if code:
             if user.check(code):
                 session['email'] = email
+                session.pop('portfolio', None)
                 return 'Login success, go to <a href="/">MOEX table</a>'
             else:
                 print('check code failed')
 
         elif not user.is_available():
+            import pyotp
             user_secret = user.new_secret()
             qr = pyotp.totp.TOTP(user_secret).provisioning_uri(
                 name=email, issuer_name='MOEX table')
@@ -217,4 +567,10 @@ def login():
 def logout():
     if 'email' in session:
         del session['email']
+    session.pop('portfolio', None)
     return redirect('/')
+
+
+# api импортирует помощники отсюда, поэтому регистрируется в конце
+from api import api  # noqa: E402
+app.register_blueprint(api)
@@ -0,0 +1,244 @@
+"""
+Архив старых снимков цен: колонки numpy, один каталог на месяц.
+
+    python3 archive.py compact [--keep-months N] [--vacuum]  # перенести из SQLite в архив
+    python3 archive.py export [--keep-months N]              # записать архив, не удаляя из SQLite
+    python3 archive.py info
+
+Каталог archive/YYYY-MM/ содержит:
+
+    meta.json         тикеры (колонки) и источники
+    ids.npy           int64[n]      id снимков в SQLite
+    dt.npy            str[n]        dt снимков, как в SQLite
+    source.npy        int16[n]      номер источника из meta.json
+    price_units.npy   int64[n, k]   цены в PRICE_SCALE, 0 — нет цены
+    lotsize.npy       int32[n, k]
+
+Файлы не сжаты и открываются через np.load(mmap_mode='r'), поэтому
+срезы строк — представления numpy без копирования. Сжатие и дельта-кодирование
+потребовали бы распаковки в память на каждое чтение.
+
+timeline() отдаёт архив и SQLite как одну последовательность снимков.
+После export снимки остаются и в SQLite, поэтому из SQLite берутся только
+снимки новее последнего в архиве (id растут вместе с dt).
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from collections import namedtuple
+from datetime import date
+from itertools import chain, groupby
+
+import numpy as np
+
+import db
+import settings
+from db import PRICE_SCALE
+
+ARCHIVE_DIR = getattr(settings, "ARCHIVE_DIR", "archive")
+KEEP_MONTHS = 2
+
+Month = namedtuple('Month', 'name tickers sources ids dt source price_units lotsize')
+
+
+def month_bounds(name: str):
+    year, month = map(int, name.split('-'))
+    end = date(year + month // 12, month % 12 + 1, 1)
+    return f'{name}-01', end.isoformat()
+
+
+def months_ago(months: int, today=None) -> str:
+    # начало месяца, который был months месяцев назад
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1 - months
+    return date(index // 12, index % 12 + 1, 1).isoformat()
+
+
+class Archive:
+    """Каталог с месяцами; month() открывает месяц через mmap."""
+    __slots__ = ['path']
+
+    def __init__(self, path=None):
+        self.path = path or ARCHIVE_DIR
+
+    def months(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path)
+                      if os.path.isfile(os.path.join(self.path, name, 'meta.json')))
+
+    def month(self, name, mmap_mode='r') -> Month:
+        path = os.path.join(self.path, name)
+        with open(os.path.join(path, 'meta.json')) as fp:
+            meta = json.load(fp)
+
+        def load(column):
+            return np.load(os.path.join(path, column + '.npy'), mmap_mode=mmap_mode)
+
+        return Month(name, meta['tickers'], meta['sources'], load('ids'), load('dt'),
+                     load('source'), load('price_units'), load('lotsize'))
+
+    def last_id(self) -> int:
+        # наибольший id снимка в архиве, 0 — архив пуст
+        return max((int(self.month(name).ids.max(initial=0)) for name in self.months()), default=0)
+
+    def rows(self, name):
+        # снимки месяца обратно строками (id, dt, source, ticker, price_units, lotsize)
+        month = self.month(name)
+        for i in range(len(month.ids)):
+            units = month.price_units[i]
+            for j in np.flatnonzero(units).tolist():
+                yield (int(month.ids[i]), str(month.dt[i]), month.sources[month.source[i]],
+                       month.tickers[j], int(units[j]), int(month.lotsize[i, j]))
+
+    def write(self, name, rows) -> int:
+        """
+        Записывает месяц из строк (id, dt, source, ticker, price_units, lotsize),
+        отсортированных по dt, id. Уже записанные снимки месяца сохраняются.
+        """
+        rows = list(rows)
+        if name in self.months():
+            ids = {row[0] for row in rows}
+            old = [row for row in self.rows(name) if row[0] not in ids]
+            rows = sorted(chain(old, rows), key=lambda row: (row[1], row[0]))
+        snapshots = [key for key, _ in groupby(rows, key=lambda row: row[:3])]
+        tickers = sorted({row[3] for row in rows})
+        sources = sorted({row[2] for row in rows})
+        column = {ticker: j for j, ticker in enumerate(tickers)}
+        source_index = {source: i for i, source in enumerate(sources)}
+
+        price_units = np.zeros((len(snapshots), len(tickers)), dtype=np.int64)
+        lotsize = np.zeros((len(snapshots), len(tickers)), dtype=np.int32)
+        i = -1
+        last = None
+        for row in rows:
+            if row[:3] != last:
+                last = row[:3]
+                i += 1
+            price_units[i, column[row[3]]] = row[4]
+            lotsize[i, column[row[3]]] = row[5]
+
+        # пишем во временный каталог и подменяем целиком
+        path = os.path.join(self.path, name)
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'ids.npy'), np.array([key[0] for key in snapshots], dtype=np.int64))
+        np.save(os.path.join(tmp, 'dt.npy'), np.array([str(key[1]) for key in snapshots]))
+        np.save(os.path.join(tmp, 'source.npy'),
+                np.array([source_index[key[2]] for key in snapshots], dtype=np.int16))
+        np.save(os.path.join(tmp, 'price_units.npy'), price_units)
+        np.save(os.path.join(tmp, 'lotsize.npy'), lotsize)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as fp:
+            json.dump({'tickers': tickers, 'sources': sources}, fp)
+        if os.path.isdir(path):
+            shutil.rmtree(path + '.old', ignore_errors=True)
+            os.rename(path, path + '.old')
+            os.rename(tmp, path)
+            shutil.rmtree(path + '.old')
+        else:
+            os.rename(tmp, path)
+        return len(snapshots)
+
+
+def archive_months(conn, archive: Archive, keep_months=KEEP_MONTHS, delete=True):
+    # месяцы старше keep_months — в архив; из SQLite удаляются после записи
+    cursor = conn.cursor()
+    total = 0
+    for name in db.fetch_snapshot_months(cursor, months_ago(keep_months - 1)):
+        start, end = month_bounds(name)
+        count = archive.write(name, db.iter_snapshot_ticks(cursor, start, end))
+        if delete:
+            db.delete_snapshots(cursor, start, end)
+            conn.commit()
+        print(name, 'snapshots', count)
+        total += count
+    return total
+
+
+def iter_rows(snapshots, tickers):
+    """
+    Общая часть timeline: из (dt, [(ticker, price_units, lotsize), ...])
+    делает (dt, prices, lotsizes), выровненные по tickers.
+    """
+    index = {ticker: i for i, ticker in enumerate(tickers)}
+    prices = np.full(len(tickers), np.nan)
+    lotsizes = np.ones(len(tickers))
+    for dt, rows in snapshots:
+        for ticker, units, lotsize in rows:
+            i = index[ticker]
+            prices[i] = units / PRICE_SCALE
+            lotsizes[i] = lotsize
+        yield dt, prices, lotsizes
+
+
+def iter_archive(archive: Archive, tickers):
+    wanted = set(tickers)
+    for name in archive.months():
+        month = archive.month(name)
+        columns = [j for j, ticker in enumerate(month.tickers) if ticker in wanted]
+        names = [month.tickers[j] for j in columns]
+        # выборка колонок списком (fancy indexing) — копия n x len(columns) на месяц;
+        # строки лежат подряд, так что с диска месяц всё равно читается целиком
+        price_units = month.price_units[:, columns]
+        lotsize = month.lotsize[:, columns]
+        for i in range(len(month.ids)):
+            present = np.flatnonzero(price_units[i]).tolist()
+            yield str(month.dt[i]), [(names[j], int(price_units[i, j]), int(lotsize[i, j]))
+                                     for j in present]
+
+
+def iter_sqlite(cursor, tickers, after_id=0):
+    ticks = db.iter_price_ticks(cursor, tickers, after_id)
+    for (_, dt), rows in groupby(ticks, key=lambda row: row[:2]):
+        yield str(dt), [row[2:] for row in rows]
+
+
+def timeline(cursor, tickers, archive: Archive = None):
+    """
+    Все снимки по порядку, сначала архив, потом SQLite: (dt, prices, lotsizes).
+    Снимки, которые уже есть в архиве, из SQLite не повторяются.
+
+    Массивы выровнены по tickers, акции без цены в снимке сохраняют
+    последнюю известную цену (NaN до первой). Массивы общие для всех шагов.
+    """
+    tickers = list(tickers)
+    archive = archive or Archive()
+    snapshots = chain(iter_archive(archive, tickers), iter_sqlite(cursor, tickers, archive.last_id()))
+    return iter_rows(snapshots, tickers)
+
+
+def info(archive: Archive):
+    for name in archive.months():
+        month = archive.month(name)
+        size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(archive.path, name)))
+        print(f'{name}: {len(month.ids)} snapshots, {len(month.tickers)} tickers, '
+              f'{size / 1024:.0f} KiB')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Monthly columnar archive of price snapshots')
+    parser.add_argument('command', choices=['compact', 'export', 'info'])
+    parser.add_argument('--keep-months', type=int, default=KEEP_MONTHS,
+                        help='months to keep in SQLite, the current one included')
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM SQLite after compaction')
+    parser.add_argument('--path', default=ARCHIVE_DIR)
+    args = parser.parse_args(argv)
+
+    archive = Archive(args.path)
+    if args.command == 'info':
+        info(archive)
+        return
+
+    conn = db.get_sqlite_connection()
+    count = archive_months(conn, archive, args.keep_months, delete=args.command == 'compact')
+    if args.vacuum and args.command == 'compact':
+        conn.execute('VACUUM')
+    conn.close()
+    print('archived snapshots', count, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+"""
+ASGI-режим: uvicorn asgi:app
+
+Flask-приложение запускается в пуле из ASGI_THREADS потоков (a2wsgi),
+поэтому быстрые htmx PATCH не ждут в очереди за медленными запросами.
+asgiref.wsgi.WsgiToAsgi для этого не подходит: он выполняет все запросы
+в одном потоке (thread_sensitive). Соединения с SQLite берутся
+из пула application.db_pool, по умолчанию потоков столько же, сколько соединений.
+"""
+from a2wsgi import WSGIMiddleware
+
+import settings
+from application import DATABASE_POOL_SIZE, app as wsgi_app
+
+ASGI_THREADS = getattr(settings, "ASGI_THREADS", DATABASE_POOL_SIZE)
+
+app = WSGIMiddleware(wsgi_app, workers=ASGI_THREADS)
@@ -0,0 +1,163 @@
+"""
+Бэктест наборов весов по сохранённым снимкам цен.
+
+    python3 backtest.py [--capital N] [--rebalance never|snapshot|day|week|month]
+                        [--workers N] [-o FILE] [WEIGHT_NAME ...]
+
+Снимки из архива и SQLite (archive.timeline) идут по порядку, цены в массивах numpy,
+выровненных по тикерам набора весов. На каждый снимок выдаётся точка:
+стоимость портфеля, оборот на ребалансировке и отклонение от весов
+(tracking error, как в solver.tracking_error). Наборы весов считаются
+параллельно в пуле процессов.
+"""
+import argparse
+import csv
+import sys
+from collections import namedtuple
+from datetime import date
+from multiprocessing import Pool
+
+import numpy as np
+
+import db
+from archive import timeline
+from main import PAIRS_DICT, weight_to_bp
+
+Point = namedtuple('Point', 'dt value cash turnover tracking_error')
+CSV_FIELDS = ['weight_name', *Point._fields]
+REBALANCE = ('never', 'snapshot', 'day', 'week', 'month')
+DEFAULT_CAPITAL = 1000 * 1000
+
+
+def period(dt: str, rebalance):
+    # при смене периода портфель ребалансируется
+    if rebalance == 'snapshot':
+        return dt
+    if rebalance == 'day':
+        return dt[:10]
+    if rebalance == 'week':
+        return date.fromisoformat(dt[:10]).isocalendar()[:2]
+    if rebalance == 'month':
+        return dt[:7]
+    return None
+
+
+def pair_groups(tickers):
+    index = {ticker: i for i, ticker in enumerate(tickers)}
+    return np.fromiter(
+        (min(index.get(_ticker, i) for _ticker in PAIRS_DICT.get(ticker, (ticker,)))
+         for i, ticker in enumerate(tickers)),
+        dtype=np.intp, count=len(tickers))
+
+
+def replay(snapshots, tickers, weights, capital=DEFAULT_CAPITAL, rebalance='month'):
+    """
+    Генератор точек Point по снимкам.
+
+    На первом снимке и при смене периода rebalance покупаем
+    round(weight / weights_sum * value / lotprice) лотов акций с известной
+    ценой (вниз, если не хватает денег), остаток лежит в cash.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    groups = pair_groups(tickers)
+    size = len(tickers)
+    lots = np.zeros(size)
+    cash = float(capital)
+    last_period = None
+    first = True
+    for dt, prices, lotsizes in snapshots:
+        known = ~np.isnan(prices)
+        lotprices = np.where(known, prices * lotsizes, 0)
+        value = cash + lots @ lotprices
+        target = np.where(known, weights, 0)
+        target_sum = target.sum()
+
+        turnover = 0.0
+        current = period(dt, rebalance)
+        if target_sum and (first or current != last_period):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                in_rur = target / target_sum * value
+                new_lots = np.nan_to_num(np.rint(in_rur / lotprices))
+                if new_lots @ lotprices > value:
+                    new_lots = np.nan_to_num(np.floor(in_rur / lotprices))
+            turnover = np.abs(new_lots - lots) @ lotprices / value if value else 0.0
+            cash = value - new_lots @ lotprices
+            lots = new_lots
+            last_period = current
+            first = False
+
+        if value and target_sum:
+            amounts = np.bincount(groups, weights=lots * lotprices, minlength=size)
+            targets = np.bincount(groups, weights=target, minlength=size) / target_sum
+            tracking_error = float(np.sqrt(((amounts / value - targets) ** 2).sum()))
+        else:
+            tracking_error = 0.0
+        yield Point(dt, float(value), float(cash), float(turnover), tracking_error)
+
+
+def run(cursor, weight_name, capital=DEFAULT_CAPITAL, rebalance='month'):
+    weights_map = db.fetch_weights(cursor, weight_name)
+    if weights_map is None:
+        raise KeyError(weight_name)
+    tickers = list(weights_map)
+    weights = [weight_to_bp(weights_map[ticker]) for ticker in tickers]
+    return replay(timeline(cursor, tickers), tickers, weights, capital, rebalance)
+
+
+def run_group(args):
+    # в дочернем процессе: своё соединение, точки целиком обратно
+    weight_name, capital, rebalance = args
+    conn = db.get_sqlite_connection()
+    try:
+        return weight_name, list(run(conn.cursor(), weight_name, capital, rebalance))
+    finally:
+        conn.close()
+
+
+def summary(weight_name, capital, points):
+    if not points:
+        return f'{weight_name}: no snapshots'
+    turnover = sum(point.turnover for point in points)
+    tracking_error = sum(point.tracking_error for point in points) / len(points)
+    return (f'{weight_name}: {points[0].dt} .. {points[-1].dt}, {len(points)} snapshots, '
+            f'value {points[-1].value:.2f} ({points[-1].value / capital - 1:+.2%}), '
+            f'turnover {turnover:.2f}, mean TE {tracking_error:.4%}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay weight sets over stored price snapshots')
+    parser.add_argument('names', nargs='*', help='weight sets, all by default')
+    parser.add_argument('--capital', type=int, default=DEFAULT_CAPITAL)
+    parser.add_argument('--rebalance', choices=REBALANCE, default='month')
+    parser.add_argument('--workers', type=int, default=0, help='process pool size')
+    parser.add_argument('-o', '--output', help='output CSV, stdout by default')
+    args = parser.parse_args(argv)
+
+    conn = db.get_sqlite_connection()
+    names = args.names or db.fetch_weights_names(conn.cursor())
+    fp = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.writer(fp)
+    writer.writerow(CSV_FIELDS)
+
+    tasks = [(name, args.capital, args.rebalance) for name in names]
+    if args.workers:
+        with Pool(args.workers) as pool:
+            results = pool.imap(run_group, tasks)
+            for name, points in results:
+                writer.writerows([name, *point] for point in points)
+                print(summary(name, args.capital, points), file=sys.stderr)
+    else:
+        for name, capital, rebalance in tasks:
+            points = []
+            for point in run(conn.cursor(), name, capital, rebalance):
+                writer.writerow([name, *point])
+                points.append(point)
+            print(summary(name, capital, points), file=sys.stderr)
+    conn.close()
+
+    if fp is not sys.stdout:
+        fp.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Планы и факты всех портфелей всех пользователей за один проход.
+
+    python3 batch.py [--format jsonl|csv] [--workers N] [--engine decimal|numpy]
+                    [--solver round|optimal] [--buy-next CASH] [-o FILE]
+
+Портфели (основные из users и остальные из portfolios) читаются курсором
+по (email, portfolio), позиции и флаги всех портфелей — двумя запросами
+в том же порядке и сливаются на ходу, поэтому в памяти держится один
+портфель и по одному WeightManager на набор весов.
+С --buy-next в jsonl добавляется, какие лоты докупить на CASH рублей.
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+from itertools import groupby
+from multiprocessing import Pool
+
+import db
+from main import UserBriefcase, WeightManager
+
+DEFAULT_WEIGHT_NAME = 'MOEX 2022'
+CSV_FIELDS = ['email', 'portfolio', 'weight_name', 'ticker',
+              'plan_count', 'plan_amount', 'fact_count', 'fact_amount', 'in_percent']
+PORTFOLIOS_SQL = ("SELECT * FROM ("
+                  "SELECT email, '' AS portfolio, capital, COALESCE(weight_name, ?) AS wn "
+                  "FROM users WHERE is_active "
+                  "UNION ALL SELECT p.email, p.name, p.capital, COALESCE(p.weight_name, ?) "
+                  "FROM portfolios p JOIN users u ON u.email = p.email WHERE u.is_active) ")
+ORDER_SQL = " ORDER BY email, portfolio"
+POSITIONS_SQL = ("SELECT p.email, p.portfolio, p.ticker, p.count FROM user_positions p "
+                 "JOIN users u ON u.email = p.email WHERE u.is_active ORDER BY p.email, p.portfolio")
+FLAGS_SQL = ("SELECT f.email, f.portfolio, f.flag, f.ticker FROM user_flags f "
+             "JOIN users u ON u.email = f.email WHERE u.is_active ORDER BY f.email, f.portfolio")
+
+
+def briefcase_class(engine):
+    if engine == 'numpy':
+        from vector import VectorBriefcase
+        return VectorBriefcase
+    return UserBriefcase
+
+
+def sorted_lookup(rows):
+    """
+    Строки (email, portfolio, ...) по возрастанию ключа -> get(key) со списком
+    остальных полей. Ключи get() тоже должны идти по возрастанию.
+    """
+    groups = groupby(rows, key=lambda row: (row[0], row[1]))
+    current = next(groups, None)
+
+    def get(key):
+        nonlocal current
+        while current is not None and current[0] < key:
+            current = next(groups, None)
+        if current is None or current[0] != key:
+            return []
+        result = [row[2:] for row in current[1]]
+        current = next(groups, None)
+        return result
+
+    return get
+
+
+def iter_users(cursor, weight_name=None):
+    defaults = (DEFAULT_WEIGHT_NAME, DEFAULT_WEIGHT_NAME)
+    if weight_name is None:
+        rows = cursor.execute(PORTFOLIOS_SQL + ORDER_SQL, defaults)
+    else:
+        rows = cursor.execute(PORTFOLIOS_SQL + "WHERE wn = ?" + ORDER_SQL, (*defaults, weight_name))
+    # сортировка BINARY в SQLite совпадает со сравнением строк в Python
+    positions = sorted_lookup(cursor.connection.execute(POSITIONS_SQL))
+    flags = sorted_lookup(cursor.connection.execute(FLAGS_SQL))
+    for email, portfolio, capital, weight_name in rows:
+        user_flags = {'favorite': set(), 'ignored': set()}
+        for flag, ticker in flags((email, portfolio)):
+            user_flags[flag].add(ticker)
+        yield weight_name, {
+            'email': email,
+            'portfolio': portfolio,
+            'shares': dict(positions((email, portfolio))),
+            'favorites': user_flags['favorite'],
+            'ignored': user_flags['ignored'],
+            'capital': capital,
+        }
+
+
+def user_result(ub_class, weight_manager, weight_name, user, solver='round', cash=None):
+    ub = ub_class(
+        weight_manager,
+        user['ignored'],
+        user['favorites'],
+        user['capital'],
+        user['shares'],
+        solver=solver,
+    )
+    positions = {}
+    for we in ub.all:
+        plan = ub.plans[we.ticker]
+        fact = ub.facts[we.ticker]
+        positions[we.ticker] = {
+            'plan_count': plan.count,
+            'plan_amount': f'{plan.amount:.2f}',
+            'fact_count': fact.count,
+            'fact_amount': f'{fact.amount:.2f}',
+            'in_percent': f'{ub.get_in_percent(we.ticker):.4f}',
+        }
+    result = {
+        'email': user['email'],
+        'portfolio': user['portfolio'],
+        'weight_name': weight_name,
+        'capital': f'{ub.capital:.2f}',
+        'plan_sum': f'{ub.all_rur:.2f}',
+        'fact_sum': f'{ub.user_amount_sum:.2f}',
+        'tracking_error': f'{ub.tracking_error:.6f}',
+        'positions': positions,
+    }
+    if cash is not None:
+        result['buy_next'] = [
+            {'ticker': p.ticker, 'lots': p.lots, 'count': p.count, 'amount': f'{p.amount:.2f}'}
+            for p in ub.buy_next(cash)]
+    return result
+
+
+def write_result(fp, fmt, result):
+    if fmt == 'jsonl':
+        fp.write(json.dumps(result, ensure_ascii=False))
+        fp.write('\n')
+    else:
+        writer = csv.writer(fp)
+        for ticker, position in result['positions'].items():
+            writer.writerow([result['email'], result['portfolio'], result['weight_name'], ticker]
+                            + [position[field] for field in CSV_FIELDS[4:]])
+
+
+def process(cursor, fp, fmt, engine, weight_name=None, solver='round', cash=None):
+    names = db.fetch_names(cursor)
+    prices = db.fetch_last_prices(cursor)
+    ub_class = briefcase_class(engine)
+    managers = {}  # weight_name -> WeightManager или None для неизвестных весов
+    count = 0
+    for weight_name, user in iter_users(cursor, weight_name):
+        if weight_name not in managers:
+            weights_map = db.fetch_weights(cursor.connection.cursor(), weight_name)
+            if weights_map is None:
+                print(f'unknown weights {weight_name!r}, skipped', file=sys.stderr)
+                managers[weight_name] = None
+            else:
+                managers[weight_name] = WeightManager(names, prices, weights_map)
+        weight_manager = managers[weight_name]
+        if weight_manager is None:
+            continue
+        write_result(fp, fmt, user_result(
+            ub_class, weight_manager, weight_name, user, solver, cash))
+        count += 1
+    return count
+
+
+def process_group(args):
+    # в дочернем процессе: своё соединение, результат во временный файл
+    weight_name, fmt, engine, solver, cash = args
+    conn = db.get_sqlite_connection()
+    with tempfile.NamedTemporaryFile('w', newline='', delete=False, suffix='.' + fmt) as fp:
+        count = process(conn.cursor(), fp, fmt, engine, weight_name, solver, cash)
+    conn.close()
+    return fp.name, count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plan vs fact for all portfolios of all users')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--engine', choices=['decimal', 'numpy'], default='decimal')
+    parser.add_argument('--solver', choices=['round', 'optimal'], default='round',
+                        help='round every ticker or fit lots to the weights as a whole')
+    parser.add_argument('--buy-next', type=int, metavar='CASH',
+                        help='lots to buy with CASH rubles, without selling (jsonl only)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='process pool size, groups of weight_name are spread over it')
+    parser.add_argument('-o', '--output', help='output file, stdout by default')
+    args = parser.parse_args(argv)
+
+    fp = open(args.output, 'w', newline='') if args.output else sys.stdout
+    if args.format == 'csv':
+        csv.writer(fp).writerow(CSV_FIELDS)
+
+    conn = db.get_sqlite_connection()
+    if args.workers:
+        weight_names = [row[0] for row in conn.execute(
+            "SELECT DISTINCT wn FROM (" + PORTFOLIOS_SQL + ")",
+            (DEFAULT_WEIGHT_NAME, DEFAULT_WEIGHT_NAME))]
+        count = 0
+        with Pool(args.workers) as pool:
+            tasks = [(name, args.format, args.engine, args.solver, args.buy_next)
+                     for name in weight_names]
+            for filename, group_count in pool.imap(process_group, tasks):
+                with open(filename) as part:
+                    shutil.copyfileobj(part, fp)
+                os.remove(filename)
+                count += group_count
+    else:
+        count = process(conn.cursor(), fp, args.format, args.engine,
+                        solver=args.solver, cash=args.buy_next)
+    conn.close()
+
+    if fp is not sys.stdout:
+        fp.close()
+    print(f'portfolios: {count}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""
+Бенчмарки горячих мест: python3 bench.py [--full] [--compare benchmarks/OLD.json]
+
+Данные синтетические: тикеры из weights.txt и securities-example.json,
+дополненные вымышленными до нужного размера. Результат (секунды на вызов)
+пишется в benchmarks/<commit>.json, чтобы сравнивать коммиты между собой.
+
+startup — импорт application и первый запрос в новом процессе,
+без прогрева (cold) и после application.warm_up (warm).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from io import StringIO
+
+from jinja2 import Environment, FileSystemLoader
+
+import batch
+import db
+from cache import fragments
+from main import PAIRS_DICT, UserBriefcase, WeightManager
+
+TICKER_SIZES = (50, 200, 500, 2000)
+SNAPSHOT_SIZES = (10, 100, 1000)
+USER_SIZES = (10, 1000, 10000)
+FULL_USER_SIZES = (10, 1000, 10000, 100000)
+STARTUP_SIZE = 200
+STARTUP_REPEAT = 3
+RESULTS_DIR = 'benchmarks'
+
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import application
+imported = time.perf_counter()
+if sys.argv[1] == 'warm':
+    application.warm_up()
+warmed = time.perf_counter()
+client = application.app.test_client()
+with client.session_transaction() as session:
+    session['email'] = 'user0@example.com'
+assert client.get('/').status_code == 200
+print(json.dumps({'import': imported - started, 'warm_up': warmed - imported,
+                  'first request': time.perf_counter() - warmed}))
+"""
+
+
+def load_universe():
+    # реальные тикеры: веса из weights.txt, цены и лоты из примера ISS
+    with open('weights.txt') as fp:
+        rows = [row.rstrip('\n').split('\t') for row in fp if row.strip()]
+    with open('securities-example.json', encoding='utf-8') as fp:
+        securities = json.load(fp)['securities']
+    columns = securities['columns']
+    names = {ticker: short_name for ticker, _, short_name in rows}
+    weights = {ticker: float(weight) for ticker, weight, _ in rows}
+    prices = {}
+    for row in securities['data']:
+        item = dict(zip(columns, row))
+        names.setdefault(item['SECID'], item['SHORTNAME'])
+        if item['PREVPRICE']:
+            prices[item['SECID']] = {'price': item['PREVPRICE'], 'lotsize': item['LOTSIZE']}
+    return names, weights, prices
+
+
+def make_fixture(size, seed=0):
+    rnd = random.Random(seed)
+    names, weights, prices = load_universe()
+    names = dict(list(names.items())[:size])
+    for i in range(len(names), size):
+        names[f'T{i:04d}'] = f'Synthetic {i}'
+    for ticker in names:
+        prices.setdefault(ticker, {'price': round(rnd.uniform(0.1, 5000), 2),
+                                   'lotsize': rnd.choice([1, 10, 100, 1000])})
+        weights.setdefault(ticker, round(rnd.uniform(0.05, 2), 2))
+    prices = {ticker: prices[ticker] for ticker in names}
+    weights = {ticker: weights[ticker] for ticker in names}
+    return names, prices, weights
+
+
+def make_user(names, rnd):
+    tickers = list(names)
+    return {
+        'ignored': rnd.sample(tickers, 3),
+        'favorites': rnd.sample(tickers, 3),
+        'capital': rnd.randint(100_000, 10_000_000),
+        'shares': {ticker: rnd.randint(0, 500) for ticker in rnd.sample(tickers, min(20, len(tickers)))},
+    }
+
+
+def measure(func):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def bench_portfolio(results):
+    env = Environment(loader=FileSystemLoader('templates'))
+    fragments.install(env)
+    templates = {name: env.get_template(name) for name in ('table.html', 'table-mobile.html')}
+    for size in TICKER_SIZES:
+        names, prices, weights = make_fixture(size)
+        user = make_user(names, random.Random(size))
+        wm = WeightManager(names, prices, weights)
+        fragments.clear()
+        ub = UserBriefcase(wm, user['ignored'], user['favorites'], user['capital'], user['shares'])
+        pair_tickers = [ticker for ticker in PAIRS_DICT if ticker in ub.plans]
+
+        def in_percent_pairs():
+            for ticker in pair_tickers:
+                ub.get_in_percent(ticker)
+
+        cases = {
+            'WeightManager.__init__': lambda: WeightManager(names, prices, weights),
+            'strategy_and_bought': lambda: list(wm.strategy_and_bought(set(user['ignored']), user['shares'])),
+            'UserBriefcase.__init__': lambda: UserBriefcase(
+                wm, user['ignored'], user['favorites'], user['capital'], user['shares']),
+            'get_in_percent[pairs]': in_percent_pairs,
+        }
+        for name, template in templates.items():
+            cases[f'render {name}'] = lambda template=template: template.render(
+                ub=ub, session={'email': 'bench@example.com'})
+
+        for name, func in cases.items():
+            results.setdefault(name, {})[size] = measure(func)
+            print(f'{name:<32} {size:>6} {results[name][size] * 1000:>10.3f} ms')
+
+
+def fill_db(conn, names, prices, weights, snapshots=1, users=0):
+    cursor = conn.cursor()
+    db.init_sqlite(cursor)
+    cursor.executemany("INSERT OR IGNORE INTO shares VALUES(?, ?)", names.items())
+    cursor.execute("INSERT OR REPLACE INTO weights VALUES(?, ?)", ('MOEX 2022', json.dumps(weights)))
+    dt = datetime(2022, 1, 1)
+    for i in range(snapshots):
+        db.insert_snapshot(cursor, dt + timedelta(minutes=10 * i), 'bench', prices)
+    rnd = random.Random(users)
+    for i in range(users):
+        email = f'user{i}@example.com'
+        user = make_user(names, rnd)
+        cursor.execute("INSERT INTO users (email, capital) VALUES(?, ?)", (email, user['capital']))
+        for ticker, count in user['shares'].items():
+            db.save_position(cursor, email, ticker, count)
+        for flag, tickers in (('favorite', user['favorites']), ('ignored', user['ignored'])):
+            for ticker in tickers:
+                db.save_flag(cursor, email, flag, ticker, True)
+    conn.commit()
+
+
+def bench_db(results, user_sizes):
+    names, prices, weights = make_fixture(50)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.sqlite'))
+        fill_db(conn, names, prices, weights)
+        done = 1
+        for size in SNAPSHOT_SIZES:
+            fill_db(conn, {}, prices, weights, snapshots=size - done)
+            done = size
+            results.setdefault('db.fetch_last_prices', {})[size] = measure(
+                lambda: db.fetch_last_prices(conn.cursor()))
+            print(f'{"db.fetch_last_prices":<32} {size:>6} '
+                  f'{results["db.fetch_last_prices"][size] * 1000:>10.3f} ms')
+        conn.close()
+
+    for size in user_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(os.path.join(tmp, 'bench.sqlite'))
+            fill_db(conn, names, prices, weights, users=size)
+            results.setdefault('batch users', {})[size] = timeit.timeit(
+                lambda: batch.process(conn.cursor(), StringIO(), 'jsonl', 'decimal'), number=1)
+            print(f'{"batch users":<32} {size:>6} {results["batch users"][size]:>10.3f} s')
+            conn.close()
+
+
+def bench_startup(results):
+    # каждый замер — новый процесс со своим settings.py на временную базу
+    names, prices, weights = make_fixture(STARTUP_SIZE)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.sqlite'))
+        fill_db(conn, names, prices, weights, users=1)
+        conn.close()
+        with open(os.path.join(tmp, 'settings.py'), 'w') as fp:
+            fp.write(f"SECRET_KEY = b'bench'\n"
+                     f"SQLITE_DB_NAME = {os.path.join(tmp, 'bench.sqlite')!r}\n"
+                     f"JINJA_CACHE_DIR = {tmp!r}\n")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([tmp, os.getcwd()]))
+        for mode in ('cold', 'warm'):
+            runs = [json.loads(subprocess.check_output(
+                        [sys.executable, '-c', STARTUP_SCRIPT, mode], env=env))
+                    for _ in range(STARTUP_REPEAT)]
+            for name in runs[0]:
+                if mode == 'cold' and name == 'warm_up':
+                    continue
+                key = f'startup {mode} {name}'
+                results.setdefault(key, {})[STARTUP_SIZE] = min(run[name] for run in runs)
+                print(f'{key:<32} {STARTUP_SIZE:>6} {results[key][STARTUP_SIZE] * 1000:>10.3f} ms')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, filename):
+    with open(filename) as fp:
+        old = json.load(fp)['results']
+    print(f'\ncompared with {filename} (new / old):')
+    for name, sizes in results.items():
+        for size, value in sizes.items():
+            before = old.get(name, {}).get(str(size))
+            if before:
+                print(f'{name:<32} {size:>6} {value / before:>8.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Portfolio hot path benchmarks')
+    parser.add_argument('--full', action='store_true', help='up to 100k users')
+    parser.add_argument('--compare', help='results JSON of another commit')
+    parser.add_argument('-o', '--output', help='results JSON, benchmarks/<commit>.json by default')
+    args = parser.parse_args()
+
+    results = {}
+    bench_portfolio(results)
+    bench_startup(results)
+    bench_db(results, FULL_USER_SIZES if args.full else USER_SIZES)
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as fp:
+        json.dump({
+            'commit': commit,
+            'date': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'results': results,
+        }, fp, indent=2)
+    print('saved', output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
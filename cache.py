@@ -0,0 +1,244 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import db
+from db import PriceMap, WeightMap
+from main import WeightManager
+
+
+class SnapshotCache:
+    """
+    Названия акций, последние цены и наборы весов процесса.
+
+    У каждого воркера gunicorn своя копия; версия — id последнего снимка цен
+    и счётчик generation из meta. invalidate() увеличивает счётчик в базе,
+    и остальные воркеры перечитывают данные на следующем запросе.
+    WeightManager строится один раз на (набор весов, версия).
+    """
+    version: Optional[tuple]
+    names: Dict[str, str]
+    prices: PriceMap
+    weights: Dict[str, WeightMap]
+    managers: Dict[str, WeightManager]
+    hits: int
+    misses: int
+    __slots__ = ['lock', 'version', 'names', 'prices', 'weights', 'managers', 'hits', 'misses']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.names = {}
+        self.prices = None
+        self.weights = {}
+        self.managers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self, cursor):
+        version = db.fetch_snapshot_version(cursor)
+        with self.lock:
+            if version == self.version:
+                self.hits += 1
+                return
+            self.misses += 1
+            self.names = db.fetch_names(cursor)
+            self.prices = db.fetch_last_prices(cursor)
+            self.weights = {}
+            self.managers = {}
+            self.version = version
+
+    def fetch_weights(self, cursor, name) -> WeightMap:
+        with self.lock:
+            version = self.version
+            result = self.weights.get(name)
+        if result is None:
+            result = db.fetch_weights(cursor, name)
+            if result is not None:
+                with self.lock:
+                    # пока читали базу, refresh мог сменить снимок
+                    if version == self.version:
+                        self.weights[name] = result
+        return result
+
+    def weight_manager(self, cursor, name) -> WeightManager:
+        # names и prices берутся вместе с версией: объект, собранный
+        # на старом снимке, в кеш нового снимка не попадает
+        with self.lock:
+            version = self.version
+            names = self.names
+            prices = self.prices
+            result = self.managers.get(name)
+        if result is None:
+            result = WeightManager(names, prices, self.fetch_weights(cursor, name))
+            with self.lock:
+                if version == self.version:
+                    # параллельный запрос мог успеть первым: один объект на версию
+                    result = self.managers.setdefault(name, result)
+        return result
+
+    def invalidate(self, conn):
+        db.bump_generation(conn.cursor())
+        conn.commit()
+        with self.lock:
+            self.version = None
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'managers': list(self.managers),
+            'briefcases': {'size': len(briefcases.items),
+                           'hits': briefcases.hits, 'misses': briefcases.misses},
+            'purchases': {'size': len(purchases.items),
+                          'hits': purchases.hits, 'misses': purchases.misses},
+            'fragments': {'size': len(fragments.items),
+                          'hits': fragments.hits, 'misses': fragments.misses},
+        }
+
+
+class BriefcaseCache:
+    """
+    Последний посчитанный UserBriefcase каждого пользователя (LRU).
+
+    take() забирает объект из кеша, только если он посчитан на том же
+    WeightManager и с тем же состоянием пользователя, что в базе;
+    после изменений объект возвращают через put().
+    """
+    __slots__ = ['lock', 'items', 'size', 'hits', 'misses']
+
+    def __init__(self, size=256):
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def state(user_data):
+        return frozenset(user_data['ignored']), frozenset(user_data['favorites']), user_data['capital']
+
+    def take(self, email, weight_manager, user_data):
+        with self.lock:
+            state, ub = self.items.pop(email, (None, None))
+        if (ub is not None and ub.weight_manager is weight_manager
+                and state == self.state(user_data) and ub.briefcase == user_data['shares']):
+            self.hits += 1
+            return ub
+        self.misses += 1
+        return None
+
+    def put(self, email, user_data, ub):
+        with self.lock:
+            self.items[email] = (self.state(user_data), ub)
+            self.items.move_to_end(email)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class PurchaseCache:
+    """
+    Ответы "что докупить" по пользователю (LRU).
+
+    Считается всегда на точную сумму; корзины по bucket рублей только
+    группируют ответы пользователя, чтобы их было легко ограничить.
+    Ответы живут, пока не изменились снимок цен, набор весов
+    или состояние пользователя.
+    """
+    __slots__ = ['lock', 'items', 'size', 'bucket', 'per_bucket', 'hits', 'misses']
+
+    def __init__(self, size=256, bucket=1000, per_bucket=8):
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.size = size
+        self.bucket = bucket
+        self.per_bucket = per_bucket
+        self.hits = 0
+        self.misses = 0
+
+    def cash_bucket(self, cash) -> int:
+        return int(cash) // self.bucket * self.bucket
+
+    @staticmethod
+    def state(version, user_data):
+        return (version, user_data.get('weight_name'), BriefcaseCache.state(user_data),
+                frozenset(user_data['shares'].items()))
+
+    def get(self, email, version, user_data, cash, compute):
+        # compute(cash) вызывается только при промахе, всегда с точной суммой
+        bucket = self.cash_bucket(cash)
+        state = self.state(version, user_data)
+        with self.lock:
+            cached_state, buckets = self.items.get(email, (None, None))
+            if cached_state != state:
+                buckets = {}
+                self.items[email] = (state, buckets)
+            self.items.move_to_end(email)
+            answers = buckets.setdefault(bucket, OrderedDict())
+            result = answers.get(cash)
+        if result is not None:
+            self.hits += 1
+            return cash, result
+        self.misses += 1
+        result = compute(cash)
+        with self.lock:
+            answers[cash] = result
+            while len(answers) > self.per_bucket:
+                answers.popitem(last=False)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return cash, result
+
+
+class FragmentCache:
+    """
+    Общие для всех пользователей ячейки строк таблицы: название, ссылка, цена.
+
+    Зависят только от снимка цен, поэтому хранятся по (версия снимка,
+    layout, тикер) и рендерятся макросами из _shared.html один раз на снимок.
+    install() делает cells доступной в шаблонах как shared_cells.
+    """
+    __slots__ = ['lock', 'version', 'items', 'env', 'hits', 'misses']
+
+    MACROS = {'desktop': 'desktop_cells', 'mobile': 'mobile_cells'}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.items = {}
+        self.env = None
+        self.hits = 0
+        self.misses = 0
+
+    def install(self, env):
+        self.env = env
+        env.globals['shared_cells'] = self.cells
+
+    def clear(self):
+        with self.lock:
+            self.items = {}
+
+    def cells(self, layout, we):
+        version = snapshot.version
+        key = (layout, we.ticker)
+        if version == self.version:
+            result = self.items.get(key)
+            if result is not None:
+                self.hits += 1
+                return result
+        self.misses += 1
+        macro = getattr(self.env.get_template('_shared.html').module, self.MACROS[layout])
+        result = macro(we)
+        with self.lock:
+            if version != self.version:
+                self.items = {}
+                self.version = version
+            self.items[key] = result
+        return result
+
+
+snapshot = SnapshotCache()
+briefcases = BriefcaseCache()
+purchases = PurchaseCache()
+fragments = FragmentCache()
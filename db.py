@@ -1,14 +1,46 @@
 import json
+import queue
 import sqlite3
-from typing import Mapping, Union, Dict
+import struct
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import groupby
+from typing import Dict, Iterable, List, Mapping, Tuple, Union
 
 import settings
+from metrics import timed
 
 Ticker = str
 PriceMap = Mapping[Ticker, Mapping[str, Union[float, int]]]
 # share.ticker: {'price': float(price), 'lotsize': share.lot}
 WeightMap = Mapping[Ticker, float]
 
+# источники цен по убыванию приоритета; остальные — после них
+PRICE_SOURCES = getattr(settings, "PRICE_SOURCES", ('manual', 'tinkoff', 'moex'))
+# через сколько часов цена источника считается устаревшей
+PRICE_MAX_AGE_HOURS = getattr(settings, "PRICE_MAX_AGE_HOURS", {'manual': 7 * 24})
+DEFAULT_MAX_AGE_HOURS = 72
+
+# цены хранятся целыми миллионными долями рубля: у MOEX до 6 знаков (DECIMALS)
+PRICE_DIGITS = 6
+PRICE_SCALE = 10 ** PRICE_DIGITS
+
+# основной портфель пользователя: капитал и веса в users, позиции с portfolio = ''
+MAIN_PORTFOLIO = ''
+
+
+def price_to_units(price) -> int:
+    return round(price * PRICE_SCALE)
+
+
+def units_to_price(units: int) -> float:
+    return units / PRICE_SCALE
+
+
+def units_to_decimal(units: int) -> Decimal:
+    return Decimal(units).scaleb(-PRICE_DIGITS)
+
 
 def sqlite_get_db_name():
     return getattr(settings, "SQLITE_DB_NAME", "moex.sqlite")
@@ -19,10 +51,88 @@ def get_sqlite_connection():
     return conn
 
 
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=67108864",
+)
+
+
+class ConnectionPool:
+    """
+    Ограниченный пул соединений SQLite в режиме WAL.
+
+    Соединения создаются по мере надобности, но не больше size;
+    acquire ждёт освободившееся соединение не дольше timeout секунд.
+    """
+    __slots__ = ['name', 'size', 'timeout', 'idle', 'created', 'lock']
+
+    def __init__(self, name, size=4, timeout=10):
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(self.name, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return self.connect()
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError(f'no free sqlite connection in {self.timeout}s')
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+
 def init_sqlite(cursor):
     cursor.execute("CREATE TABLE IF NOT EXISTS prices("
                    "dt PRIMARY KEY, source TEXT NOT NULL, price_map TEXT NOT NULL)")
 
+    cursor.execute("CREATE TABLE IF NOT EXISTS snapshots("
+                   "id INTEGER PRIMARY KEY, "
+                   "dt TIMESTAMP NOT NULL, source TEXT NOT NULL)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS snapshots_dt ON snapshots(dt)")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS price_ticks("
+                   "snapshot_id INTEGER NOT NULL REFERENCES snapshots(id), "
+                   "ticker TEXT NOT NULL, "
+                   "price_units INTEGER NOT NULL, lotsize INTEGER NOT NULL, "
+                   "PRIMARY KEY (snapshot_id, ticker)) WITHOUT ROWID")
+    cursor.execute("CREATE INDEX IF NOT EXISTS price_ticks_ticker ON price_ticks(ticker, snapshot_id)")
+
+    # последняя цена каждой акции от каждого источника
+    cursor.execute("CREATE TABLE IF NOT EXISTS source_prices("
+                   "ticker TEXT NOT NULL, source TEXT NOT NULL, "
+                   "snapshot_id INTEGER NOT NULL, dt TIMESTAMP NOT NULL, "
+                   "price_units INTEGER NOT NULL, lotsize INTEGER NOT NULL, "
+                   "PRIMARY KEY (ticker, source)) WITHOUT ROWID")
+    # выбранная по приоритету и свежести цена, пересчитывается на каждый снимок
+    cursor.execute("CREATE TABLE IF NOT EXISTS resolved_prices("
+                   "ticker TEXT PRIMARY KEY, "
+                   "price_units INTEGER NOT NULL, lotsize INTEGER NOT NULL, "
+                   "source TEXT NOT NULL, snapshot_id INTEGER NOT NULL, dt TIMESTAMP NOT NULL, "
+                   "stale INT NOT NULL DEFAULT 0) WITHOUT ROWID")
+
     cursor.execute("CREATE TABLE IF NOT EXISTS users("
                    "email TEXT PRIMARY KEY, "
                    "is_active INT DEFAULT 1, is_available INT DEFAULT 0, "
@@ -32,41 +142,455 @@ def init_sqlite(cursor):
                    "capital NUMERIC NOT NULL DEFAULT 1000000, "
                    "weight_name TEXT DEFAULT 'MOEX 2022')")
 
+    # остальные портфели пользователя; старые базы — migration_portfolios.py
+    cursor.execute("CREATE TABLE IF NOT EXISTS portfolios("
+                   "email TEXT NOT NULL REFERENCES users(email), "
+                   "name TEXT NOT NULL, "
+                   "capital NUMERIC NOT NULL DEFAULT 1000000, "
+                   "weight_name TEXT DEFAULT 'MOEX 2022', "
+                   "PRIMARY KEY (email, name)) WITHOUT ROWID")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS user_positions("
+                   "email TEXT NOT NULL REFERENCES users(email), "
+                   "portfolio TEXT NOT NULL DEFAULT '', "
+                   "ticker TEXT NOT NULL, "
+                   "count INTEGER NOT NULL DEFAULT 0, "
+                   "PRIMARY KEY (email, portfolio, ticker)) WITHOUT ROWID")
+    cursor.execute("CREATE INDEX IF NOT EXISTS user_positions_ticker ON user_positions(ticker)")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS user_flags("
+                   "email TEXT NOT NULL REFERENCES users(email), "
+                   "portfolio TEXT NOT NULL DEFAULT '', "
+                   "ticker TEXT NOT NULL, "
+                   "flag TEXT NOT NULL CHECK (flag IN ('favorite', 'ignored')), "
+                   "PRIMARY KEY (email, portfolio, flag, ticker)) WITHOUT ROWID")
+
     cursor.execute("CREATE TABLE IF NOT EXISTS shares("
                    "ticker TEXT PRIMARY KEY, "
                    "short_name TEXT NOT NULL)")
 
+    # кеш поиска акций в Тинькофф; figi NULL — тикер не найден.
+    # старые базы — migration_instruments.py
+    cursor.execute("CREATE TABLE IF NOT EXISTS instruments("
+                   "ticker TEXT PRIMARY KEY, "
+                   "figi TEXT, lot INTEGER, class_code TEXT NOT NULL, updated TEXT NOT NULL)")
+
     cursor.execute("CREATE TABLE IF NOT EXISTS weights("
                    "name TEXT PRIMARY KEY, "
                    "weights_json BLOB NOT NULL DEFAULT '{}')")
+    # проверенный набор весов из weightsets.py, читается без разбора JSON;
+    # старые базы — migration_compile_weights.py
+    cursor.execute("CREATE TABLE IF NOT EXISTS weights_compiled("
+                   "name TEXT PRIMARY KEY, "
+                   "digest TEXT NOT NULL, "
+                   "tickers TEXT NOT NULL, "
+                   "weights_bp BLOB NOT NULL)")
 
+    cursor.execute("CREATE TABLE IF NOT EXISTS meta("
+                   "key TEXT PRIMARY KEY, "
+                   "value NOT NULL)")
 
+    # токены API рядом с users.secret: храним только sha256 токена
+    cursor.execute("CREATE TABLE IF NOT EXISTS api_tokens("
+                   "token_hash TEXT PRIMARY KEY, "
+                   "email TEXT NOT NULL REFERENCES users(email), "
+                   "created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS api_tokens_email ON api_tokens(email)")
+
+
+@timed('db.fetch_names')
 def fetch_names(cursor) -> Dict[str, str]:
     result = cursor.execute("SELECT ticker, short_name FROM shares").fetchall()
     return {ticker: short_name for ticker, short_name in result}
 
 
+def insert_snapshot(cursor, dt, source: str, price_map: PriceMap) -> int:
+    cursor.execute("INSERT INTO snapshots (dt, source) VALUES(?, ?)", (dt, source))
+    snapshot_id = cursor.lastrowid
+    ticks = [(snapshot_id, ticker, price_to_units(attr['price']), attr['lotsize'])
+             for ticker, attr in price_map.items()]
+    cursor.executemany("INSERT INTO price_ticks VALUES(?, ?, ?, ?)", ticks)
+    cursor.executemany(
+        "INSERT INTO source_prices VALUES(?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(ticker, source) DO UPDATE SET snapshot_id = excluded.snapshot_id, "
+        "dt = excluded.dt, price_units = excluded.price_units, lotsize = excluded.lotsize "
+        "WHERE excluded.dt >= source_prices.dt",
+        [(ticker, source, snapshot_id, dt, units, lotsize) for _, ticker, units, lotsize in ticks])
+    resolve_prices(cursor)
+    return snapshot_id
+
+
+def parse_dt(dt) -> datetime:
+    return dt if isinstance(dt, datetime) else datetime.fromisoformat(str(dt))
+
+
+def source_rank(source) -> int:
+    return PRICE_SOURCES.index(source) if source in PRICE_SOURCES else len(PRICE_SOURCES)
+
+
+def resolve(candidates, now: datetime):
+    """
+    Из последних цен акции по источникам (source, snapshot_id, dt, ...)
+    выбирает свежую цену самого приоритетного источника, а если свежих нет —
+    самую новую. Возвращает (candidate, stale).
+    """
+    fresh = [
+        candidate for candidate in candidates
+        if now - parse_dt(candidate[2]) <= timedelta(
+            hours=PRICE_MAX_AGE_HOURS.get(candidate[0], DEFAULT_MAX_AGE_HOURS))]
+    if fresh:
+        return min(fresh, key=lambda candidate: (source_rank(candidate[0]), -candidate[1])), False
+    return max(candidates, key=lambda candidate: (parse_dt(candidate[2]), candidate[1])), True
+
+
+def resolve_prices(cursor):
+    # свежесть считается от самого нового снимка, а не от текущего времени
+    rows = cursor.execute(
+        "SELECT ticker, source, snapshot_id, dt, price_units, lotsize FROM source_prices "
+        "ORDER BY ticker").fetchall()
+    if not rows:
+        return
+    now = max(parse_dt(row[3]) for row in rows)
+    resolved = []
+    for ticker, group in groupby(rows, key=lambda row: row[0]):
+        (source, snapshot_id, dt, units, lotsize), stale = resolve([row[1:] for row in group], now)
+        resolved.append((ticker, units, lotsize, source, snapshot_id, dt, stale))
+    cursor.execute("DELETE FROM resolved_prices")
+    cursor.executemany("INSERT INTO resolved_prices VALUES(?, ?, ?, ?, ?, ?, ?)", resolved)
+
+
+def rebuild_source_prices(cursor):
+    # source_prices заново из всей истории price_ticks
+    cursor.execute("DELETE FROM source_prices")
+    cursor.execute(
+        "INSERT INTO source_prices "
+        "SELECT ticker, source, snapshot_id, dt, price_units, lotsize FROM ("
+        "  SELECT t.ticker, s.source, t.snapshot_id, s.dt, t.price_units, t.lotsize, "
+        "  row_number() OVER (PARTITION BY t.ticker, s.source ORDER BY s.dt DESC, s.id DESC) AS n "
+        "  FROM price_ticks AS t JOIN snapshots AS s ON s.id = t.snapshot_id"
+        ") WHERE n = 1")
+    resolve_prices(cursor)
+
+
+@timed('db.fetch_last_prices')
 def fetch_last_prices(cursor) -> PriceMap:
-    result = cursor.execute("SELECT price_map FROM prices ORDER BY dt DESC LIMIT 1").fetchone()
-    return json.loads(result[0]) if result else None
+    # цены уже выбраны resolve_prices при записи снимка
+    result = cursor.execute(
+        "SELECT ticker, price_units, lotsize, source, dt, stale FROM resolved_prices").fetchall()
+    return {ticker: {'price': units_to_price(units), 'lotsize': lotsize,
+                     'source': source, 'dt': dt, 'stale': bool(stale)}
+            for ticker, units, lotsize, source, dt, stale in result} if result else None
+
+
+@timed('db.fetch_last_prices_for')
+def fetch_last_prices_for(cursor, tickers: Iterable[Ticker]) -> PriceMap:
+    # последняя известная цена каждой акции, даже если её нет в последнем снимке
+    tickers = list(tickers)
+    result = cursor.execute(
+        "SELECT ticker, price_units, lotsize FROM price_ticks AS t "
+        "WHERE ticker IN (%s) AND snapshot_id = "
+        "(SELECT max(snapshot_id) FROM price_ticks WHERE ticker = t.ticker)"
+        % ', '.join('?' * len(tickers)), tickers).fetchall()
+    return {ticker: {'price': units_to_price(units), 'lotsize': lotsize}
+            for ticker, units, lotsize in result}
+
+
+@timed('db.fetch_price_history')
+def fetch_price_history(cursor, ticker: Ticker) -> List[Tuple[str, float, int]]:
+    result = cursor.execute(
+        "SELECT s.dt, t.price_units, t.lotsize FROM price_ticks AS t "
+        "JOIN snapshots AS s ON s.id = t.snapshot_id "
+        "WHERE t.ticker = ? ORDER BY t.snapshot_id", (ticker,)).fetchall()
+    return [(dt, units_to_price(units), lotsize) for dt, units, lotsize in result]
+
+
+def iter_price_ticks(cursor, tickers: Iterable[Ticker], after_id: int = 0):
+    # снимки с id > after_id по порядку, курсором: (snapshot_id, dt, ticker, price_units, lotsize)
+    tickers = list(tickers)
+    return cursor.execute(
+        "SELECT s.id, s.dt, t.ticker, t.price_units, t.lotsize FROM snapshots AS s "
+        "JOIN price_ticks AS t ON t.snapshot_id = s.id "
+        "WHERE s.id > ? AND t.ticker IN (%s) ORDER BY s.dt, s.id" % ', '.join('?' * len(tickers)),
+        [after_id] + tickers)
+
+
+@timed('db.fetch_snapshot_months')
+def fetch_snapshot_months(cursor, before: str) -> List[str]:
+    # месяцы ('YYYY-MM') снимков старше before, кроме последнего снимка
+    result = cursor.execute(
+        "SELECT DISTINCT substr(dt, 1, 7) FROM snapshots "
+        "WHERE dt < ? AND id < (SELECT max(id) FROM snapshots) ORDER BY 1", (before,)).fetchall()
+    return [row[0] for row in result]
+
+
+def iter_snapshot_ticks(cursor, start: str, end: str):
+    # (snapshot_id, dt, source, ticker, price_units, lotsize) снимков из [start, end)
+    return cursor.execute(
+        "SELECT s.id, s.dt, s.source, t.ticker, t.price_units, t.lotsize FROM snapshots AS s "
+        "JOIN price_ticks AS t ON t.snapshot_id = s.id "
+        "WHERE s.dt >= ? AND s.dt < ? AND s.id < (SELECT max(id) FROM snapshots) "
+        "ORDER BY s.dt, s.id", (start, end))
+
+
+def delete_snapshots(cursor, start: str, end: str) -> int:
+    # последний снимок не удаляется: по нему fetch_last_prices и версия кеша
+    condition = "dt >= ? AND dt < ? AND id < (SELECT max(id) FROM snapshots)"
+    cursor.execute(
+        "DELETE FROM price_ticks WHERE snapshot_id IN (SELECT id FROM snapshots WHERE %s)"
+        % condition, (start, end))
+    cursor.execute("DELETE FROM snapshots WHERE %s" % condition, (start, end))
+    return cursor.rowcount
+
+
+@timed('db.fetch_snapshot_version')
+def fetch_snapshot_version(cursor):
+    # (последний снимок цен, счётчик изменений весов и акций)
+    return cursor.execute(
+        "SELECT (SELECT max(id) FROM snapshots), "
+        "(SELECT value FROM meta WHERE key = 'generation')").fetchone()
+
 
+@timed('db.fetch_last_snapshot_id')
+def fetch_last_snapshot_id(cursor) -> int:
+    # id последнего снимка цен, 0 — снимков нет; общий для всех процессов
+    return cursor.execute("SELECT coalesce(max(id), 0) FROM snapshots").fetchone()[0]
 
+
+@timed('db.fetch_meta')
+def fetch_meta(cursor, key):
+    result = cursor.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return result[0] if result else None
+
+
+def save_meta(cursor, key, value):
+    cursor.execute("INSERT OR REPLACE INTO meta VALUES(?, ?)", (key, value))
+
+
+def bump_generation(cursor):
+    cursor.execute("INSERT INTO meta VALUES('generation', 1) "
+                   "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+
+
+def pack_weights(weights_bp: Mapping[Ticker, int]) -> Tuple[str, bytes]:
+    # тикеры по возрастанию через '\n' и веса uint32 little-endian в том же порядке
+    tickers = sorted(weights_bp)
+    return '\n'.join(tickers), struct.pack(f'<{len(tickers)}I', *map(weights_bp.__getitem__, tickers))
+
+
+def unpack_weights(tickers: str, packed: bytes) -> WeightMap:
+    tickers = tickers.split('\n')
+    return {ticker: bp / 100 for ticker, bp in zip(tickers, struct.unpack(f'<{len(tickers)}I', packed))}
+
+
+@timed('db.fetch_weights')
 def fetch_weights(cursor, name) -> WeightMap:
-    result = cursor.execute("SELECT weights_json FROM weights WHERE name = ?", (name,)).fetchone()
-    return json.loads(result[0]) if result else None
+    # скомпилированный набор; JSON — для наборов, сохранённых до weightsets.py
+    result = cursor.execute(
+        "SELECT c.tickers, c.weights_bp, w.weights_json FROM weights w "
+        "LEFT JOIN weights_compiled c ON c.name = w.name WHERE w.name = ?", (name,)).fetchone()
+    if result is None:
+        return None
+    if result[0] is not None:
+        return unpack_weights(result[0], result[1])
+    return json.loads(result[2])
+
+
+@timed('db.fetch_weights_digest')
+def fetch_weights_digest(cursor, name):
+    result = cursor.execute("SELECT digest FROM weights_compiled WHERE name = ?", (name,)).fetchone()
+    return result[0] if result else None
+
+
+def save_weights(cursor, name, weights_bp: Mapping[Ticker, int], digest):
+    # weights_json остаётся для формы редактирования и старых читателей
+    tickers, packed = pack_weights(weights_bp)
+    weights_json = json.dumps({ticker: weights_bp[ticker] / 100 for ticker in sorted(weights_bp)})
+    cursor.execute("INSERT INTO weights VALUES(?, ?) "
+                   "ON CONFLICT(name) DO UPDATE SET weights_json = excluded.weights_json",
+                   (name, weights_json))
+    cursor.execute("INSERT OR REPLACE INTO weights_compiled VALUES(?, ?, ?, ?)",
+                   (name, digest, tickers, packed))
 
 
+@timed('db.fetch_weights_names')
 def fetch_weights_names(cursor):
     result = cursor.execute("SELECT name FROM weights").fetchall()
     return [row[0] for row in result] if result else None
 
 
-def add_new_tickers(cursor, tickers):
-    db_tickers = set(fetch_names(cursor).keys())
-    new_tickers = tickers - db_tickers
-    data = []
-    for ticker in new_tickers:
-        data.append((ticker, ticker))
+@timed('db.fetch_positions')
+def fetch_positions(cursor, email, portfolio=MAIN_PORTFOLIO) -> Dict[Ticker, int]:
+    result = cursor.execute(
+        "SELECT ticker, count FROM user_positions WHERE email = ? AND portfolio = ?",
+        (email, portfolio)).fetchall()
+    return dict(result)
+
+
+def save_position(cursor, email, ticker, count, portfolio=MAIN_PORTFOLIO):
+    cursor.execute("INSERT INTO user_positions (email, portfolio, ticker, count) VALUES(?, ?, ?, ?) "
+                   "ON CONFLICT(email, portfolio, ticker) DO UPDATE SET count = excluded.count",
+                   (email, portfolio, ticker, count))
+
+
+@timed('db.fetch_flags')
+def fetch_flags(cursor, email, portfolio=MAIN_PORTFOLIO) -> Dict[str, set]:
+    result = {'favorite': set(), 'ignored': set()}
+    for ticker, flag in cursor.execute(
+            "SELECT ticker, flag FROM user_flags WHERE email = ? AND portfolio = ?",
+            (email, portfolio)):
+        result[flag].add(ticker)
+    return result
+
+
+def save_flag(cursor, email, flag, ticker, value: bool, portfolio=MAIN_PORTFOLIO):
+    if value:
+        cursor.execute("INSERT OR IGNORE INTO user_flags (email, portfolio, ticker, flag) "
+                       "VALUES(?, ?, ?, ?)", (email, portfolio, ticker, flag))
+    else:
+        cursor.execute("DELETE FROM user_flags "
+                       "WHERE email = ? AND portfolio = ? AND flag = ? AND ticker = ?",
+                       (email, portfolio, flag, ticker))
+
+
+@timed('db.fetch_holdings')
+def fetch_holdings(cursor, email, portfolio=MAIN_PORTFOLIO) -> Tuple[Dict[Ticker, int], Dict[str, set]]:
+    # позиции и флаги одним запросом
+    positions = {}
+    flags = {'favorite': set(), 'ignored': set()}
+    for ticker, count, flag in cursor.execute(
+            "SELECT ticker, count, NULL FROM user_positions WHERE email = ? AND portfolio = ? "
+            "UNION ALL SELECT ticker, NULL, flag FROM user_flags WHERE email = ? AND portfolio = ?",
+            (email, portfolio, email, portfolio)):
+        if flag is None:
+            positions[ticker] = count
+        else:
+            flags[flag].add(ticker)
+    return positions, flags
+
+
+@timed('db.fetch_all_positions')
+def fetch_all_positions(cursor, email) -> Dict[str, Dict[Ticker, int]]:
+    # позиции всех портфелей пользователя: портфель -> {ticker: count}
+    result = {}
+    for portfolio, ticker, count in cursor.execute(
+            "SELECT portfolio, ticker, count FROM user_positions WHERE email = ? AND count != 0",
+            (email,)):
+        result.setdefault(portfolio, {})[ticker] = count
+    return result
+
+
+@timed('db.fetch_portfolios')
+def fetch_portfolios(cursor, email) -> Dict[str, Tuple[int, str]]:
+    # портфель -> (capital, weight_name); основной ('') первым
+    result = cursor.execute(
+        "SELECT ? AS name, capital, weight_name FROM users WHERE email = ? "
+        "UNION ALL SELECT name, capital, weight_name FROM portfolios WHERE email = ? "
+        "ORDER BY name", (MAIN_PORTFOLIO, email, email)).fetchall()
+    return {name: (capital, weight_name) for name, capital, weight_name in result}
+
+
+@timed('db.fetch_portfolio')
+def fetch_portfolio(cursor, email, name) -> Tuple[int, str]:
+    result = cursor.execute(
+        "SELECT capital, weight_name FROM portfolios WHERE email = ? AND name = ?",
+        (email, name)).fetchone()
+    return tuple(result) if result else None
+
+
+def save_portfolio(cursor, email, name, **data):
+    # новый портфель или изменение capital/weight_name существующего
+    cursor.execute("INSERT OR IGNORE INTO portfolios (email, name) VALUES(?, ?)", (email, name))
     if data:
-        print('created tickers', new_tickers)
-        cursor.executemany("INSERT INTO shares VALUES(?, ?)", data)
+        keys = ', '.join(f"{k} = ?" for k in data.keys())
+        cursor.execute(f"UPDATE portfolios SET {keys} WHERE email = ? AND name = ?",
+                       [*data.values(), email, name])
+
+
+def delete_portfolio(cursor, email, name):
+    # вместе с позициями и флагами; основной портфель не удаляется
+    for table in ('user_positions', 'user_flags'):
+        cursor.execute(f"DELETE FROM {table} WHERE email = ? AND portfolio = ?", (email, name))
+    cursor.execute("DELETE FROM portfolios WHERE email = ? AND name = ?", (email, name))
+
+
+class QueryCounter:
+    """Считает SQL-запросы соединения через set_trace_callback."""
+    __slots__ = ['count', 'statements', 'keep']
+
+    def __init__(self, keep=False):
+        self.count = 0
+        self.statements = []
+        self.keep = keep
+
+    def __call__(self, statement):
+        self.count += 1
+        if self.keep:
+            self.statements.append(statement)
+
+    def attach(self, conn):
+        conn.set_trace_callback(self)
+        return self
+
+    @staticmethod
+    def detach(conn):
+        conn.set_trace_callback(None)
+
+
+def save_api_token(cursor, email, token_hash):
+    cursor.execute("INSERT INTO api_tokens (token_hash, email) VALUES(?, ?)", (token_hash, email))
+
+
+def delete_api_tokens(cursor, email):
+    cursor.execute("DELETE FROM api_tokens WHERE email = ?", (email,))
+
+
+@timed('db.fetch_api_token_email')
+def fetch_api_token_email(cursor, token_hash):
+    result = cursor.execute(
+        "SELECT email FROM api_tokens WHERE token_hash = ?", (token_hash,)).fetchone()
+    return result[0] if result else None
+
+
+@timed('db.fetch_existing_emails')
+def fetch_existing_emails(cursor, emails: Iterable[str]) -> set:
+    emails = list(emails)
+    result = cursor.execute(
+        "SELECT email FROM users WHERE email IN (%s)" % ', '.join('?' * len(emails)), emails)
+    return {row[0] for row in result}
+
+
+@timed('db.fetch_total_positions')
+def fetch_total_positions(cursor) -> Dict[Ticker, int]:
+    # сколько акций каждого тикера у всех пользователей вместе
+    result = cursor.execute(
+        "SELECT ticker, sum(count) FROM user_positions GROUP BY ticker HAVING sum(count) > 0")
+    return dict(result.fetchall())
+
+
+@timed('db.fetch_instruments')
+def fetch_instruments(cursor, class_code, since: datetime) -> Dict[Ticker, Tuple[str, int]]:
+    # записи не старше since; (None, None) — тикер искали и не нашли
+    result = cursor.execute(
+        "SELECT ticker, figi, lot FROM instruments WHERE class_code = ? AND updated >= ?",
+        (class_code, since.isoformat())).fetchall()
+    return {ticker: (figi, lot) for ticker, figi, lot in result}
+
+
+def save_instruments(cursor, class_code, instruments: Iterable[Tuple[Ticker, str, int]], updated: datetime):
+    cursor.executemany(
+        "INSERT OR REPLACE INTO instruments VALUES(?, ?, ?, ?, ?)",
+        [(ticker, figi, lot, class_code, updated.isoformat()) for ticker, figi, lot in instruments])
+
+
+@timed('db.fetch_known_tickers')
+def fetch_known_tickers(cursor, tickers: Iterable[Ticker]) -> set:
+    # только запрошенные тикеры, без чтения всей shares
+    tickers = list(tickers)
+    result = cursor.execute(
+        "SELECT ticker FROM shares WHERE ticker IN (%s)" % ', '.join('?' * len(tickers)), tickers)
+    return {row[0] for row in result}
+
+
+def add_new_tickers(cursor, names: Mapping[Ticker, str]):
+    # названия уже известных акций не меняются
+    cursor.executemany("INSERT OR IGNORE INTO shares VALUES(?, ?)", names.items())
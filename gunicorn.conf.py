@@ -0,0 +1,28 @@
+"""
+Настройки gunicorn: gunicorn -c gunicorn.conf.py application:app
+
+Приложение загружается в мастере (preload_app), when_ready прогревает
+общий кэш до fork, а gc.freeze убирает прогретые объекты из обхода
+сборщика мусора: иначе первая же сборка в воркере трогает их заголовки
+и копирует страницы памяти (copy-on-write).
+"""
+import gc
+
+bind = '0.0.0.0:8456'
+workers = 1
+preload_app = True
+
+
+def when_ready(server):
+    # мастер, до запуска воркеров
+    import application
+    application.warm_up()
+    gc.collect()
+    gc.freeze()
+    server.log.info('warm cache: snapshot %s, weights %s',
+                    application.snapshot.version, list(application.snapshot.managers))
+
+
+def post_fork(server, worker):
+    import application
+    application.start_refresher()
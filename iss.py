@@ -0,0 +1,187 @@
+"""
+Цены и названия акций с доски TQBR из MOEX ISS.
+
+    python3 iss.py                          # скачать с iss.moex.com
+    python3 iss.py securities-example.json  # взять из файла
+
+Ответ ISS разбирается потоково: из блоков securities и marketdata
+читаются по одной строке data, весь документ в память не загружается.
+Если dataversion.seqnum не изменился с прошлой загрузки, снимок не пишется.
+"""
+import io
+import json
+import sys
+import urllib.request
+from datetime import datetime
+
+import db
+
+ISS_URL = 'https://iss.moex.com/iss/engines/stock/markets/shares/boards/TQBR/securities.json'
+ISS_PARAMS = ('iss.meta=off&iss.only=securities,marketdata,dataversion'
+              '&securities.columns=SECID,SHORTNAME,LOTSIZE,PREVPRICE'
+              '&marketdata.columns=SECID,LAST')
+SOURCE = 'moex'
+SEQNUM_KEY = 'iss_seqnum'
+CHUNK_SIZE = 64 * 1024
+
+
+class BlockReader:
+    """
+    Потоковый разбор ответа ISS вида
+    {"block": {"metadata": ..., "columns": [...], "data": [[...], ...]}, ...}
+
+    rows() выдаёт (block, columns, row) по одной строке.
+    """
+    __slots__ = ['fp', 'buf', 'pos', 'decoder', 'chunk_size']
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.buf = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+        self.chunk_size = chunk_size
+
+    def read_more(self) -> bool:
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                raise ValueError('unexpected end of ISS document')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'expected {char!r} at {self.buf[self.pos:self.pos + 20]!r}')
+        self.pos += 1
+
+    def skip(self, char) -> bool:
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                result, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # значение ещё не дочитано
+                if not self.read_more():
+                    raise
+                continue
+            if end == len(self.buf) and self.read_more():
+                # число могло оборваться на границе куска
+                continue
+            self.pos = end
+            return result
+
+    def rows(self):
+        self.expect('{')
+        while not self.skip('}'):
+            block = self.value()
+            self.expect(':')
+            self.expect('{')
+            columns = None
+            while not self.skip('}'):
+                key = self.value()
+                self.expect(':')
+                if key == 'columns':
+                    columns = self.value()
+                elif key == 'data':
+                    if columns is None:
+                        raise ValueError(f'{block}: data before columns')
+                    self.expect('[')
+                    while not self.skip(']'):
+                        yield block, columns, self.value()
+                        self.skip(',')
+                else:
+                    self.value()
+                self.skip(',')
+            self.skip(',')
+
+
+def parse(fp, chunk_size=CHUNK_SIZE):
+    """Возвращает (seqnum, {ticker: shortname}, price_map)."""
+    names = {}
+    securities = {}
+    last = {}
+    seqnum = None
+    for block, columns, row in BlockReader(fp, chunk_size).rows():
+        item = dict(zip(columns, row))
+        if block == 'securities':
+            names[item['SECID']] = item['SHORTNAME']
+            securities[item['SECID']] = (item['PREVPRICE'], item['LOTSIZE'])
+        elif block == 'marketdata':
+            last[item['SECID']] = item['LAST']
+        elif block == 'dataversion':
+            seqnum = item['seqnum']
+
+    price_map = {}
+    for ticker, (prevprice, lotsize) in securities.items():
+        price = last.get(ticker) or prevprice
+        if price and lotsize:
+            price_map[ticker] = {'price': float(price), 'lotsize': lotsize}
+    return seqnum, names, price_map
+
+
+def fetch_seqnum(url=ISS_URL):
+    with urllib.request.urlopen(f'{url}?iss.meta=off&iss.only=dataversion') as response:
+        data = json.load(response)
+    return dict(zip(data['dataversion']['columns'], data['dataversion']['data'][0]))['seqnum']
+
+
+def ingest(conn, fp, chunk_size=CHUNK_SIZE) -> bool:
+    cursor = conn.cursor()
+    seqnum, names, price_map = parse(fp, chunk_size)
+    if seqnum is not None and seqnum == db.fetch_meta(cursor, SEQNUM_KEY):
+        print('ISS data not changed', seqnum)
+        return False
+
+    # названия-заглушки (ticker = short_name) заменяем на SHORTNAME из ISS
+    cursor.executemany(
+        "INSERT INTO shares VALUES(?, ?) "
+        "ON CONFLICT(ticker) DO UPDATE SET short_name = excluded.short_name "
+        "WHERE short_name = ticker",
+        names.items())
+    db.insert_snapshot(cursor, datetime.utcnow(), SOURCE, price_map)
+    if seqnum is not None:
+        db.save_meta(cursor, SEQNUM_KEY, seqnum)
+    conn.commit()
+    print('ISS snapshot saved', seqnum, len(price_map))
+    return True
+
+
+def update(conn, url=ISS_URL) -> bool:
+    # сначала спрашиваем только dataversion, весь ответ качаем при изменениях
+    if fetch_seqnum(url) == db.fetch_meta(conn.cursor(), SEQNUM_KEY):
+        print('ISS data not changed')
+        return False
+    with urllib.request.urlopen(f'{url}?{ISS_PARAMS}') as response:
+        encoding = response.headers.get_content_charset() or 'utf-8'
+        fp = io.TextIOWrapper(response, encoding=encoding)
+        return ingest(conn, fp)
+
+
+def main(argv):
+    conn = db.get_sqlite_connection()
+    db.init_sqlite(conn.cursor())
+    if argv:
+        with open(argv[0], encoding='utf-8') as fp:
+            ingest(conn, fp)
+    else:
+        update(conn)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,66 @@
+"""
+Нагрузочный тест запущенного сервера.
+
+    python3 loadtest.py http://127.0.0.1:8456 --cookie 'session=...' -c 16 -n 2000
+
+Смесь запросов как у страницы таблицы: GET / и htmx PATCH (toggle_fav,
+количество акций). Печатает запросы в секунду и перцентили задержки,
+чтобы сравнить `make start` и `make start-asgi`.
+"""
+import argparse
+import random
+import statistics
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+TICKERS = ['SBER', 'LKOH', 'GAZP', 'GMKN', 'NVTK']
+
+
+def make_request(base_url, cookie):
+    kind = random.random()
+    headers = {'Cookie': cookie, 'Hx-Request': 'true'}
+    if kind < 0.4:
+        return urllib.request.Request(base_url + '/', headers=headers)
+    ticker = random.choice(TICKERS)
+    if kind < 0.6:
+        data = {'toggle_fav': ticker}
+    else:
+        data = {ticker: str(random.randint(0, 100))}
+    headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    return urllib.request.Request(
+        base_url + '/', data=urllib.parse.urlencode(data).encode(),
+        headers=headers, method='PATCH')
+
+
+def timed(base_url, cookie):
+    started = time.perf_counter()
+    with urllib.request.urlopen(make_request(base_url, cookie)) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for the MOEX table')
+    parser.add_argument('url')
+    parser.add_argument('--cookie', default='', help='session cookie of a logged in user')
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('-n', '--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip('/')
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = sorted(pool.map(lambda _: timed(base_url, args.cookie), range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f'requests: {len(latencies)}, concurrency: {args.concurrency}')
+    print(f'throughput: {len(latencies) / elapsed:.1f} req/s')
+    print(f'latency p50: {quantiles[49] * 1000:.1f} ms, p95: {quantiles[94] * 1000:.1f} ms, '
+          f'p99: {quantiles[98] * 1000:.1f} ms, max: {latencies[-1] * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,19 @@
-import json
-import sys
 from collections import namedtuple
 from dataclasses import dataclass
 from datetime import datetime
 from decimal import Decimal
 from typing import Mapping, Sequence
 
-from db import Ticker, PriceMap, WeightMap, fetch_weights
+import solver
+from metrics import timed
+from db import (Ticker, PriceMap, WeightMap, insert_snapshot, price_to_units,
+                units_to_decimal)
 
 Plan = namedtuple('Plan', 'count amount')
 Fact = namedtuple('Fact', 'count amount')
+Purchase = namedtuple('Purchase', 'ticker lots count amount')
+Holding = namedtuple('Holding', 'ticker shortname price count amount counts')
+PortfolioTotal = namedtuple('PortfolioTotal', 'name weight_name capital amount')
 
 PAIRS = (
     ('SBER', 'SBERP'),
@@ -28,18 +32,45 @@ class WeightFull:
     lotsize: int
 
 
+def weight_to_bp(weight) -> int:
+    # вес в процентах -> целые сотые доли процента (базисные пункты)
+    return round(Decimal(str(weight)) * 100)
+
+
+def div_round(a: int, b: int) -> int:
+    # round(a / b) в целых числах, с тем же банковским округлением
+    if b < 0:
+        a, b = -a, -b
+    quotient, remainder = divmod(a, b)
+    twice = 2 * remainder
+    if twice > b or (twice == b and quotient % 2):
+        quotient += 1
+    return quotient
+
+
 class Weight:
+    """
+    Акция стратегии в целых числах: вес в базисных пунктах,
+    цена в 1/PRICE_SCALE долях рубля. Расчёт плана идёт по ним,
+    а точные Decimal price/lotprice посчитаны заранее для сумм и вывода.
+    """
     ticker: str
-    weight: Decimal
+    weight_bp: int
     shortname: str
-    __slots__ = ['ticker', 'weight', 'shortname', 'price', 'lotsize']
+    price_units: int
+    lotsize: int
+    price: Decimal
+    lotprice: Decimal
+    source: str  # откуда цена: moex, tinkoff, manual
+    stale: bool  # свежих цен нет ни у одного источника
+    __slots__ = ['ticker', 'weight_bp', 'shortname', 'price_units', 'lotsize', 'price', 'lotprice',
+                 'source', 'stale']
 
     def __init__(self, ticker, weight, shortname):
         self.ticker = ticker
-        self.weight = Decimal(weight)
+        self.weight_bp = weight_to_bp(weight)
         self.shortname = shortname
-        self.price = 1
-        self.lotsize = 1
+        self.set_price(1, 1)
 
     def __str__(self):
         return f'{self.ticker}'
@@ -47,22 +78,39 @@ class Weight:
     def __repr__(self):
         return f'{self.ticker} -> {self.weight}'
 
-    def set_price(self, price, lotsize: int):
-        self.price = Decimal(price)
+    def set_price(self, price, lotsize: int, source=None, stale=False):
+        self.price_units = price_to_units(price)
         self.lotsize = lotsize
+        self.price = units_to_decimal(self.price_units)
+        self.lotprice = self.price * lotsize
+        self.source = source
+        self.stale = stale
 
     @property
-    def lotprice(self):
-        return self.price * self.lotsize
+    def weight(self) -> Decimal:
+        return Decimal(self.weight_bp).scaleb(-2)
+
+    @property
+    def lotprice_units(self) -> int:
+        return self.price_units * self.lotsize
 
 
 class WeightManager:
+    """
+    Веса стратегии с ценами из одного снимка.
+
+    Зависит только от (набор весов, снимок цен), поэтому один объект
+    разделяется между всеми пользователями и не должен меняться после создания.
+    """
     names: Mapping[Ticker, str]
     prices: PriceMap
     weights_map: WeightMap
     weights: Mapping[Ticker, Weight]
-    __slots__ = ['names', 'prices', 'weights_map', 'weights']
+    others: Mapping[Ticker, Weight]  # акции вне стратегии, которые можно купить
+    order: Mapping[Ticker, int]
+    __slots__ = ['names', 'prices', 'weights_map', 'weights', 'others', 'order']
 
+    @timed('main.WeightManager')
     def __init__(self, names, prices: PriceMap, weights_map: WeightMap):
         self.names = names
         self.prices = prices
@@ -70,6 +118,15 @@ class WeightManager:
         self.weights = {ticker: Weight(ticker, weights_map[ticker], shortname)
                         for ticker, shortname in names.items() if ticker in weights_map}
         self.set_prices(prices)
+        self.order = {ticker: i for i, ticker in enumerate(names)}
+        self.others = {}
+        for ticker, shortname in names.items():
+            if ticker in self.weights or ticker not in prices:
+                continue
+            attr = prices[ticker]
+            weight = Weight(ticker, 0, shortname)
+            weight.set_price(attr['price'], attr['lotsize'], attr.get('source'), attr.get('stale', False))
+            self.others[ticker] = weight
 
     def values(self):
         return self.weights.values()
@@ -82,62 +139,62 @@ class WeightManager:
                 continue
             yield weight
 
-        for ticker, shortname in self.names.items():
-            if ticker in self.weights:
-                continue
-            if (briefcase.get(ticker, 0) <= 0) or (ticker in ignored):
-                continue
-
-            attr = self.prices[ticker]
-            weight = Weight(ticker, 0, shortname)
-            weight.set_price(attr['price'], attr['lotsize'])
-            yield weight
+        bought = [ticker for ticker, count in briefcase.items()
+                  if count > 0 and ticker in self.others and ticker not in ignored]
+        for ticker in sorted(bought, key=self.order.__getitem__):
+            yield self.others[ticker]
 
     @staticmethod
     def save_to_sqlite(conn, source: str, price_map: PriceMap):
-        data = (datetime.utcnow(), source, json.dumps(price_map))
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO prices VALUES(?, ?, ?)", data)
+        insert_snapshot(conn.cursor(), datetime.utcnow(), source, price_map)
         conn.commit()
 
     def set_prices(self, price_map: PriceMap):
         for ticker, attr in price_map.items():
             if ticker in self.weights:
-                self.weights[ticker].set_price(attr['price'], attr['lotsize'])
+                self.weights[ticker].set_price(
+                    attr['price'], attr['lotsize'], attr.get('source'), attr.get('stale', False))
 
 
 class UserBriefcase:
     capital: Decimal
+    capital_units: int
     briefcase: Mapping
     ignored: set
     favorites: set
     weights: WeightManager
 
     all_rur: Decimal  # Сколько плановый портфель весит в рублях. Примерно равно capital
-    weights_sum: Decimal
+    weights_sum: int  # в базисных пунктах
 
     plans: dict
     facts: dict
     user_amount_sum: Decimal
-    __slots__ = ['weight_manager', 'capital', 'briefcase',
+    solver: str  # 'round' — каждая акция отдельно, 'optimal' — solver.allocate_lots
+    tracking_error: float
+    __slots__ = ['weight_manager', 'capital', 'capital_units', 'briefcase',
                  'ignored', 'favorites', 'all', 'weights_sum', 'all_rur',
-                 'plans', 'facts', 'user_amount_sum']
+                 'plans', 'facts', 'user_amount_sum', 'solver', 'tracking_error']
 
+    @timed('main.UserBriefcase')
     def __init__(
             self,
             weight_manager: WeightManager,
             ignored: Sequence,
             favorites: Sequence,
             capital: int,
-            briefcase: Mapping):
+            briefcase: Mapping,
+            solver: str = 'round'):
         self.weight_manager = weight_manager
+        self.solver = solver
         self.capital = Decimal(capital or 1 * 1000 * 1000)
+        self.capital_units = price_to_units(self.capital)
         self.briefcase = briefcase
         self.ignored = set(ignored)
         self.favorites = set(favorites)
 
         self.all = tuple(self.get_all())
-        self.weights_sum = Decimal(sum(we.weight for we in self.all))
+        self.weights_sum = sum(we.weight_bp for we in self.all)
         self.update_plan()
         self.all_rur = Decimal(sum(plan.amount for plan in self.plans.values()))
         self.update_fact()
@@ -150,21 +207,68 @@ class UserBriefcase:
         self.plans = {}
         # _capital = self.capital * self.weights_sum / 100
         # print('_kap', _capital, self.weights_sum)
-        for we in self.all:
-            in_rur = we.weight / self.weights_sum * self.capital
-            lot_count = round(in_rur / we.lotprice)
+        weights = [we.weight_bp for we in self.all]
+        lotprices = [we.lotprice_units for we in self.all]
+        groups = self.pair_groups()
+        if self.solver == 'optimal':
+            lot_counts = solver.allocate_lots(weights, lotprices, groups, self.capital_units)
+        else:
+            # round(weight / weights_sum * capital / lotprice); без цены или лота — 0 лотов
+            lot_counts = [div_round(weight * self.capital_units, self.weights_sum * lotprice)
+                          if lotprice and self.weights_sum else 0
+                          for weight, lotprice in zip(weights, lotprices)]
+        for we, lot_count in zip(self.all, lot_counts):
             count = lot_count * we.lotsize
             amount = lot_count * we.lotprice
             self.plans[we.ticker] = Plan(count, amount)
+        self.tracking_error = solver.tracking_error(
+            weights, lotprices, groups, self.capital_units, lot_counts)
+
+    def pair_groups(self):
+        # номер группы для каждой акции из self.all, пары — в одной группе
+        index = {we.ticker: i for i, we in enumerate(self.all)}
+        return [min(index.get(_ticker, i) for _ticker in PAIRS_DICT.get(we.ticker, (we.ticker,)))
+                for i, we in enumerate(self.all)]
 
     def update_fact(self):
         self.facts = {}
-        self.user_amount_sum = Decimal(0)
+        amount_sum = 0
         for we in self.all:
             count = self.briefcase.get(we.ticker, 0)
-            amount = we.price * count
-            self.user_amount_sum += amount
-            self.facts[we.ticker] = Fact(count, amount)
+            amount_sum += we.price_units * count
+            self.facts[we.ticker] = Fact(count, we.price * count)
+        self.user_amount_sum = units_to_decimal(amount_sum)
+
+    def set_count(self, ticker, count):
+        # пересчёт факта одной акции без полной пересборки;
+        # None, если от этого меняется состав таблицы
+        if (ticker not in self.facts or ticker in self.ignored
+                or ticker not in self.weight_manager.weights):
+            return None
+        we = self.weight_manager.weights[ticker]
+        old = self.facts[ticker]
+        fact = Fact(count, we.price * count)
+        self.briefcase[ticker] = count
+        self.facts[ticker] = fact
+        self.user_amount_sum += fact.amount - old.amount
+        # вместе с акцией меняется процент её пары
+        return {_ticker for _ticker in PAIRS_DICT.get(ticker, (ticker,)) if _ticker in self.facts}
+
+    def buy_next(self, cash) -> list:
+        # что докупить на cash рублей, ничего не продавая;
+        # игнорируемые акции не покупаем
+        lotprices = [0 if we.ticker in self.ignored else we.lotprice_units for we in self.all]
+        gaps = [(self.plans[we.ticker].count - self.facts[we.ticker].count) * we.price_units
+                for we in self.all]
+        lots = solver.buy_lots(lotprices, self.pair_groups(), gaps, price_to_units(cash))
+        return [Purchase(we.ticker, count, count * we.lotsize, count * we.lotprice)
+                for we, count in zip(self.all, lots) if count]
+
+    def set_capital(self, capital):
+        self.capital = Decimal(capital or 1 * 1000 * 1000)
+        self.capital_units = price_to_units(self.capital)
+        self.update_plan()
+        self.all_rur = Decimal(sum(plan.amount for plan in self.plans.values()))
 
     def get_in_percent(self, ticker):
         # процент акции от планового по этой акции
@@ -225,3 +329,60 @@ class UserBriefcase:
             ign = 'i' if we.ticker in self.ignored else ''
             print(
                 f'{we.shortname[:20]:<20} {we.ticker:<5} {we.price:>9.2f} {plan.count:>7} {plan.amount:>10.0f} {fact.count:>7} {fact.amount:>10.0f} ({in_percent:>7.0%}) {fav or ign}')
+
+
+class ConsolidatedBriefcase:
+    """
+    Все портфели пользователя вместе: сколько каждой акции в каждом
+    портфеле и в сумме, по ценам одного снимка.
+
+    Считается одним проходом по позициям всех портфелей, без плана
+    и UserBriefcase для каждого портфеля. Акции без цены входят с price None.
+    """
+    portfolios: list  # PortfolioTotal, в порядке portfolios
+    holdings: list  # Holding, по убыванию суммы; counts — по портфелям
+    capital: Decimal
+    amount_sum: Decimal
+    __slots__ = ['portfolios', 'holdings', 'capital', 'amount_sum']
+
+    @timed('main.ConsolidatedBriefcase')
+    def __init__(self, names: Mapping, prices: PriceMap, portfolios: Mapping, positions: Mapping):
+        # portfolios: имя -> (capital, weight_name), positions: имя -> {ticker: count}
+        column = {name: i for i, name in enumerate(portfolios)}
+        size = len(column)
+        counts = {}
+        units = {}
+        amounts = [0] * size
+        for name, shares in positions.items():
+            i = column.get(name)
+            if i is None:
+                continue
+            for ticker, count in shares.items():
+                row = counts.get(ticker)
+                if row is None:
+                    row = counts[ticker] = [0] * size
+                    attr = prices.get(ticker)
+                    units[ticker] = price_to_units(attr['price']) if attr else None
+                row[i] += count
+                amounts[i] += (units[ticker] or 0) * count
+
+        self.holdings = []
+        for ticker, row in counts.items():
+            count = sum(row)
+            price_units = units[ticker]
+            self.holdings.append(Holding(
+                ticker, names.get(ticker, ticker),
+                None if price_units is None else units_to_decimal(price_units),
+                count, units_to_decimal((price_units or 0) * count), tuple(row)))
+        self.holdings.sort(key=lambda holding: (-holding.amount, holding.ticker))
+        self.portfolios = [
+            PortfolioTotal(name, weight_name, Decimal(capital or 1 * 1000 * 1000),
+                           units_to_decimal(amount))
+            for (name, (capital, weight_name)), amount in zip(portfolios.items(), amounts)]
+        self.capital = sum((portfolio.capital for portfolio in self.portfolios), Decimal(0))
+        self.amount_sum = units_to_decimal(sum(amounts))
+
+    def percent_of_total(self, holding: Holding):
+        if holding.amount and self.amount_sum:
+            return holding.amount / self.amount_sum
+        return 0
@@ -0,0 +1,41 @@
+"""
+Ручная цена акции, источник 'manual':
+
+    python3 manual_price.py TICKER PRICE [LOTSIZE]
+
+Пишется отдельным снимком из одной акции. По умолчанию ручная цена
+важнее остальных, пока не устарела (PRICE_SOURCES, PRICE_MAX_AGE_HOURS).
+"""
+import sys
+from datetime import datetime
+
+import db
+
+SOURCE = 'manual'
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        print(__doc__.strip(), file=sys.stderr)
+        return 2
+    ticker, price = argv[0].upper(), float(argv[1])
+    conn = db.get_sqlite_connection()
+    cursor = conn.cursor()
+    db.init_sqlite(cursor)
+    if len(argv) == 3:
+        lotsize = int(argv[2])
+    else:
+        known = db.fetch_last_prices(cursor) or {}
+        if ticker not in known:
+            print(f'{ticker}: unknown lot size, pass LOTSIZE', file=sys.stderr)
+            return 1
+        lotsize = known[ticker]['lotsize']
+    db.insert_snapshot(cursor, datetime.utcnow(), SOURCE, {ticker: {'price': price, 'lotsize': lotsize}})
+    conn.commit()
+    conn.close()
+    print(ticker, price, lotsize)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
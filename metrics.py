@@ -0,0 +1,214 @@
+"""
+Метрики процесса в формате Prometheus и сэмплирующий профилировщик.
+
+    @metrics.timed('db.fetch_names')     # гистограмма moex_span_seconds{span="db.fetch_names"}
+    with metrics.span('get_db'): ...
+
+render() отдаёт текст для /metrics. Метрики живут в памяти процесса:
+у каждого воркера gunicorn свои, Prometheus собирает их по отдельности.
+
+Profiler раз в interval снимает стек одного потока (sys._current_frames)
+и копит свёрнутые стеки "a;b;c count" — формат flamegraph.pl и speedscope.
+"""
+import os
+import sys
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import Counter as StackCounter, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+MAX_PROFILES = 20
+
+REGISTRY = OrderedDict()
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(key, extra=()) -> str:
+    labels = [*key, *extra]
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+class Counter:
+    __slots__ = ['name', 'help', 'lock', 'series']
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.series = {}
+        REGISTRY[name] = self
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def lines(self):
+        for key, value in sorted(self.series.items()):
+            yield f'{self.name}{format_labels(key)} {value}'
+
+
+class Histogram:
+    """Гистограмма с накоплением по корзинам, как у prometheus_client."""
+    __slots__ = ['name', 'help', 'buckets', 'lock', 'series']
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}  # labels -> [счётчики корзин + переполнение, сумма]
+        REGISTRY[name] = self
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def lines(self):
+        for key, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(key, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{format_labels(key)} {total}'
+            yield f'{self.name}_count{format_labels(key)} {cumulative}'
+
+
+spans = Histogram('moex_span_seconds', 'Time spent in instrumented code')
+request_seconds = Histogram('moex_request_seconds', 'Request latency by endpoint')
+request_queries = Histogram('moex_request_sql_queries', 'SQL statements per request', COUNT_BUCKETS)
+queries = Counter('moex_sql_queries_total', 'SQL statements executed by requests')
+
+
+@contextmanager
+def span(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.observe(time.perf_counter() - started, span=name)
+
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                spans.observe(time.perf_counter() - started, span=name)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY.values():
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        with metric.lock:
+            lines.extend(metric.lines())
+    return '\n'.join(lines) + '\n'
+
+
+# switch interval общий на процесс: его сохраняет первый запущенный Profiler,
+# а восстанавливает последний остановленный
+switch_lock = threading.Lock()
+active_profilers = 0
+saved_switch_interval = None
+
+
+def lower_switch_interval(interval):
+    global active_profilers, saved_switch_interval
+    with switch_lock:
+        if not active_profilers:
+            saved_switch_interval = sys.getswitchinterval()
+        active_profilers += 1
+        # иначе GIL отдаётся потоку профилировщика раз в 5 мс
+        sys.setswitchinterval(min(sys.getswitchinterval(), interval / 2))
+
+
+def restore_switch_interval():
+    global active_profilers
+    with switch_lock:
+        active_profilers -= 1
+        if not active_profilers:
+            sys.setswitchinterval(saved_switch_interval)
+
+
+class Profiler:
+    """Сэмплирует стек потока thread_id в фоновом потоке."""
+    __slots__ = ['thread_id', 'interval', 'samples', 'running', 'thread', 'started', 'elapsed']
+
+    def __init__(self, thread_id=None, interval=0.001):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = StackCounter()
+        self.running = False
+        self.thread = None
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        lower_switch_interval(self.interval)
+        self.running = True
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self.elapsed = time.perf_counter() - self.started
+            restore_switch_interval()
+        return self
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+profiles = OrderedDict()
+profiles_lock = threading.Lock()
+
+
+def save_profile(profiler: Profiler) -> str:
+    # последние MAX_PROFILES профилей, по id
+    profile_id = uuid.uuid4().hex[:12]
+    with profiles_lock:
+        profiles[profile_id] = profiler.collapsed()
+        while len(profiles) > MAX_PROFILES:
+            profiles.popitem(last=False)
+    return profile_id
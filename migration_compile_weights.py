@@ -0,0 +1,29 @@
+import db
+import weightsets
+
+
+def migrate():
+    conn = db.get_sqlite_connection()
+    cursor = conn.cursor()
+    db.init_sqlite(cursor)
+
+    rows = cursor.execute(
+        'SELECT name, weights_json FROM weights '
+        'WHERE name NOT IN (SELECT name FROM weights_compiled)').fetchall()
+    for name, weights_json in rows:
+        try:
+            weightsets.ingest(cursor, name, weightsets.parse_json(weights_json))
+        except weightsets.WeightsError as e:
+            # остаётся JSON, db.fetch_weights прочитает его как раньше
+            print('skipped', name, e)
+            continue
+        print('compiled', name)
+    if rows:
+        db.bump_generation(cursor)
+        conn.commit()
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    migrate()
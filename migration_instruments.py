@@ -0,0 +1,21 @@
+import db
+
+
+def migrate():
+    conn = db.get_sqlite_connection()
+    cursor = conn.cursor()
+
+    # instruments — только кеш ответов Тинькофф: старую таблицу без updated
+    # проще удалить, get_shares заполнит её заново одним запросом
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(instruments)')]
+    if columns and 'updated' not in columns:
+        cursor.execute('DROP TABLE instruments')
+        print('dropped old instruments cache')
+    db.init_sqlite(cursor)
+    conn.commit()
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,36 @@
+import db
+
+
+def migrate():
+    conn = db.get_sqlite_connection()
+    cursor = conn.cursor()
+
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(user_positions)')]
+    if columns and 'portfolio' not in columns:
+        add_portfolio_column(cursor)
+    db.init_sqlite(cursor)
+    conn.commit()
+
+    conn.close()
+
+
+def add_portfolio_column(cursor):
+    # первичный ключ WITHOUT ROWID не поменять ALTER TABLE: пересобираем таблицы,
+    # все старые позиции и флаги попадают в основной портфель
+    cursor.execute('DROP INDEX IF EXISTS user_positions_ticker')
+    cursor.execute('ALTER TABLE user_positions RENAME TO user_positions_old')
+    cursor.execute('ALTER TABLE user_flags RENAME TO user_flags_old')
+    db.init_sqlite(cursor)
+    cursor.execute('INSERT INTO user_positions (email, ticker, count) '
+                   'SELECT email, ticker, count FROM user_positions_old')
+    positions = cursor.rowcount
+    cursor.execute('INSERT INTO user_flags (email, ticker, flag) '
+                   'SELECT email, ticker, flag FROM user_flags_old')
+    flags = cursor.rowcount
+    cursor.execute('DROP TABLE user_positions_old')
+    cursor.execute('DROP TABLE user_flags_old')
+    print('migrated positions', positions, 'flags', flags)
+
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,47 @@
+import json
+
+import db
+
+
+def migrate():
+    conn = db.get_sqlite_connection()
+    cursor = conn.cursor()
+    migrate_price_units(cursor)
+    db.init_sqlite(cursor)
+    conn.commit()
+
+    result = cursor.execute('select count(*) from snapshots').fetchone()
+    if not result or not result[0]:
+        migrate_prices(cursor)
+        conn.commit()
+
+    conn.close()
+
+
+def migrate_prices(cursor):
+    rows = cursor.connection.cursor().execute(
+        'SELECT dt, source, price_map FROM prices ORDER BY dt')
+    count = 0
+    for dt, source, price_map in rows:
+        db.insert_snapshot(cursor, dt, source, json.loads(price_map))
+        count += 1
+    print('migrated snapshots', count)
+
+
+def migrate_price_units(cursor):
+    # price_ticks.price REAL -> price_ticks.price_units INTEGER
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(price_ticks)')]
+    if 'price' not in columns:
+        return
+    cursor.execute('ALTER TABLE price_ticks RENAME TO price_ticks_real')
+    cursor.execute('DROP INDEX IF EXISTS price_ticks_ticker')
+    db.init_sqlite(cursor)
+    cursor.execute(
+        'INSERT INTO price_ticks SELECT snapshot_id, ticker, round(price * ?), lotsize '
+        'FROM price_ticks_real', (db.PRICE_SCALE,))
+    cursor.execute('DROP TABLE price_ticks_real')
+    print('converted price_ticks to integer units')
+
+
+if __name__ == '__main__':
+    migrate()
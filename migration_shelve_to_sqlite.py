@@ -19,7 +19,7 @@ def migrate():
         migrate_users(cursor)
         conn.commit()
 
-    result = cursor.execute('select count(*) from prices').fetchone()
+    result = cursor.execute('select count(*) from snapshots').fetchone()
     if not result or not result[0]:
         migrate_prices(cursor)
         conn.commit()
@@ -56,8 +56,7 @@ def migrate_prices(cursor):
     with open(PRICES_FILENAME, 'r') as fp:
         price_map = json.load(fp)
     print(price_map)
-    data = (datetime.utcnow(), 'tinkoff', json.dumps(price_map))
-    cursor.execute("INSERT INTO prices VALUES(?, ?, ?)", data)
+    db.insert_snapshot(cursor, datetime.utcnow(), 'tinkoff', price_map)
 
 
 def migrate_weights(cursor):
@@ -0,0 +1,20 @@
+import db
+
+
+def migrate():
+    conn = db.get_sqlite_connection()
+    cursor = conn.cursor()
+    db.init_sqlite(cursor)
+
+    result = cursor.execute('select count(*) from resolved_prices').fetchone()
+    if not result or not result[0]:
+        db.rebuild_source_prices(cursor)
+        conn.commit()
+        count = cursor.execute('select count(*) from resolved_prices').fetchone()[0]
+        print('resolved prices', count)
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,35 @@
+import json
+
+import db
+
+
+def migrate():
+    conn = db.get_sqlite_connection()
+    cursor = conn.cursor()
+    db.init_sqlite(cursor)
+
+    result = cursor.execute('select count(*) from user_positions').fetchone()
+    flags = cursor.execute('select count(*) from user_flags').fetchone()
+    if (not result or not result[0]) and (not flags or not flags[0]):
+        migrate_users(cursor)
+        conn.commit()
+
+    conn.close()
+
+
+def migrate_users(cursor):
+    rows = cursor.connection.cursor().execute('SELECT email, shares, favorites, ignored FROM users')
+    count = 0
+    for email, shares, favorites, ignored in rows:
+        for ticker, share_count in json.loads(shares).items():
+            db.save_position(cursor, email, ticker, share_count)
+        for ticker in favorites.split():
+            db.save_flag(cursor, email, 'favorite', ticker, True)
+        for ticker in ignored.split():
+            db.save_flag(cursor, email, 'ignored', ticker, True)
+        count += 1
+    print('migrated users', count)
+
+
+if __name__ == '__main__':
+    migrate()
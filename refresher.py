@@ -0,0 +1,168 @@
+"""
+Фоновое обновление цен.
+
+Поток в приложении (или отдельный процесс: python3 refresher.py) раз в
+PRICES_REFRESH_INTERVAL секунд в торговые часы MOEX и раз в
+PRICES_IDLE_INTERVAL секунд вне их сохраняет новый снимок цен.
+Запуски из разных воркеров gunicorn разводит файловая блокировка.
+"""
+import fcntl
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, time as dtime, timedelta, timezone
+
+import db
+import settings
+
+REFRESH_INTERVAL = getattr(settings, "PRICES_REFRESH_INTERVAL", 0)
+IDLE_INTERVAL = getattr(settings, "PRICES_IDLE_INTERVAL", 60 * 60)
+LOCK_FILENAME = getattr(settings, "PRICES_LOCK_FILENAME", "prices_refresh.lock")
+
+MSK = timezone(timedelta(hours=3))
+TRADING_START = dtime(9, 50)
+TRADING_END = dtime(18, 50)
+
+
+def is_trading_time(now=None):
+    now = (now or datetime.now(MSK)).astimezone(MSK)
+    return now.weekday() < 5 and TRADING_START <= now.time() <= TRADING_END
+
+
+@contextmanager
+def file_lock(filename):
+    # None, если обновление уже идёт в другом процессе
+    with open(filename, 'w') as fp:
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield None
+            return
+        try:
+            yield fp
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def refresh_prices(conn):
+    import tink
+    from main import WeightManager
+
+    cursor = conn.cursor()
+    tickers = list(db.fetch_names(cursor).keys())
+    with tink.Client(tink.TOKEN) as client:
+        shares = tink.get_shares(client, tickers, cursor)
+        conn.commit()
+        shares_with_prices = tink.get_prices(client, shares)
+
+    price_map = {
+        share.ticker: {'price': float(price), 'lotsize': share.lot}
+        for share, price in shares_with_prices}
+    WeightManager.save_to_sqlite(conn, 'tinkoff', price_map)
+
+
+class Refresher:
+    runs: int
+    failures: int
+    skipped: int
+    last_latency: float
+    last_run: float
+    last_error: str
+    __slots__ = ['job', 'interval', 'idle_interval', 'lock_filename', 'event', 'thread',
+                 'runs', 'failures', 'skipped', 'last_latency', 'last_run', 'last_error']
+
+    def __init__(self, job=refresh_prices, interval=REFRESH_INTERVAL,
+                 idle_interval=IDLE_INTERVAL, lock_filename=LOCK_FILENAME):
+        self.job = job
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.lock_filename = lock_filename
+        self.event = threading.Event()
+        self.thread = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_latency = 0.0
+        self.last_run = 0.0
+        self.last_error = ''
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop, name='prices-refresher', daemon=True)
+            self.thread.start()
+
+    def request(self):
+        # обновить как можно скорее, не дожидаясь расписания
+        self.start()
+        self.event.set()
+
+    def next_timeout(self):
+        if not self.interval:
+            return None
+        return self.interval if is_trading_time() else self.idle_interval
+
+    def loop(self):
+        # поток не перезапускается (start смотрит на self.thread), поэтому
+        # любая ошибка только записывается, а цикл идёт дальше
+        while True:
+            try:
+                forced = self.event.wait(self.next_timeout())
+                self.event.clear()
+                if forced or self.is_due():
+                    self.run_once()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = repr(e)
+                print('prices refresher error', self.last_error)
+
+    def is_due(self):
+        # снимок мог сохранить другой воркер
+        conn = db.get_sqlite_connection()
+        row = conn.execute("SELECT max(dt) FROM snapshots").fetchone()
+        conn.close()
+        if not row or not row[0]:
+            return True
+        age = datetime.utcnow() - datetime.fromisoformat(row[0])
+        return age.total_seconds() >= self.next_timeout()
+
+    def run_once(self):
+        with file_lock(self.lock_filename) as lock:
+            if lock is None:
+                self.skipped += 1
+                return
+            started = time.perf_counter()
+            conn = db.get_sqlite_connection()
+            try:
+                self.job(conn)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = repr(e)
+                print('prices refresh failed', self.last_error)
+            else:
+                self.runs += 1
+            finally:
+                conn.close()
+                self.last_latency = time.perf_counter() - started
+                self.last_run = time.time()
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'last_latency': self.last_latency,
+            'last_run': self.last_run,
+            'last_error': self.last_error,
+            'pending': self.event.is_set(),
+            'trading': is_trading_time(),
+        }
+
+
+refresher = Refresher()
+
+
+if __name__ == '__main__':
+    if not refresher.interval:
+        refresher.interval = 5 * 60
+    refresher.run_once()
+    refresher.loop()
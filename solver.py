@@ -0,0 +1,170 @@
+"""
+Подбор целого числа лотов под веса стратегии.
+
+Вместо независимого округления каждой акции минимизируем сумму квадратов
+отклонений (факт - цель) по группам (парные акции — одна группа) при
+условии, что весь план укладывается в капитал. Начинаем с округления
+вниз, затем жадно добавляем, убираем или переставляем по одному лоту,
+пока это уменьшает отклонение; число шагов ограничено.
+
+Все величины целые: цели и стоимости лотов умножены на сумму весов.
+
+buy_lots — докупка на свободные деньги без продаж: жадно по куче,
+каждый раз лот, который сильнее всего сокращает недобор группы.
+"""
+import heapq
+import math
+from typing import List, Sequence
+
+
+def deviations(weights, lotprices, groups, capital, lots):
+    weights_sum = sum(weights)
+    result = {}
+    for weight, lotprice, group, count in zip(weights, lotprices, groups, lots):
+        result[group] = result.get(group, 0) + count * lotprice * weights_sum - weight * capital
+    return result
+
+
+def tracking_error(weights: Sequence[int], lotprices: Sequence[int], groups: Sequence[int],
+                   capital: int, lots: Sequence[int]) -> float:
+    # корень из суммы квадратов отклонений долей групп от целевых
+    budget = capital * sum(weights)
+    if not budget:
+        return 0.0
+    squares = sum(d * d for d in deviations(weights, lotprices, groups, capital, lots).values())
+    return math.sqrt(squares) / budget
+
+
+def best_swap(lots, costs, groups, delta, free):
+    # лот j убираем, лот i добавляем. Для разных групп изменения независимы,
+    # поэтому перебираем оба списка по возрастанию и обрываем перебор,
+    # как только сумма лучших кандидатов не может улучшить результат.
+    adds = sorted((delta(groups[i], cost), i) for i, cost in enumerate(costs) if cost)
+    removes = sorted((delta(groups[j], -costs[j]), j) for j, count in enumerate(lots) if count)
+    best, move = 0, None
+    if not adds:
+        return best, move
+    for removed, j in removes:
+        if removed + adds[0][0] >= best:
+            break
+        for added, i in adds:
+            if added + removed >= best:
+                break
+            if groups[i] != groups[j] and costs[i] - costs[j] <= free:
+                best, move = added + removed, (i, j)
+                break
+
+    # внутри группы (пары) отклонение общее, считаем отдельно
+    members = {}
+    for i, group in enumerate(groups):
+        members.setdefault(group, []).append(i)
+    for group, indexes in members.items():
+        for j in indexes:
+            if not lots[j]:
+                continue
+            for i in indexes:
+                if i != j and costs[i] and costs[i] - costs[j] <= free:
+                    change = delta(group, costs[i] - costs[j])
+                    if change < best:
+                        best, move = change, (i, j)
+    return best, move
+
+
+def allocate_lots(weights: Sequence[int], lotprices: Sequence[int], groups: Sequence[int],
+                  capital: int, max_moves: int = 0) -> List[int]:
+    size = len(weights)
+    weights_sum = sum(weights)
+    if not size or not weights_sum:
+        return [0] * size
+
+    costs = [lotprice * weights_sum for lotprice in lotprices]
+    targets = [weight * capital for weight in weights]
+    budget = capital * weights_sum
+    lots = [target // cost if cost else 0 for target, cost in zip(targets, costs)]
+    deviation = deviations(weights, lotprices, groups, capital, lots)
+    spent = sum(count * cost for count, cost in zip(lots, costs))
+
+    def delta(group, change):
+        # изменение суммы квадратов, если отклонение группы сдвинуть на change
+        d = deviation[group]
+        return change * (2 * d + change)
+
+    for _ in range(max_moves or 4 * size):
+        best = 0
+        move = None
+        for i in range(size):
+            cost = costs[i]
+            if not cost:
+                continue
+            if spent + cost <= budget:
+                change = delta(groups[i], cost)
+                if change < best:
+                    best, move = change, (i, None)
+            if lots[i]:
+                change = delta(groups[i], -cost)
+                if change < best:
+                    best, move = change, (None, i)
+
+        if move is None:
+            # одиночные шаги не помогают — пробуем переставить лот
+            best, move = best_swap(lots, costs, groups, delta, budget - spent)
+
+        if move is None:
+            break
+        add, remove = move
+        if add is not None:
+            lots[add] += 1
+            spent += costs[add]
+            deviation[groups[add]] += costs[add]
+        if remove is not None:
+            lots[remove] -= 1
+            spent -= costs[remove]
+            deviation[groups[remove]] -= costs[remove]
+
+    return lots
+
+
+def buy_lots(lotprices: Sequence[int], groups: Sequence[int], gaps: Sequence[int],
+             cash: int) -> List[int]:
+    """
+    Сколько лотов каждой акции докупить на cash.
+
+    gaps — недобор (план - факт) каждой акции, суммируется по группам.
+    Лот выгоден, пока уменьшает квадрат недобора группы,
+    т.е. стоит меньше двойного недобора. Акции с lotprice == 0 не покупаются.
+    """
+    size = len(lotprices)
+    lots = [0] * size
+    gap = {}
+    members = {}
+    for i, group in enumerate(groups):
+        gap[group] = gap.get(group, 0) + gaps[i]
+        if lotprices[i]:
+            members.setdefault(group, []).append(i)
+    version = dict.fromkeys(members, 0)
+
+    def gain(i):
+        cost = lotprices[i]
+        return cost * (2 * gap[groups[i]] - cost)
+
+    heap = [(-gain(i), i, 0) for indexes in members.values() for i in indexes
+            if lotprices[i] <= cash and gain(i) > 0]
+    heapq.heapify(heap)
+    while heap:
+        _, i, seen = heapq.heappop(heap)
+        group = groups[i]
+        if seen != version[group]:
+            # недобор группы изменился — запись устарела
+            continue
+        cost = lotprices[i]
+        if cost > cash:
+            # денег меньше не станет, больше эта акция не пригодится
+            continue
+        lots[i] += 1
+        cash -= cost
+        gap[group] -= cost
+        version[group] += 1
+        for j in members[group]:
+            if lotprices[j] <= cash and gain(j) > 0:
+                heapq.heappush(heap, (-gain(j), j, version[group]))
+    return lots
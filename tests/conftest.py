@@ -0,0 +1,109 @@
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# tests/settings.py должен найтись раньше settings.py из корня проекта
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, ROOT)
+
+from main import PAIRS_DICT, WeightManager  # noqa: E402
+
+
+def load_weights():
+    # тикеры, веса и названия из weights.txt
+    with open(os.path.join(ROOT, 'weights.txt'), encoding='utf-8') as fp:
+        rows = [row.rstrip('\n').split('\t') for row in fp if row.strip()]
+    return {row[0]: row[2] for row in rows}, {row[0]: float(row[1]) for row in rows}
+
+
+def random_portfolio(rnd: random.Random):
+    """
+    Случайные цены, лоты и позиции по тикерам weights.txt и одна акция вне стратегии:
+    (WeightManager, ignored, briefcase, capital). Парные акции всегда в портфеле.
+    """
+    names, weights = load_weights()
+    names = dict(names, YNDX='Яндекс')
+    prices = {ticker: {'price': round(rnd.uniform(0.001, 9000), rnd.choice([2, 3, 6])),
+                       'lotsize': rnd.choice([1, 10, 100, 1000, 10000])}
+              for ticker in names}
+    tickers = list(names)
+    held = set(rnd.sample(tickers, 10)) | set(PAIRS_DICT)
+    briefcase = {ticker: rnd.randint(0, 500) for ticker in sorted(held)}
+    ignored = rnd.sample(tickers, 3)
+    capital = rnd.randint(1000, 10 ** 7)
+    return WeightManager(names, prices, weights), ignored, briefcase, capital
+
+
+@pytest.fixture(params=range(50))
+def portfolio(request):
+    return random_portfolio(random.Random(request.param))
+
+
+@pytest.fixture
+def conn():
+    # общая для сессии тестовая база из tests/settings.py
+    import db
+    conn = db.get_sqlite_connection()
+    db.init_sqlite(conn.cursor())
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+PRICES_SEED = 1
+
+
+def random_prices(names, rnd: random.Random):
+    return {ticker: {'price': round(rnd.uniform(1, 5000), 2), 'lotsize': rnd.choice([1, 10, 100])}
+            for ticker in names}
+
+
+@pytest.fixture
+def client(conn, request):
+    """
+    Клиент приложения с вошедшим пользователем <имя теста>@example.com:
+    веса из weights.txt, свежий снимок цен, несколько позиций и флагов.
+    """
+    import application
+    import db
+    import weightsets
+    from datetime import datetime
+    from users import User
+
+    cursor = conn.cursor()
+    names, weights = load_weights()
+    db.add_new_tickers(cursor, dict(names, YNDX='Яндекс'))
+    if weightsets.ingest(cursor, 'MOEX 2022', [(ticker, str(weight), None)
+                                              for ticker, weight in weights.items()]):
+        db.bump_generation(cursor)
+    prices = random_prices(list(names) + ['YNDX'], random.Random(PRICES_SEED))
+    db.insert_snapshot(cursor, datetime.utcnow(), 'tinkoff', prices)
+    conn.commit()
+
+    email = f'{request.node.name}@example.com'
+    user = User(conn, email)
+    for ticker, count in {'SBER': 100, 'SBERP': 50, 'YNDX': 3}.items():
+        user.save_position(ticker, count)
+    user.toggle_flag('favorite', 'SBER', True)
+    user.toggle_flag('ignored', 'GAZP', True)
+    user.flush()
+
+    # testing включает заголовок X-Query-Count
+    application.app.testing = True
+    client = application.app.test_client()
+    with client.session_transaction() as session:
+        session['email'] = email
+    client.prices = prices
+    return client
+
+
+@pytest.fixture(scope='session', autouse=True)
+def remove_database():
+    import settings
+    yield
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(settings.SQLITE_DB_NAME + suffix):
+            os.remove(settings.SQLITE_DB_NAME + suffix)
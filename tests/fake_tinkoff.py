@@ -0,0 +1,50 @@
+"""
+Клиент Тинькофф без сети для тестов tink.py: тот же интерфейс,
+что нужен get_shares и get_prices.
+
+    with FakeClient({'SBER': (Decimal('250.1'), 10)}) as client:
+        shares = tink.get_shares(client, ['SBER'])
+"""
+from decimal import Decimal
+from types import SimpleNamespace
+
+NANO = 10 ** 9
+
+
+def to_quotation(value: Decimal):
+    # как Quotation в tinkoff.invest: целые units и nano одного знака
+    units = int(value)
+    return SimpleNamespace(units=units, nano=int((value - units) * NANO))
+
+
+class FakeClient:
+    def __init__(self, instruments, class_code='TQBR'):
+        self.calls = []
+        self.class_code = class_code
+        self.set_instruments(instruments)
+        self.instruments = SimpleNamespace(shares=self._shares)
+        self.market_data = SimpleNamespace(get_last_prices=self._get_last_prices)
+
+    def set_instruments(self, instruments):
+        # {ticker: (price, lot)}
+        self.share_list = [
+            SimpleNamespace(ticker=ticker, figi=f'FIGI-{ticker}', lot=lot, class_code=self.class_code)
+            for ticker, (price, lot) in instruments.items()]
+        self.price_map = {f'FIGI-{ticker}': Decimal(price)
+                          for ticker, (price, lot) in instruments.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _shares(self):
+        self.calls.append('shares')
+        return SimpleNamespace(instruments=self.share_list)
+
+    def _get_last_prices(self, figi):
+        self.calls.append('get_last_prices')
+        return SimpleNamespace(last_prices=[
+            SimpleNamespace(figi=item, price=to_quotation(self.price_map[item]))
+            for item in figi if item in self.price_map])
@@ -0,0 +1,7 @@
+# настройки для тестов: conftest кладёт tests/ раньше корня проекта в sys.path
+import os
+import tempfile
+
+SECRET_KEY = b'test'
+SQLITE_DB_NAME = os.path.join(tempfile.gettempdir(), f'moex-test-{os.getpid()}.sqlite')
+TINKOFF_TOKEN = ''
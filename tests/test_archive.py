@@ -0,0 +1,82 @@
+import sqlite3
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytest
+
+import archive
+import db
+
+
+@pytest.fixture
+def conn(tmp_path):
+    # снимки раз в 13 часов за последние пять месяцев, часть снимков неполные
+    conn = sqlite3.connect(str(tmp_path / 'archive.sqlite'))
+    cursor = conn.cursor()
+    db.init_sqlite(cursor)
+    start = datetime.combine(date.today(), datetime.min.time()) - timedelta(days=150)
+    for i in range(150 * 24 // 13):
+        price_map = {'SBER': {'price': 250 + i / 100, 'lotsize': 10},
+                     'GAZP': {'price': 150 - i / 1000, 'lotsize': 10}}
+        if i % 3:
+            price_map['LKOH'] = {'price': 7000 + i, 'lotsize': 1}
+        if i % 5 == 0:
+            del price_map['SBER']
+        db.insert_snapshot(cursor, start + timedelta(hours=13 * i), 'moex', price_map)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def snapshot_count(conn):
+    return conn.execute('SELECT count(*) FROM snapshots').fetchone()[0]
+
+
+def collect(conn, path, tickers=('SBER', 'GAZP', 'LKOH')):
+    # массивы timeline общие для всех шагов, поэтому копии
+    return [(dt, prices.copy(), lotsizes.copy())
+            for dt, prices, lotsizes in archive.timeline(conn.cursor(), tickers, archive.Archive(str(path)))]
+
+
+def assert_same(left, right):
+    assert [dt for dt, _, _ in left] == [dt for dt, _, _ in right]
+    for (_, prices, lotsizes), (_, expected_prices, expected_lotsizes) in zip(left, right):
+        np.testing.assert_array_equal(prices, expected_prices)
+        np.testing.assert_array_equal(lotsizes, expected_lotsizes)
+
+
+def test_timeline_same_after_export_and_compact(conn, tmp_path):
+    path = tmp_path / 'archive'
+    total = snapshot_count(conn)
+    before = collect(conn, path)
+    assert len(before) == total
+
+    exported = archive.archive_months(conn, archive.Archive(str(path)), keep_months=2, delete=False)
+    assert exported and snapshot_count(conn) == total
+    assert_same(collect(conn, path), before)
+
+    archive.archive_months(conn, archive.Archive(str(path)), keep_months=2, delete=True)
+    assert snapshot_count(conn) == total - exported
+    after = collect(conn, path)
+    assert_same(after, before)
+    # на стыке архива и SQLite: ни повторов, ни пропусков
+    dts = [dt for dt, _, _ in after]
+    assert len(set(dts)) == len(dts) == total
+
+
+def test_export_twice_is_idempotent(conn, tmp_path):
+    path = tmp_path / 'archive'
+    before = collect(conn, path)
+    archive.archive_months(conn, archive.Archive(str(path)), keep_months=2, delete=False)
+    archive.archive_months(conn, archive.Archive(str(path)), keep_months=2, delete=False)
+    assert_same(collect(conn, path), before)
+
+
+def test_month_columns(conn, tmp_path):
+    store = archive.Archive(str(tmp_path / 'archive'))
+    archive.archive_months(conn, store, keep_months=2, delete=False)
+    month = store.month(store.months()[0])
+    assert month.tickers == ['GAZP', 'LKOH', 'SBER']
+    assert month.price_units.shape == (len(month.ids), 3)
+    assert list(month.ids) == sorted(month.ids)
+    assert store.last_id() == max(int(store.month(name).ids.max()) for name in store.months())
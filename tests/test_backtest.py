@@ -0,0 +1,65 @@
+import random
+
+import numpy as np
+import pytest
+
+import backtest
+
+NAN = float('nan')
+
+
+def snapshots(rows):
+    for dt, prices, lotsizes in rows:
+        yield dt, np.array(prices, dtype=np.float64), np.array(lotsizes, dtype=np.float64)
+
+
+def test_replay_turnover_by_hand():
+    rows = [
+        ('2026-01-05 10:00:00', [100, 100], [1, 1]),
+        ('2026-01-20 10:00:00', [120, 100], [1, 1]),
+        ('2026-02-02 10:00:00', [200, 100], [1, 1]),
+    ]
+    points = list(backtest.replay(snapshots(rows), ['AAAA', 'BBBB'], [5000, 5000], 1000, 'month'))
+    # первый снимок: 5 + 5 лотов на все деньги
+    assert points[0] == (rows[0][0], 1000, 0, 1.0, 0.0)
+    # тот же месяц: без сделок
+    assert points[1].value == 1100 and points[1].cash == 0 and points[1].turnover == 0
+    # новый месяц, стоимость 1500: по 750 на акцию, rint даёт 4 + 8 лотов = 1600 > 1500,
+    # поэтому вниз: 3 + 7 лотов, остаток 200, оборот (2 * 200 + 2 * 100) / 1500
+    assert points[2].value == 1500
+    assert points[2].cash == 200
+    assert points[2].turnover == pytest.approx(600 / 1500)
+
+
+def test_replay_waits_for_prices():
+    # акция без цены не покупается, её доля достаётся остальным
+    rows = [('2026-01-05 10:00:00', [100, NAN], [1, 1]), ('2026-01-06 10:00:00', [100, 50], [1, 1])]
+    points = list(backtest.replay(snapshots(rows), ['AAAA', 'BBBB'], [5000, 5000], 1000, 'snapshot'))
+    assert points[0].cash == 0 and points[0].turnover == 1.0
+    assert points[1].turnover == pytest.approx(1000 / 1000)
+
+
+@pytest.mark.parametrize('rebalance', backtest.REBALANCE)
+@pytest.mark.parametrize('seed', range(10))
+def test_replay_cash_never_negative(seed, rebalance):
+    rnd = random.Random(seed)
+    size = 8
+    prices = [rnd.uniform(1, 5000) for _ in range(size)]
+    lotsizes = [rnd.choice([1, 10, 100]) for _ in range(size)]
+    rows = []
+    for day in range(120):
+        prices = [price * (1 + rnd.gauss(0, 0.05)) for price in prices]
+        rows.append((f'2026-{1 + day // 30:02d}-{1 + day % 28:02d} 10:00:00',
+                     [NAN if day < 3 and i == 0 else price for i, price in enumerate(prices)], lotsizes))
+    weights = [rnd.randint(1, 2000) for _ in range(size)]
+    capital = rnd.randint(10 ** 4, 10 ** 7)
+    points = list(backtest.replay(snapshots(rows), [f'T{i}' for i in range(size)], weights, capital, rebalance))
+    assert len(points) == len(rows)
+    for point in points:
+        assert point.cash >= -1e-6 * point.value
+        assert point.cash <= point.value
+        assert 0 <= point.turnover <= 2
+    if rebalance == 'never':
+        assert all(point.turnover == 0 for point in points[1:])
+    # первая покупка — почти все деньги
+    assert points[0].turnover > 0.5
@@ -0,0 +1,65 @@
+"""batch.iter_users: позиции и флаги всех портфелей двумя запросами."""
+import io
+import json
+import random
+from datetime import datetime
+
+import batch
+import db
+import weightsets
+from conftest import load_weights, random_prices
+from users import User
+
+
+def add_users(conn, prefix):
+    cursor = conn.cursor()
+    for i in range(5):
+        user = User(conn, f'{prefix}{i}@example.com')
+        user.save_position('SBER', 10 * (i + 1))
+        if i % 2:
+            user.toggle_flag('ignored', 'GAZP', True)
+        user.flush()
+        if i % 3 == 0:
+            db.save_portfolio(cursor, user.email, 'второй', capital=500000)
+            db.save_position(cursor, user.email, 'LKOH', i + 1, portfolio='второй')
+            db.save_flag(cursor, user.email, 'favorite', 'LKOH', True, portfolio='второй')
+    conn.commit()
+
+
+def test_iter_users_matches_lookups(conn):
+    add_users(conn, 'batch')
+    lookup = conn.cursor()
+    users = [user for _, user in batch.iter_users(conn.cursor())]
+    assert any(user['portfolio'] == 'второй' for user in users)
+    for user in users:
+        flags = db.fetch_flags(lookup, user['email'], user['portfolio'])
+        assert user['shares'] == db.fetch_positions(lookup, user['email'], user['portfolio'])
+        assert user['favorites'] == flags['favorite']
+        assert user['ignored'] == flags['ignored']
+
+
+def test_iter_users_query_count(conn):
+    add_users(conn, 'count')
+    counter = db.QueryCounter()
+    conn.set_trace_callback(counter)
+    users = list(batch.iter_users(conn.cursor()))
+    conn.set_trace_callback(None)
+    assert len(users) >= 5
+    # портфели, позиции и флаги — независимо от числа пользователей
+    assert counter.count == 3
+
+
+def test_process_writes_every_portfolio(conn):
+    add_users(conn, 'process')
+    names, weights = load_weights()
+    cursor = conn.cursor()
+    db.add_new_tickers(cursor, names)
+    weightsets.ingest(cursor, 'MOEX 2022', [(ticker, str(weight), None) for ticker, weight in weights.items()])
+    db.insert_snapshot(cursor, datetime.utcnow(), 'test', random_prices(names, random.Random(0)))
+    conn.commit()
+    fp = io.StringIO()
+    count = batch.process(conn.cursor(), fp, 'jsonl', 'decimal')
+    results = [json.loads(line) for line in fp.getvalue().splitlines()]
+    assert len(results) == count
+    second = next(r for r in results if r['email'] == 'process0@example.com' and r['portfolio'] == 'второй')
+    assert second['positions']['LKOH']['fact_count'] == 1
@@ -0,0 +1,70 @@
+import random
+from decimal import Decimal
+
+import pytest
+
+import solver
+from cache import PurchaseCache
+from conftest import random_portfolio
+from main import UserBriefcase
+
+
+def test_buy_lots_spends_at_most_cash():
+    lots = solver.buy_lots([300, 500, 700], [0, 1, 2], [3000, 5000, 7000], 1000)
+    assert sum(lot * price for lot, price in zip(lots, [300, 500, 700])) <= 1000
+    assert all(lot >= 0 for lot in lots)
+
+
+def test_buy_lots_aggregates_pairs():
+    # у второй акции пары перебор, он покрывает недобор первой
+    assert solver.buy_lots([100, 100], [0, 0], [500, -500], 10000) == [0, 0]
+    assert solver.buy_lots([100, 100], [0, 1], [500, -500], 10000) == [5, 0]
+
+
+def test_buy_lots_skips_zero_lotprice():
+    assert solver.buy_lots([0, 100], [0, 1], [10000, 10000], 10000)[0] == 0
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_buy_next(seed):
+    rnd = random.Random(seed)
+    weight_manager, ignored, briefcase, capital = random_portfolio(rnd)
+    ub = UserBriefcase(weight_manager, ignored, [], capital, briefcase)
+    cash = Decimal(rnd.randint(1, 10 ** 6))
+    purchases = ub.buy_next(cash)
+    assert sum(purchase.amount for purchase in purchases) <= cash
+    for purchase in purchases:
+        # только покупки и никогда — игнорируемых акций
+        assert purchase.lots > 0 and purchase.count > 0
+        assert purchase.ticker not in ub.ignored
+
+
+def test_buy_next_sub_bucket_cash():
+    # cash меньше корзины PurchaseCache всё равно что-то покупает
+    weight_manager, ignored, briefcase, capital = random_portfolio(random.Random(0))
+    ub = UserBriefcase(weight_manager, [], [], 10 ** 7, {})
+    cheapest = min(we.lotprice for we in ub.all)
+    assert ub.buy_next(cheapest + 1)
+
+
+def test_purchase_cache_computes_exact_cash():
+    cache = PurchaseCache(bucket=1000)
+    user_data = {'ignored': [], 'favorites': [], 'capital': 1, 'shares': {}}
+    computed = []
+
+    def compute(cash):
+        computed.append(cash)
+        return [cash]
+
+    assert cache.get('a', 1, user_data, Decimal(800), compute) == (Decimal(800), [Decimal(800)])
+    assert cache.get('a', 1, user_data, Decimal(1999), compute) == (Decimal(1999), [Decimal(1999)])
+    assert cache.get('a', 1, user_data, Decimal(1500), compute) == (Decimal(1500), [Decimal(1500)])
+    assert cache.get('a', 1, user_data, Decimal(1999), compute) == (Decimal(1999), [Decimal(1999)])
+    assert computed == [800, 1999, 1500]
+
+
+def test_buy_next_view_sub_bucket(client):
+    response = client.get('/buy_next?cash=800')
+    assert response.json['cash'] == '800.00'
+    assert response.json['purchases']
+    assert sum(Decimal(purchase['amount']) for purchase in response.json['purchases']) <= 800
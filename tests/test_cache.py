@@ -0,0 +1,38 @@
+from datetime import datetime
+
+import db
+import weightsets
+from cache import SnapshotCache
+
+
+def save_prices(conn, price):
+    db.insert_snapshot(conn.cursor(), datetime.utcnow(), 'test',
+                       {'RACEA': {'price': price, 'lotsize': 10}, 'RACEB': {'price': 150, 'lotsize': 10}})
+    conn.commit()
+
+
+def test_manager_built_on_old_snapshot_is_not_cached(conn, monkeypatch):
+    cursor = conn.cursor()
+    db.add_new_tickers(cursor, {'RACEA': 'Акция A', 'RACEB': 'Акция B'})
+    weightsets.ingest(cursor, 'race', [('RACEA', '60', None), ('RACEB', '40', None)])
+    save_prices(conn, 250)
+    cache = SnapshotCache()
+    cache.refresh(cursor)
+    fetch_weights = db.fetch_weights
+
+    def fetch_weights_during_refresh(cursor, name):
+        # пока запрос читает веса, другой поток видит новый снимок
+        save_prices(conn, 300)
+        cache.refresh(conn.cursor())
+        return fetch_weights(cursor, name)
+
+    monkeypatch.setattr(db, 'fetch_weights', fetch_weights_during_refresh)
+    stale = cache.weight_manager(cursor, 'race')
+    assert stale.weights['RACEA'].price == 250
+    assert 'race' not in cache.managers
+    assert 'race' not in cache.weights
+
+    monkeypatch.setattr(db, 'fetch_weights', fetch_weights)
+    fresh = cache.weight_manager(cursor, 'race')
+    assert fresh.weights['RACEA'].price == 300
+    assert cache.weight_manager(cursor, 'race') is fresh
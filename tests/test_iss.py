@@ -0,0 +1,50 @@
+import os
+from collections import Counter
+
+import pytest
+
+import db
+import iss
+from conftest import ROOT
+
+EXAMPLE = os.path.join(ROOT, 'securities-example.json')
+SEQNUM = 20230526235957
+# маленькие блоки режут строки JSON и escape-последовательности в любом месте
+CHUNK_SIZES = [1, 2, 7, 64, 1000, iss.CHUNK_SIZE]
+
+
+def open_example():
+    return open(EXAMPLE, encoding='utf-8')
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_block_reader(chunk_size):
+    with open_example() as fp:
+        rows = list(iss.BlockReader(fp, chunk_size).rows())
+    assert len(rows) == 493
+    assert Counter(block for block, _, _ in rows) == {'securities': 246, 'marketdata': 246, 'dataversion': 1}
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_parse(chunk_size):
+    with open_example() as fp:
+        seqnum, names, price_map = iss.parse(fp, chunk_size)
+    assert seqnum == SEQNUM
+    assert len(names) == 246
+    assert len(price_map) == 246
+    assert all(attr['price'] > 0 and attr['lotsize'] > 0 for attr in price_map.values())
+    with open_example() as fp:
+        assert iss.parse(fp) == (seqnum, names, price_map)
+
+
+def test_ingest_same_seqnum_is_noop(conn):
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM meta WHERE key = ?', (iss.SEQNUM_KEY,))
+    conn.commit()
+    with open_example() as fp:
+        assert iss.ingest(conn, fp, chunk_size=7)
+    assert db.fetch_meta(cursor, iss.SEQNUM_KEY) == SEQNUM
+    version = db.fetch_snapshot_version(cursor)
+    with open_example() as fp:
+        assert not iss.ingest(conn, fp)
+    assert db.fetch_snapshot_version(cursor) == version
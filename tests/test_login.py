@@ -0,0 +1,38 @@
+import pyotp
+
+import application
+import db
+from users import User
+
+
+def login(client, email):
+    client.post('/login', data={'email': email})
+    conn = db.get_sqlite_connection()
+    user = User(conn, email, db.MAIN_PORTFOLIO)
+    # у нового пользователя есть портфель с тем же именем,
+    # что выбрал в сессии прошлый пользователь этого браузера
+    user.add_portfolio('ИИС', 100000, 'MOEX 2022')
+    conn.commit()
+    code = pyotp.TOTP(user._get_secret()).now()
+    conn.close()
+    with client.session_transaction() as session:
+        session['portfolio'] = 'ИИС'
+    return client.post('/login', data={'email': email, 'code': code})
+
+
+def test_login_and_logout_reset_portfolio(conn):
+    client = application.app.test_client()
+    with client.session_transaction() as session:
+        session['email'] = 'old@example.com'
+    response = login(client, 'new@example.com')
+    assert 'Login success' in response.get_data(as_text=True)
+    with client.session_transaction() as session:
+        assert session['email'] == 'new@example.com'
+        assert 'portfolio' not in session
+
+    with client.session_transaction() as session:
+        session['portfolio'] = 'ИИС'
+    client.get('/logout')
+    with client.session_transaction() as session:
+        assert 'email' not in session
+        assert 'portfolio' not in session
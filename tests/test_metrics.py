@@ -0,0 +1,49 @@
+import sys
+import threading
+
+import pytest
+
+import application
+import metrics
+
+
+def test_overlapping_profilers_restore_switch_interval():
+    original = sys.getswitchinterval()
+    first = metrics.Profiler(interval=0.002).start()
+    second = metrics.Profiler(thread_id=threading.get_ident(), interval=0.001).start()
+    assert sys.getswitchinterval() == 0.0005
+    # первый остановился раньше второго: второму интервал всё ещё нужен
+    first.stop()
+    assert sys.getswitchinterval() == 0.0005
+    second.stop()
+    assert sys.getswitchinterval() == original
+    assert metrics.active_profilers == 0
+
+
+def test_stop_twice():
+    original = sys.getswitchinterval()
+    profiler = metrics.Profiler().start()
+    profiler.stop()
+    profiler.stop()
+    assert sys.getswitchinterval() == original
+    assert metrics.active_profilers == 0
+
+
+@pytest.mark.parametrize('path', ['/metrics', '/cache_stats'])
+def test_metrics_disabled_by_default(client, path):
+    assert client.get(path).status_code == 404
+
+
+@pytest.mark.parametrize('path', ['/metrics', '/cache_stats'])
+def test_metrics_enabled(client, monkeypatch, path):
+    monkeypatch.setattr(application, 'METRICS_ENABLED', True)
+    assert client.get(path).status_code == 200
+
+
+@pytest.mark.parametrize('path', ['/metrics', '/cache_stats'])
+def test_metrics_token(client, monkeypatch, path):
+    monkeypatch.setattr(application, 'METRICS_ENABLED', True)
+    monkeypatch.setattr(application, 'METRICS_TOKEN', 'secret')
+    assert client.get(path).status_code == 404
+    assert client.get(path, headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    assert client.get(path, headers={'Authorization': 'Bearer secret'}).status_code == 200
@@ -0,0 +1,55 @@
+"""PATCH из htmx отвечает только изменёнными строками (hx-swap-oob)."""
+import re
+
+import pytest
+
+HTMX = {'Hx-Request': 'true'}
+
+
+def patch(client, layout, data):
+    client.set_cookie('layout', layout)
+    # первый GET кладёт портфель в BriefcaseCache
+    client.get('/')
+    response = client.patch('/', data=data, headers=HTMX)
+    assert response.status_code == 200
+    assert response.headers['HX-Reswap'] == 'none'
+    html = response.get_data(as_text=True)
+    assert '<table' not in html
+    return html
+
+
+def oob_ids(html):
+    return re.findall(r'<tr id="([^"]+)"[^>]*hx-swap-oob="true"', html)
+
+
+@pytest.mark.parametrize('layout, ids', [
+    ('desktop', ['row-SBER', 'row-SBERP']),
+    ('mobile', ['name-SBER', 'row-SBER', 'name-SBERP', 'row-SBERP']),
+])
+def test_set_count_updates_pair(client, layout, ids):
+    # процент выполнения плана у пары общий: меняется и строка SBERP
+    html = patch(client, layout, {'SBER': '110'})
+    assert oob_ids(html) == ids
+    assert 'id="fact-sum" hx-swap-oob="true"' in html
+    assert 'value="110"' in html
+
+
+def test_set_count_single(client):
+    html = patch(client, 'desktop', {'LKOH': '5'})
+    assert oob_ids(html) == ['row-LKOH']
+
+
+def test_toggle_fav_desktop(client):
+    html = patch(client, 'desktop', {'toggle_fav': 'LKOH'})
+    assert oob_ids(html) == ['row-LKOH']
+    assert re.search(r'<tr id="row-LKOH" class="fav"', html)
+
+    html = patch(client, 'desktop', {'toggle_fav': 'LKOH'})
+    assert re.search(r'<tr id="row-LKOH" class=""', html)
+
+
+def test_toggle_fav_mobile(client):
+    html = patch(client, 'mobile', {'toggle_fav': 'LKOH'})
+    assert oob_ids(html) == ['name-LKOH', 'row-LKOH']
+    name_row = html[html.index('id="name-LKOH"'):html.index('id="row-LKOH"')]
+    assert 'class="first fav"' in name_row
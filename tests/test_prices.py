@@ -0,0 +1,85 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import db
+
+T0 = datetime(2026, 3, 2, 10, 0)
+
+
+@pytest.fixture
+def cursor():
+    # отдельная база: свежесть считается от самого нового снимка во всей базе
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    db.init_sqlite(cursor)
+    yield cursor
+    conn.close()
+
+
+def prices(**units):
+    return {ticker: {'price': price, 'lotsize': 10} for ticker, price in units.items()}
+
+
+def test_resolve_priority():
+    candidates = [('moex', 2, T0, 100, 10), ('tinkoff', 1, T0 - timedelta(hours=1), 101, 10)]
+    assert db.resolve(candidates, T0) == (candidates[1], False)
+
+
+def test_resolve_stale_falls_back():
+    candidates = [('tinkoff', 1, T0 - timedelta(hours=100), 101, 10), ('moex', 2, T0, 100, 10)]
+    assert db.resolve(candidates, T0) == (candidates[1], False)
+    # у manual свой срок, неделя
+    manual = ('manual', 3, T0 - timedelta(hours=100), 99, 10)
+    assert db.resolve(candidates + [manual], T0) == (manual, False)
+
+
+def test_resolve_all_stale():
+    candidates = [('tinkoff', 1, T0 - timedelta(hours=100), 101, 10),
+                  ('moex', 2, T0 - timedelta(hours=80), 100, 10)]
+    assert db.resolve(candidates, T0 + timedelta(hours=1)) == (candidates[1], True)
+
+
+def test_higher_priority_source_wins(cursor):
+    db.insert_snapshot(cursor, T0, 'tinkoff', prices(SBER=250.5))
+    db.insert_snapshot(cursor, T0 + timedelta(hours=1), 'moex', prices(SBER=251))
+    result = db.fetch_last_prices(cursor)
+    assert result['SBER']['price'] == 250.5
+    assert result['SBER']['source'] == 'tinkoff'
+    assert not result['SBER']['stale']
+
+
+def test_stale_price_falls_back_to_fresher_source(cursor):
+    db.insert_snapshot(cursor, T0, 'tinkoff', prices(SBER=250.5, GAZP=150))
+    db.insert_snapshot(cursor, T0 + timedelta(hours=100), 'moex', prices(SBER=260))
+    result = db.fetch_last_prices(cursor)
+    assert (result['SBER']['price'], result['SBER']['source'], result['SBER']['stale']) == (260, 'moex', False)
+    # свежей цены GAZP нет ни у кого: последняя известная, помеченная устаревшей
+    assert (result['GAZP']['price'], result['GAZP']['source'], result['GAZP']['stale']) == (150, 'tinkoff', True)
+
+
+def test_partial_snapshot_keeps_other_prices(cursor):
+    db.insert_snapshot(cursor, T0, 'tinkoff', prices(SBER=250.5, GAZP=150, LKOH=7000))
+    db.insert_snapshot(cursor, T0 + timedelta(hours=1), 'tinkoff', prices(SBER=252))
+    db.insert_snapshot(cursor, T0 + timedelta(hours=2), 'moex', prices(GAZP=151))
+    result = db.fetch_last_prices(cursor)
+    assert {ticker: attr['price'] for ticker, attr in result.items()} == {
+        'SBER': 252, 'GAZP': 150, 'LKOH': 7000}
+    assert {attr['source'] for attr in result.values()} == {'tinkoff'}
+
+
+def test_older_snapshot_does_not_override(cursor):
+    # снимок, записанный позже, но с более старым dt
+    db.insert_snapshot(cursor, T0 + timedelta(hours=1), 'tinkoff', prices(SBER=252))
+    db.insert_snapshot(cursor, T0, 'tinkoff', prices(SBER=250.5))
+    assert db.fetch_last_prices(cursor)['SBER']['price'] == 252
+
+
+def test_rebuild_matches_incremental(cursor):
+    db.insert_snapshot(cursor, T0, 'tinkoff', prices(SBER=250.5, GAZP=150))
+    db.insert_snapshot(cursor, T0 + timedelta(hours=100), 'moex', prices(SBER=260, LKOH=7000))
+    db.insert_snapshot(cursor, T0 + timedelta(hours=101), 'manual', prices(GAZP=149))
+    expected = db.fetch_last_prices(cursor)
+    db.rebuild_source_prices(cursor)
+    assert db.fetch_last_prices(cursor) == expected
@@ -0,0 +1,62 @@
+"""Сколько SQL-запросов делает каждый endpoint (заголовок X-Query-Count)."""
+import pytest
+
+import db
+
+HTMX = {'Hx-Request': 'true'}
+
+
+def query_count(response) -> int:
+    assert response.status_code == 200, response.get_data(as_text=True)[:500]
+    return int(response.headers['X-Query-Count'])
+
+
+@pytest.fixture
+def statements(monkeypatch):
+    # тексты запросов последнего запроса к приложению
+    counters = []
+
+    class KeepingCounter(db.QueryCounter):
+        __slots__ = []
+
+        def __init__(self):
+            super().__init__(keep=True)
+            counters.append(self)
+
+    monkeypatch.setattr(db, 'QueryCounter', KeepingCounter)
+    return lambda: counters[-1].statements
+
+
+def test_warm_index(client):
+    client.get('/')
+    # пользователь, его позиции с флагами и версия снимка
+    assert query_count(client.get('/')) <= 3
+
+
+def test_patch_commits_once(client, statements):
+    client.get('/')
+    response = client.patch('/', data={'SBER': '110', 'capital': '2000000', 'toggle_fav': 'LKOH'},
+                            headers=HTMX)
+    assert query_count(response) <= 8
+    assert [statement for statement in statements() if statement.strip() == 'COMMIT'] == ['COMMIT']
+
+
+def test_patch_single_count(client, statements):
+    client.get('/')
+    assert query_count(client.patch('/', data={'SBER': '120'}, headers=HTMX)) <= 6
+    assert sum(statement.strip() == 'COMMIT' for statement in statements()) == 1
+
+
+def test_buy_next(client, statements):
+    client.get('/')
+    assert query_count(client.get('/buy_next?cash=5000')) <= 3
+    assert query_count(client.get('/buy_next?cash=5000')) <= 3
+    assert 'COMMIT' not in [statement.strip() for statement in statements()]
+
+
+def test_refresh_status(client, conn):
+    since = db.fetch_last_snapshot_id(conn.cursor())
+    assert query_count(client.get('/refresh_status')) <= 1
+    response = client.get(f'/refresh_status?since={since}&failures=0')
+    assert response.status_code == 204
+    assert int(response.headers['X-Query-Count']) <= 1
@@ -0,0 +1,69 @@
+import threading
+import time
+from datetime import datetime
+
+import application
+import db
+from refresher import Refresher
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class BrokenRefresher(Refresher):
+    # is_due падает, как при "database is locked"
+    __slots__ = []
+
+    def is_due(self):
+        raise RuntimeError('database is locked')
+
+
+def test_loop_survives_errors(tmp_path, conn):
+    ran = threading.Event()
+    refresher = BrokenRefresher(job=lambda conn: ran.set(), interval=0.01, idle_interval=0.01,
+                                lock_filename=str(tmp_path / 'lock'))
+    refresher.start()
+    try:
+        assert wait_for(lambda: refresher.failures >= 3)
+        assert refresher.thread.is_alive()
+        assert 'database is locked' in refresher.last_error
+        refresher.request()
+        assert ran.wait(2)
+    finally:
+        # без интервала цикл ждёт request() и больше ничего не делает
+        refresher.interval = 0
+
+
+def test_refresh_status_follows_snapshots_in_db(conn):
+    client = application.app.test_client()
+    since = db.fetch_last_snapshot_id(conn.cursor())
+    failures = application.refresher.failures
+    url = f'/refresh_status?since={since}&failures={failures}'
+    assert client.get(url).status_code == 204
+    # снимок сохранил другой процесс: счётчики этого не изменились
+    db.insert_snapshot(conn.cursor(), datetime.utcnow(), 'test', {'SBER': {'price': 250.5, 'lotsize': 10}})
+    conn.commit()
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['HX-Refresh'] == 'true'
+    assert client.get('/refresh_status').json['snapshot'] == since + 1
+
+
+def test_refresh_status_stops_on_failure(conn):
+    client = application.app.test_client()
+    since = db.fetch_last_snapshot_id(conn.cursor())
+    failures = application.refresher.failures
+    application.refresher.failures += 1
+    application.refresher.last_error = "ConnectionError('timeout')"
+    try:
+        response = client.get(f'/refresh_status?since={since}&failures={failures}')
+    finally:
+        application.refresher.failures -= 1
+    assert response.status_code == 286
+    assert 'timeout' in response.get_data(as_text=True)
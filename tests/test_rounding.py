@@ -0,0 +1,63 @@
+import random
+from decimal import Decimal
+from fractions import Fraction
+
+import pytest
+
+from conftest import random_portfolio
+from db import PRICE_SCALE, price_to_units, units_to_decimal, units_to_price
+from main import UserBriefcase, div_round
+
+
+def test_div_round_ties():
+    # банковское округление: x.5 — к чётному, в обе стороны от нуля
+    for a, b in [(1, 2), (3, 2), (5, 2), (-1, 2), (-3, 2), (-5, 2), (5, -2), (-5, -2), (7, -2)]:
+        assert div_round(a, b) == round(Fraction(a, b)) == round(a / b), (a, b)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_div_round_random(seed):
+    rnd = random.Random(seed)
+    for _ in range(10000):
+        b = rnd.choice([1, -1]) * rnd.randint(1, 10 ** rnd.randint(1, 18))
+        # каждое третье a — ровно посередине между кратными b
+        if rnd.random() < 1 / 3 and b % 2 == 0:
+            a = rnd.randint(-10 ** 6, 10 ** 6) * b + b // 2
+        else:
+            a = rnd.randint(-10 ** 24, 10 ** 24)
+        assert div_round(a, b) == round(Fraction(a, b)), (a, b)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_price_units_round_trip(seed):
+    rnd = random.Random(seed)
+    for _ in range(10000):
+        units = rnd.randint(0, 10 ** 6 * PRICE_SCALE)
+        assert price_to_units(units_to_decimal(units)) == units
+        assert price_to_units(units_to_price(units)) == units
+        # цена из ISS: float не больше чем с PRICE_DIGITS знаками
+        text = f'{rnd.randint(0, 10 ** 6)}.{rnd.randint(0, PRICE_SCALE - 1):06d}'
+        assert price_to_units(float(text)) == price_to_units(Decimal(text))
+        assert units_to_decimal(price_to_units(Decimal(text))) == Decimal(text)
+
+
+def decimal_lot_counts(ub):
+    # план прежнего движка на Decimal: round(weight / weights_sum * capital / lotprice)
+    weights_sum = Decimal(ub.weights_sum)
+    return {we.ticker: round(Decimal(we.weight_bp) / weights_sum * ub.capital / we.lotprice)
+            for we in ub.all}
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_plans_match_decimal_engine(seed):
+    weight_manager, ignored, briefcase, capital = random_portfolio(random.Random(seed))
+    ub = UserBriefcase(weight_manager, ignored, [], capital, briefcase)
+    expected = decimal_lot_counts(ub)
+    for we in ub.all:
+        lots = Fraction(we.weight_bp * ub.capital_units, ub.weights_sum * we.lotprice_units)
+        plan = ub.plans[we.ticker]
+        assert plan.count == round(lots) * we.lotsize, we.ticker
+        assert plan.amount == round(lots) * we.lotprice, we.ticker
+        # на точной середине Decimal с 28 знаками может ошибиться в последнем знаке
+        if lots.denominator != 2:
+            assert plan.count == expected[we.ticker] * we.lotsize, we.ticker
@@ -0,0 +1,63 @@
+import random
+from fractions import Fraction
+
+import pytest
+
+import solver
+from conftest import random_portfolio
+from main import UserBriefcase
+
+
+def briefcases(seed):
+    weight_manager, ignored, briefcase, capital = random_portfolio(random.Random(seed))
+    return (UserBriefcase(weight_manager, ignored, [], capital, briefcase),
+            UserBriefcase(weight_manager, ignored, [], capital, briefcase, solver='optimal'))
+
+
+def lot_counts(ub):
+    return [ub.plans[we.ticker].count // we.lotsize for we in ub.all]
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_optimal_within_capital(seed):
+    _, optimal = briefcases(seed)
+    spent = sum(lots * we.lotprice_units for lots, we in zip(lot_counts(optimal), optimal.all))
+    assert spent <= optimal.capital_units
+    assert all(lots >= 0 for lots in lot_counts(optimal))
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_optimal_not_worse_than_round(seed):
+    rounded, optimal = briefcases(seed)
+    assert optimal.tracking_error <= rounded.tracking_error + 1e-12
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_round_matches_old_output(seed):
+    # прежний расчёт: каждая акция отдельно, round(weight / weights_sum * capital / lotprice)
+    rounded, _ = briefcases(seed)
+    for we in rounded.all:
+        lots = round(Fraction(we.weight_bp * rounded.capital_units,
+                              rounded.weights_sum * we.lotprice_units))
+        assert rounded.plans[we.ticker] == (lots * we.lotsize, lots * we.lotprice), we.ticker
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_pair_group_is_one_target(seed):
+    # две акции одной группы по одной цене ведут себя как одна акция с их общим весом
+    rnd = random.Random(seed)
+    price, other = rnd.randint(1, 10 ** 4), rnd.randint(1, 10 ** 4)
+    first, second, rest = rnd.randint(1, 50), rnd.randint(1, 50), rnd.randint(1, 100)
+    capital = rnd.randint(10 ** 4, 10 ** 7)
+    pair = solver.allocate_lots([first, second, rest], [price, price, other], [0, 0, 2], capital)
+    single = solver.allocate_lots([first + second, rest], [price, other], [0, 1], capital)
+    assert pair[0] + pair[1] == single[0]
+    assert pair[2] == single[1]
+
+
+def test_pair_members_share_deviation():
+    # перебор одной акции пары покрывает недобор другой
+    lots = solver.allocate_lots([50, 50], [100, 100], [0, 0], 1000)
+    assert sum(lots) == 10
+    assert solver.tracking_error([50, 50], [100, 100], [0, 0], 1000, [10, 0]) == 0
+    assert solver.tracking_error([50, 50], [100, 100], [0, 1], 1000, [10, 0]) > 0
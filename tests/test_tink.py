@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+from fake_tinkoff import FakeClient
+
+pytest.importorskip('tinkoff.invest')  # tink.py импортирует его при загрузке
+import tink  # noqa: E402
+
+NOW = datetime(2026, 3, 2, 12, 0)
+INSTRUMENTS = {'SBER': (Decimal('250.13'), 10), 'GAZP': (Decimal('0.000135'), 10000),
+               'LKOH': (Decimal('-1.5'), 1)}
+
+
+@pytest.fixture
+def cursor(conn):
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM instruments')
+    return cursor
+
+
+def test_get_shares_and_prices(cursor):
+    with FakeClient(INSTRUMENTS) as client:
+        shares = tink.get_shares(client, ['SBER', 'GAZP', 'LKOH'], cursor, NOW)
+        prices = {share.ticker: (price, share.lot) for share, price in tink.get_prices(client, shares)}
+    assert prices == INSTRUMENTS
+    assert client.calls == ['shares', 'get_last_prices']
+
+
+def test_instruments_cache(cursor):
+    with FakeClient(INSTRUMENTS) as client:
+        tink.get_shares(client, ['SBER', 'GAZP', 'UNKNOWN'], cursor, NOW)
+        # найденные и ненайденные тикеры берутся из instruments
+        shares = tink.get_shares(client, ['SBER', 'GAZP', 'UNKNOWN'], cursor, NOW + timedelta(hours=1))
+    assert client.calls == ['shares']
+    assert sorted(share.ticker for share in shares.values()) == ['GAZP', 'SBER']
+
+    with FakeClient(INSTRUMENTS) as client:
+        # нового тикера в кеше нет: один запрос списка
+        tink.get_shares(client, ['SBER', 'LKOH'], cursor, NOW + timedelta(hours=1))
+    assert client.calls == ['shares']
+
+
+def test_instruments_expire(cursor):
+    with FakeClient(INSTRUMENTS) as client:
+        tink.get_shares(client, ['SBER', 'UNKNOWN'], cursor, NOW)
+    # после сплита лот изменился, а UNKNOWN начали торговать
+    later = NOW + timedelta(hours=tink.INSTRUMENTS_TTL_HOURS + 1)
+    with FakeClient({'SBER': (Decimal('25.01'), 100), 'UNKNOWN': (Decimal(1), 1)}) as client:
+        shares = tink.get_shares(client, ['SBER', 'UNKNOWN'], cursor, later)
+    assert client.calls == ['shares']
+    assert {share.ticker: share.lot for share in shares.values()} == {'SBER': 100, 'UNKNOWN': 1}
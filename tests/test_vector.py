@@ -0,0 +1,111 @@
+import random
+from fractions import Fraction
+
+import pytest
+
+from conftest import random_portfolio
+from main import PAIRS_DICT, UserBriefcase, WeightManager
+from vector import VectorBriefcase
+
+
+def near_tie(ub, ticker):
+    # число лотов по плану ровно x.5: float в VectorBriefcase может округлить иначе
+    we = next(we for we in ub.all if we.ticker == ticker)
+    if not we.lotprice_units:
+        return False
+    lots = Fraction(we.weight_bp * ub.capital_units, ub.weights_sum * we.lotprice_units)
+    return abs(lots - round(lots) - Fraction(1, 2)) < Fraction(1, 10 ** 6) \
+        or abs(lots - round(lots) + Fraction(1, 2)) < Fraction(1, 10 ** 6)
+
+
+def briefcases(portfolio, solver='round'):
+    weight_manager, ignored, briefcase, capital = portfolio
+    return (UserBriefcase(weight_manager, ignored, [], capital, dict(briefcase), solver),
+            VectorBriefcase(weight_manager, ignored, [], capital, dict(briefcase), solver))
+
+
+@pytest.mark.parametrize('solver', ['round', 'optimal'])
+def test_plans(portfolio, solver):
+    ub, vb = briefcases(portfolio, solver)
+    assert [we.ticker for we in vb.all] == [we.ticker for we in ub.all]
+    for ticker, plan in ub.plans.items():
+        if near_tie(ub, ticker):
+            continue
+        assert vb.plans[ticker].count == plan.count, ticker
+        assert vb.plans[ticker].amount == pytest.approx(plan.amount, abs=0.01), ticker
+
+
+def test_facts(portfolio):
+    ub, vb = briefcases(portfolio)
+    for ticker, fact in ub.facts.items():
+        assert vb.facts[ticker].count == fact.count, ticker
+        assert vb.facts[ticker].amount == pytest.approx(fact.amount, abs=0.01), ticker
+    assert vb.user_amount_sum == pytest.approx(ub.user_amount_sum, abs=0.01)
+
+
+def test_percents(portfolio):
+    ub, vb = briefcases(portfolio)
+    if any(near_tie(ub, ticker) for ticker in ub.plans):
+        pytest.skip('plan on a rounding tie')
+    for ticker in ub.plans:
+        assert vb.get_in_percent(ticker) == pytest.approx(float(ub.get_in_percent(ticker)), abs=1e-9)
+        assert vb.percent_of_total(ticker) == pytest.approx(float(ub.percent_of_total(ticker)), abs=1e-9)
+
+
+def test_pairs_share_percent(portfolio):
+    # у парных акций процент выполнения плана общий на пару
+    ub, vb = briefcases(portfolio)
+    for ticker, pair in PAIRS_DICT.items():
+        present = [_ticker for _ticker in pair if _ticker in vb.plans]
+        if ticker in vb.plans and len(present) == 2:
+            assert vb.get_in_percent(pair[0]) == vb.get_in_percent(pair[1])
+            assert float(ub.get_in_percent(pair[0])) == pytest.approx(vb.get_in_percent(pair[1]), abs=1e-9)
+
+
+def test_set_count_and_capital(portfolio):
+    ub, vb = briefcases(portfolio)
+    for ticker in PAIRS_DICT:
+        if ticker in ub.facts:
+            assert vb.set_count(ticker, 7) == ub.set_count(ticker, 7)
+    ub.set_capital(ub.capital * 2)
+    vb.set_capital(vb.capital * 2)
+    if any(near_tie(ub, ticker) for ticker in ub.plans):
+        pytest.skip('plan on a rounding tie')
+    for ticker in ub.plans:
+        assert vb.plans[ticker].count == ub.plans[ticker].count, ticker
+        assert vb.facts[ticker].count == ub.facts[ticker].count, ticker
+        assert vb.get_in_percent(ticker) == pytest.approx(float(ub.get_in_percent(ticker)), abs=1e-9)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_zero_lotprice(seed):
+    # цена 0 или лот 0: 0 лотов в обоих движках, без переполнения int64
+    weight_manager, ignored, briefcase, capital = random_portfolio(random.Random(seed))
+    prices = {ticker: dict(attr) for ticker, attr in weight_manager.prices.items()}
+    prices['SBER']['price'] = 0
+    prices['GAZP']['lotsize'] = 0
+    portfolio = WeightManager(weight_manager.names, prices, weight_manager.weights_map), [], briefcase, capital
+    for solver in ('round', 'optimal'):
+        ub, vb = briefcases(portfolio, solver)
+        assert ub.plans['SBER'].count == vb.plans['SBER'].count == 0
+        assert ub.plans['GAZP'].count == vb.plans['GAZP'].count == 0
+        for ticker, plan in ub.plans.items():
+            if not near_tie(ub, ticker):
+                assert vb.plans[ticker].count == plan.count, ticker
+        for ticker in ub.plans:
+            assert vb.get_in_percent(ticker) == pytest.approx(float(ub.get_in_percent(ticker)), abs=1e-9)
+
+
+def test_only_zero_weights():
+    # в стратегии всё игнорируется, куплены только акции вне её: weights_sum == 0
+    weight_manager, _, _, _ = random_portfolio(random.Random(0))
+    weights_map = {ticker: weight for ticker, weight in weight_manager.weights_map.items() if ticker != 'YNDX'}
+    weight_manager = WeightManager(weight_manager.names, weight_manager.prices, weights_map)
+    ignored = list(weight_manager.weights)
+    other = 'YNDX'
+    briefcase = {other: 3}
+    ub = UserBriefcase(weight_manager, ignored, [], 10 ** 6, briefcase)
+    vb = VectorBriefcase(weight_manager, ignored, [], 10 ** 6, briefcase)
+    assert [we.ticker for we in ub.all] == [other]
+    assert ub.plans[other].count == vb.plans[other].count == 0
+    assert vb.facts[other].count == 3
@@ -0,0 +1,109 @@
+import random
+import sqlite3
+from decimal import Decimal
+
+import pytest
+
+import db
+import weightsets
+from main import weight_to_bp
+
+
+@pytest.fixture
+def cursor():
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    db.init_sqlite(cursor)
+    db.add_new_tickers(cursor, {'SBER': 'Сбербанк', 'GAZP': 'Газпром', 'LKOH': 'Лукойл'})
+    yield cursor
+    conn.close()
+
+
+def problems(rows, known=frozenset({'SBER', 'GAZP', 'LKOH'})):
+    with pytest.raises(weightsets.WeightsError) as error:
+        weightsets.validate(rows, set(known))
+    return error.value.problems
+
+
+def test_parse_json_keeps_duplicate_keys():
+    rows = weightsets.parse('{"SBER": 10, "GAZP": 5, "SBER": 20}')
+    assert rows == [('SBER', 10, None), ('GAZP', 5, None), ('SBER', 20, None)]
+    assert problems(rows) == ['SBER: duplicate']
+
+
+def test_duplicate_after_normalizing_case():
+    assert problems([('sber', '10', None), (' SBER ', '5', None)]) == ['SBER: duplicate']
+
+
+def test_parse_errors():
+    with pytest.raises(weightsets.WeightsError):
+        weightsets.parse('{"SBER": 10,')
+    with pytest.raises(weightsets.WeightsError):
+        weightsets.parse('SBER 10')
+
+
+def test_unknown_tickers_rejected():
+    assert problems([('SBER', '10', None), ('XXXX', '5', None)]) == ['XXXX: unknown ticker']
+    # строка TSV с названием добавляет новую акцию
+    weights, names = weightsets.validate([('XXXX', '5', 'Новая')], {'SBER'})
+    assert weights == {'XXXX': Decimal(5)} and names == {'XXXX': 'Новая'}
+
+
+@pytest.mark.parametrize('weight', ['0', '-1', 'abc', 'NaN', 'Infinity'])
+def test_bad_weights_rejected(weight):
+    assert problems([('SBER', weight, None)]) == [f'SBER: weight must be a positive number, got {weight!r}']
+
+
+def test_normalize_largest_remainder():
+    # по 3333.33 bp: лишний пункт достаётся первому по тикеру при равных остатках
+    assert weightsets.normalize({'SBER': Decimal(1), 'GAZP': Decimal(1), 'LKOH': Decimal(1)}) == {
+        'GAZP': 3334, 'LKOH': 3333, 'SBER': 3333}
+    # 16.666.. / 33.333.. / 50: наибольшие дробные части у первых двух
+    assert weightsets.normalize({'SBER': Decimal(1), 'GAZP': Decimal(2), 'LKOH': Decimal(3)}) == {
+        'SBER': 1667, 'GAZP': 3333, 'LKOH': 5000}
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_normalize_sums_to_total(seed):
+    rnd = random.Random(seed)
+    weights = {f'T{i}': Decimal(rnd.randint(1, 10 ** 6)) / 1000 for i in range(rnd.randint(1, 300))}
+    try:
+        result = weightsets.normalize(weights)
+    except weightsets.WeightsError:
+        return
+    assert sum(result.values()) == weightsets.TOTAL_BP
+    total = sum(weights.values())
+    for ticker, bp in result.items():
+        exact = weights[ticker] * weightsets.TOTAL_BP / total
+        assert abs(bp - exact) < 1
+
+
+def test_normalize_rejects_tiny_weights():
+    with pytest.raises(weightsets.WeightsError):
+        weightsets.normalize({'SBER': Decimal(100000), 'GAZP': Decimal('0.001')})
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_pack_round_trip(seed):
+    rnd = random.Random(seed)
+    weights_bp = {f'T{i}': rnd.randint(1, weightsets.TOTAL_BP) for i in range(rnd.randint(1, 300))}
+    unpacked = db.unpack_weights(*db.pack_weights(weights_bp))
+    assert {ticker: weight_to_bp(weight) for ticker, weight in unpacked.items()} == weights_bp
+
+
+def test_ingest_same_digest_is_noop(cursor):
+    rows = weightsets.parse('SBER\t60\nGAZP\t30\nLKOH\t10\n')
+    assert weightsets.ingest(cursor, 'test', rows)
+    digest = db.fetch_weights_digest(cursor, 'test')
+    assert db.fetch_weights(cursor, 'test') == {'GAZP': 30.0, 'LKOH': 10.0, 'SBER': 60.0}
+
+    statements = db.QueryCounter(keep=True).attach(cursor.connection)
+    # тот же набор в другом виде: те же базисные пункты и sha256
+    assert not weightsets.ingest(cursor, 'test', weightsets.parse('{"lkoh": 1, "sber": 6, "gazp": 3}'))
+    db.QueryCounter.detach(cursor.connection)
+    assert not [statement for statement in statements.statements
+                if statement.split()[0] in ('INSERT', 'UPDATE', 'DELETE')]
+    assert db.fetch_weights_digest(cursor, 'test') == digest
+
+    assert weightsets.ingest(cursor, 'test', weightsets.parse('{"SBER": 50, "GAZP": 50}'))
+    assert db.fetch_weights_digest(cursor, 'test') != digest
@@ -1,26 +1,55 @@
 import json
+from collections import namedtuple
+from datetime import datetime, timedelta
 
 from tinkoff.invest import Client
-from tinkoff.invest.grpc.instruments_pb2 import INSTRUMENT_ID_TYPE_TICKER
 from tinkoff.invest.utils import quotation_to_decimal
 
+import db
+import settings
+from metrics import timed
 from settings import TINKOFF_TOKEN
 
 TOKEN = TINKOFF_TOKEN
 CLASS_CODE = 'TQBR'
 TICKERS = ['SBER', 'MOEX', 'ROSN', 'GMKN', 'LKOH']
+# через сколько часов figi и лот из instruments запрашиваются заново:
+# лоты меняются после сплитов, а ненайденные тикеры могут появиться
+INSTRUMENTS_TTL_HOURS = getattr(settings, "INSTRUMENTS_TTL_HOURS", 24)
 
+Instrument = namedtuple('Instrument', 'ticker figi lot')
+
+
+@timed('tink.get_shares')
+def get_shares(client, tickers, cursor=None, now=None):
+    # ticker -> figi/lot берём из таблицы instruments, а неизвестные
+    # акции ищем одним запросом instruments.shares() вместо share_by на каждую
+    now = now or datetime.utcnow()
+    known = {}
+    if cursor is not None:
+        known = db.fetch_instruments(cursor, CLASS_CODE, now - timedelta(hours=INSTRUMENTS_TTL_HOURS))
+    shares = [Instrument(ticker, *known[ticker]) for ticker in tickers
+              if ticker in known and known[ticker][0] is not None]
+
+    missing = set(tickers) - set(known)
+    if missing:
+        found = [
+            Instrument(inst.ticker, inst.figi, inst.lot)
+            for inst in client.instruments.shares().instruments
+            if inst.class_code == CLASS_CODE and inst.ticker in missing]
+        not_found = missing - {share.ticker for share in found}
+        if cursor is not None:
+            # ненайденные тоже запоминаем, чтобы не просить весь список на каждом обновлении
+            db.save_instruments(cursor, CLASS_CODE, found + [
+                Instrument(ticker, None, None) for ticker in sorted(not_found)], now)
+        shares.extend(found)
+        if not_found:
+            print('tickers not found', not_found)
 
-def get_shares(client, tickers):
-    # shares = client.instruments.shares()
-    # shares = [inst for inst in shares.instruments if inst.ticker in tickers]
-    shares = [
-        client.instruments.share_by(id_type=INSTRUMENT_ID_TYPE_TICKER, class_code=CLASS_CODE, id=ticker).instrument
-        for ticker in tickers]
-    shares = [inst for inst in shares if inst.ticker in tickers]
     return {share.figi: share for share in shares}
 
 
+@timed('tink.get_prices')
 def get_prices(client, shares, ):
     response = client.market_data.get_last_prices(figi=[share.figi for share in shares.values()])
     result = []
@@ -44,11 +73,12 @@ def main_fun():
     with Client(TOKEN) as client:
         # for acc in client.users.get_accounts().accounts:
         #     print(acc)
-        import db
         import main
         conn = db.get_sqlite_connection()
-        tickers = list(db.fetch_names(conn.cursor()).keys())
-        shares = get_shares(client, tickers)
+        cursor = conn.cursor()
+        tickers = list(db.fetch_names(cursor).keys())
+        shares = get_shares(client, tickers, cursor)
+        conn.commit()
         shares_with_prices = get_prices(client, shares)
         price_map = {
             share.ticker: {'price': float(price), 'lotsize': share.lot}
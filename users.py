@@ -1,43 +1,110 @@
-import json
+import hashlib
+import secrets
 from collections import namedtuple
-from typing import Mapping
 
-import pyotp
+import db
+from metrics import timed
 
-FIELDS = "email is_active is_available secret shares favorites ignored capital weight_name"
+FIELDS = "email is_active is_available secret capital weight_name"
 UserData = namedtuple('UserData', FIELDS)
+PORTFOLIO_FIELDS = ('capital', 'weight_name')
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
 
 
 class User:
-    def __init__(self, conn, email):
+    """
+    Пользователь, загруженный один раз за запрос.
+
+    save/save_portfolio/save_position/toggle_flag только запоминают изменения,
+    flush пишет их одной транзакцией с одним commit.
+
+    Позиции, флаги, капитал и веса относятся к портфелю portfolio;
+    основной портфель (db.MAIN_PORTFOLIO) хранит капитал и веса в users.
+    Несуществующий портфель заменяется основным.
+    """
+
+    def __init__(self, conn, email, portfolio=db.MAIN_PORTFOLIO):
         self.conn = conn
         self.cursor = conn.cursor()
         self.email = email
+        self.dirty = {}
+        self.dirty_portfolio = {}
+        self.dirty_positions = {}
+        self.dirty_flags = {}
         self.user = self._get_user() or self._create_user()
+        self.portfolio = db.MAIN_PORTFOLIO
+        self.portfolio_data = None
+        if portfolio != db.MAIN_PORTFOLIO:
+            row = db.fetch_portfolio(self.cursor, email, portfolio)
+            if row is not None:
+                self.portfolio = portfolio
+                self.portfolio_data = dict(zip(PORTFOLIO_FIELDS, row))
+        self._briefcase = None
 
     def is_available(self) -> bool:
         return self.user.is_available
 
     def save(self, **data):
-
         if not data:
             data = {k: getattr(self.user, k)
                     for k in FIELDS.split() if k != 'email'}
+        self.dirty.update(data)
+        self.user = self.user._replace(**data)
+
+    def save_portfolio(self, **data):
+        # capital и weight_name текущего портфеля
+        if self.portfolio_data is None:
+            self.save(**data)
+        else:
+            self.dirty_portfolio.update(data)
+            self.portfolio_data.update(data)
+
+    def save_position(self, ticker, count):
+        self.dirty_positions[ticker] = count
 
-        keys = ', '.join(f"{k} = ?" for k in data.keys())
-        values = [(json.dumps(val) if isinstance(val, Mapping) else val) for val in data.values()]
-        values.append(self.user.email)
+    def toggle_flag(self, flag, ticker, value: bool):
+        self.dirty_flags[(flag, ticker)] = value
 
-        self.cursor.execute(f'UPDATE users SET {keys} WHERE email=?', values)
-        self.conn.commit()
+    @timed('users.User.flush')
+    def flush(self):
+        if self.dirty:
+            keys = ', '.join(f"{k} = ?" for k in self.dirty.keys())
+            self.cursor.execute(f'UPDATE users SET {keys} WHERE email=?',
+                                [*self.dirty.values(), self.email])
+        if self.dirty_portfolio:
+            db.save_portfolio(self.cursor, self.email, self.portfolio, **self.dirty_portfolio)
+        for ticker, count in self.dirty_positions.items():
+            db.save_position(self.cursor, self.email, ticker, count, self.portfolio)
+        for (flag, ticker), value in self.dirty_flags.items():
+            db.save_flag(self.cursor, self.email, flag, ticker, value, self.portfolio)
+        if self.conn.in_transaction:
+            self.conn.commit()
+        self.dirty = {}
+        self.dirty_portfolio = {}
+        self.dirty_positions = {}
+        self.dirty_flags = {}
 
     def new_secret(self):
+        import pyotp
         user_secret = pyotp.random_base32()
         if not self.is_available():
             self.save(secret=user_secret)
         return user_secret
 
+    def new_api_token(self) -> str:
+        # сам токен показывается один раз, в базе только его хеш
+        token = secrets.token_urlsafe(32)
+        db.save_api_token(self.cursor, self.email, hash_token(token))
+        return token
+
+    def revoke_api_tokens(self):
+        db.delete_api_tokens(self.cursor, self.email)
+
     def check(self, code) -> bool:
+        import pyotp
         user_secret = self._get_secret()
         totp = pyotp.TOTP(user_secret)
         good = totp.now() == code
@@ -47,14 +114,30 @@ class User:
 
     @property
     def briefcase(self):
-        fields = 'shares favorites ignored capital weight_name'.split()
-        row = self.cursor.execute(
-            'SELECT %s FROM users WHERE email=? LIMIT 1' % ', '.join(fields),
-            (self.email,)
-        ).fetchone()
-        return {field: (json.loads(val) if field == 'shares' else val)
-                for field, val in zip(fields, row)}
+        if self._briefcase is None:
+            positions, flags = db.fetch_holdings(self.cursor, self.email, self.portfolio)
+            data = self.portfolio_data or self.user._asdict()
+            self._briefcase = {
+                'shares': positions,
+                'favorites': flags['favorite'],
+                'ignored': flags['ignored'],
+                'capital': data['capital'],
+                'weight_name': data['weight_name'],
+                'portfolio': self.portfolio,
+            }
+        return self._briefcase
+
+    def portfolios(self):
+        return db.fetch_portfolios(self.cursor, self.email)
+
+    def add_portfolio(self, name, capital, weight_name):
+        db.save_portfolio(self.cursor, self.email, name, capital=capital, weight_name=weight_name)
 
+    def delete_portfolio(self, name):
+        if name != db.MAIN_PORTFOLIO:
+            db.delete_portfolio(self.cursor, self.email, name)
+
+    @timed('users.User.load')
     def _get_user(self):
         row = self.cursor.execute(
             'SELECT %s FROM users WHERE email=? LIMIT 1' % ', '.join(FIELDS.split()),
@@ -63,9 +146,12 @@ class User:
         return UserData(*row) if row else None
 
     def _create_user(self):
-        self.cursor.execute('INSERT INTO users (email) VALUES(?)', (self.email,))
-        self.conn.commit()
-        return self._get_user()
+        # RETURNING вместо повторного SELECT; commit сделает flush
+        row = self.cursor.execute(
+            'INSERT INTO users (email) VALUES(?) RETURNING %s' % ', '.join(FIELDS.split()),
+            (self.email,)
+        ).fetchone()
+        return UserData(*row)
 
     def _get_secret(self):
         return self.user.secret
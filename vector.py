@@ -0,0 +1,119 @@
+from decimal import Decimal
+
+import numpy as np
+
+import solver
+from db import PRICE_SCALE
+from main import PAIRS_DICT, Fact, Plan, UserBriefcase
+
+
+def to_kopecks(values):
+    return np.rint(values * 100).astype(np.int64).tolist()
+
+
+def kopecks_to_decimal(kopecks: int) -> Decimal:
+    return Decimal(kopecks).scaleb(-2)
+
+
+class VectorBriefcase(UserBriefcase):
+    """
+    Тот же UserBriefcase, но план, факт и проценты считаются массивами numpy.
+
+    Веса, цены, лоты и количество акций хранятся в выровненных по self.all
+    массивах, а в копейки (Decimal) округляем только при заполнении
+    plans/facts для шаблонов.
+    """
+    tickers: list
+    prices: np.ndarray
+    lotsizes: np.ndarray
+    groups: np.ndarray
+    plan_amounts: np.ndarray
+    fact_amounts: np.ndarray
+    in_percents: dict
+    of_total: dict
+    __slots__ = ['tickers', 'prices', 'lotsizes', 'groups',
+                 'plan_amounts', 'fact_amounts', 'in_percents', 'of_total']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_percents()
+
+    def get_all(self):
+        result = tuple(super().get_all())
+        count = len(result)
+        self.tickers = [we.ticker for we in result]
+        self.prices = np.fromiter(
+            (we.price_units for we in result), dtype=np.float64, count=count) / PRICE_SCALE
+        self.lotsizes = np.fromiter((we.lotsize for we in result), dtype=np.float64, count=count)
+
+        return result
+
+    def pair_groups(self):
+        # парные акции (SBER, SBERP) попадают в одну группу
+        index = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.groups = np.fromiter(
+            (min(index.get(_ticker, i) for _ticker in PAIRS_DICT.get(ticker, (ticker,)))
+             for i, ticker in enumerate(self.tickers)),
+            dtype=np.intp, count=len(self.tickers))
+        return self.groups.tolist()
+
+    def update_plan(self):
+        if self.solver != 'round':
+            super().update_plan()
+            self.plan_amounts = np.fromiter(
+                (self.plans[ticker].amount for ticker in self.tickers),
+                dtype=np.float64, count=len(self.tickers))
+            return
+        groups = self.pair_groups()
+        weights = np.fromiter((we.weight_bp for we in self.all), dtype=np.float64, count=len(self.all))
+        lotprices = self.prices * self.lotsizes
+        # без цены или лота (lotprice 0) — 0 лотов, как в UserBriefcase
+        valid = lotprices > 0 if self.weights_sum else np.zeros(len(self.all), dtype=bool)
+        in_rur = weights / float(self.weights_sum or 1) * float(self.capital)
+        lot_counts = np.where(valid, np.rint(in_rur / np.where(valid, lotprices, 1)), 0)
+        counts = (lot_counts * self.lotsizes).astype(np.int64).tolist()
+        self.plan_amounts = lot_counts * lotprices
+        self.plans = {
+            ticker: Plan(count, kopecks_to_decimal(amount))
+            for ticker, count, amount in zip(self.tickers, counts, to_kopecks(self.plan_amounts))}
+        self.tracking_error = solver.tracking_error(
+            [we.weight_bp for we in self.all], [we.lotprice_units for we in self.all],
+            groups, self.capital_units, lot_counts.astype(np.int64).tolist())
+
+    def update_fact(self):
+        counts = np.fromiter(
+            (self.briefcase.get(ticker, 0) for ticker in self.tickers),
+            dtype=np.float64, count=len(self.tickers))
+        self.fact_amounts = self.prices * counts
+        self.facts = {
+            ticker: Fact(count, kopecks_to_decimal(amount))
+            for ticker, count, amount in zip(
+                self.tickers, counts.astype(np.int64).tolist(), to_kopecks(self.fact_amounts))}
+        self.user_amount_sum = kopecks_to_decimal(to_kopecks(self.fact_amounts.sum()))
+
+    def update_percents(self):
+        size = len(self.tickers)
+        plan_sums = np.bincount(self.groups, weights=self.plan_amounts, minlength=size)[self.groups]
+        fact_sums = np.bincount(self.groups, weights=self.fact_amounts, minlength=size)[self.groups]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            in_percents = np.where((plan_sums != 0) & (fact_sums != 0), fact_sums / plan_sums, 0)
+            of_total = self.fact_amounts / float(self.capital)
+        self.in_percents = dict(zip(self.tickers, in_percents.tolist()))
+        self.of_total = dict(zip(self.tickers, of_total.tolist()))
+
+    def set_count(self, ticker, count):
+        affected = super().set_count(ticker, count)
+        if affected is not None:
+            self.update_fact()
+            self.update_percents()
+        return affected
+
+    def set_capital(self, capital):
+        super().set_capital(capital)
+        self.update_percents()
+
+    def get_in_percent(self, ticker):
+        return self.in_percents[ticker]
+
+    def percent_of_total(self, ticker):
+        return self.of_total[ticker]
@@ -0,0 +1,171 @@
+"""
+Загрузка наборов весов: разбор, проверка, нормировка, компиляция.
+
+    python3 weightsets.py NAME FILE     # weights.txt (ticker<TAB>weight<TAB>short_name) или JSON
+
+Тикеры приводятся к верхнему регистру и должны быть в shares; новые акции
+можно добавить только строкой TSV с названием, как в migrate_weights.
+Повторы тикеров и веса <= 0 — ошибка. Веса нормируются до 100%
+в базисных пунктах: сумма ровно TOTAL_BP, остатки округления достаются
+акциям с наибольшей дробной частью.
+
+Набор хранится в weights_compiled (db.pack_weights) вместе с sha256;
+загрузка набора с тем же хешем ничего не пишет и не сбрасывает кеши.
+"""
+import argparse
+import hashlib
+import json
+import sys
+from decimal import Decimal, InvalidOperation
+
+import db
+
+TOTAL_BP = 100 * 100
+
+
+class WeightsError(ValueError):
+    """Набор не прошёл проверку; problems — все найденные ошибки."""
+
+    def __init__(self, problems):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+
+def parse_json(text) -> list:
+    # object_pairs_hook сохраняет повторы ключей, которые json.loads схлопнул бы
+    try:
+        pairs = json.loads(text, object_pairs_hook=list)
+    except ValueError as e:
+        raise WeightsError([f'invalid JSON: {e}'])
+    if not isinstance(pairs, list) or not all(isinstance(pair, tuple) for pair in pairs):
+        raise WeightsError(['expected {"TICKER": weight, ...}'])
+    return [(ticker, weight, None) for ticker, weight in pairs]
+
+
+def parse_tsv(text) -> list:
+    # ticker<TAB>weight[<TAB>short_name] построчно, пустые строки пропускаются
+    rows = []
+    problems = []
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        fields = line.split('\t')
+        if len(fields) < 2:
+            problems.append(f'line {number}: expected ticker<TAB>weight')
+            continue
+        rows.append((fields[0], fields[1], fields[2].strip() if len(fields) > 2 else None))
+    if problems:
+        raise WeightsError(problems)
+    return rows
+
+
+def parse(text) -> list:
+    if text.lstrip().startswith('{'):
+        return parse_json(text)
+    return parse_tsv(text)
+
+
+def clean_ticker(ticker) -> str:
+    return str(ticker).strip().upper()
+
+
+def validate(rows, known: set):
+    """
+    Строки (ticker, weight, short_name) -> ({ticker: Decimal}, {ticker: short_name})
+    для акций, которых нет в known. Все ошибки собираются в один WeightsError.
+    """
+    weights = {}
+    names = {}
+    problems = []
+    for ticker, weight, short_name in rows:
+        ticker = clean_ticker(ticker)
+        if not ticker:
+            problems.append('empty ticker')
+            continue
+        if ticker in weights:
+            problems.append(f'{ticker}: duplicate')
+            continue
+        try:
+            value = Decimal(str(weight).strip().replace(',', '.'))
+        except InvalidOperation:
+            value = None
+        if value is None or not value.is_finite() or value <= 0:
+            problems.append(f'{ticker}: weight must be a positive number, got {weight!r}')
+            continue
+        weights[ticker] = value
+        if ticker not in known:
+            if short_name:
+                names[ticker] = short_name
+            else:
+                problems.append(f'{ticker}: unknown ticker')
+    if not weights and not problems:
+        problems.append('empty weight set')
+    if problems:
+        raise WeightsError(problems)
+    return weights, names
+
+
+def normalize(weights) -> dict:
+    # {ticker: Decimal} -> {ticker: базисные пункты}, сумма ровно TOTAL_BP
+    total = sum(weights.values())
+    exact = {ticker: weight * TOTAL_BP / total for ticker, weight in weights.items()}
+    result = {ticker: int(value) for ticker, value in exact.items()}
+    rest = TOTAL_BP - sum(result.values())
+    for ticker in sorted(exact, key=lambda ticker: (result[ticker] - exact[ticker], ticker))[:rest]:
+        result[ticker] += 1
+    too_small = [ticker for ticker, bp in result.items() if not bp]
+    if too_small:
+        raise WeightsError([f'{ticker}: weight below 0.01%' for ticker in sorted(too_small)])
+    return result
+
+
+def digest(weights_bp) -> str:
+    tickers, packed = db.pack_weights(weights_bp)
+    return hashlib.sha256(tickers.encode() + b'\0' + packed).hexdigest()
+
+
+def ingest(cursor, name, rows) -> bool:
+    """
+    Проверяет и сохраняет набор name без commit.
+    False — набор не изменился и ничего не записано.
+    """
+    known = db.fetch_known_tickers(cursor, {clean_ticker(row[0]) for row in rows})
+    weights, names = validate(rows, known)
+    weights_bp = normalize(weights)
+    content_hash = digest(weights_bp)
+    if db.fetch_weights_digest(cursor, name) == content_hash:
+        return False
+    if names:
+        db.add_new_tickers(cursor, names)
+    db.save_weights(cursor, name, weights_bp, content_hash)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Validate, normalize and store a weight set')
+    parser.add_argument('name', help='weight set name')
+    parser.add_argument('file', help='weights.txt-style TSV or JSON')
+    args = parser.parse_args(argv)
+
+    with open(args.file, encoding='utf-8') as fp:
+        text = fp.read()
+    conn = db.get_sqlite_connection()
+    cursor = conn.cursor()
+    db.init_sqlite(cursor)
+    try:
+        changed = ingest(cursor, args.name, parse(text))
+    except WeightsError as e:
+        for problem in e.problems:
+            print(problem, file=sys.stderr)
+        sys.exit(1)
+    if changed:
+        db.bump_generation(cursor)
+        conn.commit()
+        print('saved', args.name)
+    else:
+        print('not changed', args.name)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()